@@ -0,0 +1,127 @@
+import numpy as np
+
+# Vectorized versions of the per-box helpers space_om_extract.py used to have
+# (enlarge_bbox, enlarge_bbox_square, calculate_combined_bbox,
+# constrain_bbox_within_frame) and of the area maths in get_best_view.py.
+# Boxes are float arrays of shape (N, 4), either xywh (as stored in the
+# annotations) or xyxy. Missing boxes are NaN rows. Integer conversions
+# truncate toward zero exactly like the scalar int() calls, so crops match
+# the per-frame code pixel for pixel; tests/test_bbox_geometry.py checks them
+# against the scalar originals.
+
+
+def as_boxes(boxes):
+    arr = np.asarray(boxes, dtype=np.float64)
+    return arr.reshape(-1, 4)
+
+
+def boxes_from_dict(bboxes, frame_ids):
+    """{'frame_id': [x, y, w, h]} -> (len(frame_ids), 4) xywh array, NaN where not annotated."""
+    out = np.full((len(frame_ids), 4), np.nan)
+    for i, frame_id in enumerate(frame_ids):
+        box = bboxes.get(str(frame_id))
+        if box is not None:
+            out[i] = box
+    return out
+
+
+def xywh_to_xyxy(boxes):
+    boxes = as_boxes(boxes)
+    return np.concatenate([boxes[:, :2], boxes[:, :2] + boxes[:, 2:]], axis=1)
+
+
+def xyxy_to_xywh(boxes):
+    boxes = as_boxes(boxes)
+    return np.concatenate([boxes[:, :2], boxes[:, 2:] - boxes[:, :2]], axis=1)
+
+
+def scale_boxes(boxes, scale=1.2):
+    """enlarge_bbox for N boxes: scale w/h around the centre."""
+    boxes = as_boxes(boxes)
+    center = boxes[:, :2] + boxes[:, 2:] / 2
+    size = boxes[:, 2:] * scale
+    return np.concatenate([center - size / 2, size], axis=1)
+
+
+def square_boxes(boxes, scale=1.2):
+    """enlarge_bbox_square for N boxes: scale, then grow the short side to the long one."""
+    boxes = as_boxes(boxes)
+    center = boxes[:, :2] + boxes[:, 2:] / 2
+    side = np.max(boxes[:, 2:] * scale, axis=1, keepdims=True)
+    size = np.repeat(side, 2, axis=1)
+    return np.concatenate([center - size / 2, size], axis=1)
+
+
+def union_boxes(a, b):
+    """calculate_combined_bbox row-wise (xywh). A NaN row on one side returns the other box."""
+    a, b = xywh_to_xyxy(a), xywh_to_xyxy(b)
+    lo = np.fmin(a[:, :2], b[:, :2])
+    hi = np.fmax(a[:, 2:], b[:, 2:])
+    return np.concatenate([lo, hi - lo], axis=1)
+
+
+def clip_boxes(boxes_xyxy, frame_shape):
+    """constrain_bbox_within_frame for N xyxy boxes. Returns int64; NaN rows become -1."""
+    boxes = np.trunc(as_boxes(boxes_xyxy))
+    missing = np.isnan(boxes).any(axis=1)
+    height, width = frame_shape[0], frame_shape[1]
+    boxes[:, :2] = np.maximum(boxes[:, :2], 0)
+    boxes[:, 2] = np.minimum(boxes[:, 2], width)
+    boxes[:, 3] = np.minimum(boxes[:, 3], height)
+    boxes[missing] = -1
+    return boxes.astype(np.int64)
+
+
+def area(boxes):
+    boxes = as_boxes(boxes)
+    return boxes[:, 2] * boxes[:, 3]
+
+
+def iou(a, b):
+    """Pairwise IoU of xywh boxes, shape (len(a), len(b))."""
+    a, b = xywh_to_xyxy(a), xywh_to_xyxy(b)
+    lo = np.maximum(a[:, None, :2], b[None, :, :2])
+    hi = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.prod(np.clip(hi - lo, 0, None), axis=2)
+    union = area(xyxy_to_xywh(a))[:, None] + area(xyxy_to_xywh(b))[None, :] - inter
+    return np.where(union > 0, inter / np.where(union > 0, union, 1), 0.0)
+
+
+def interpolate_track(bboxes, frame_ids):
+    """
+    Dense track from sparse annotations: linear interpolation of xywh between
+    annotated frames. Frames outside the annotated range are NaN.
+    `bboxes` is the {'frame_id': [x, y, w, h]} dict of the annotation files.
+    """
+    frame_ids = np.asarray(frame_ids, dtype=np.float64)
+    out = np.full((len(frame_ids), 4), np.nan)
+    if not bboxes:
+        return out
+    keys = sorted(bboxes, key=int)
+    known = np.array([int(k) for k in keys], dtype=np.float64)
+    values = as_boxes([bboxes[k] for k in keys])
+    inside = (frame_ids >= known[0]) & (frame_ids <= known[-1])
+    for c in range(4):
+        out[inside, c] = np.interp(frame_ids[inside], known, values[:, c])
+    return out
+
+
+def crop_rects(ped, veh, frame_shape, scale=1.5):
+    """
+    Everything draw_and_save_bboxes_scale_version computes per frame, for all
+    frames at once. `ped` / `veh` are (N, 4) xywh arrays with NaN rows for
+    frames without a box. Returns int64 xyxy arrays (ped, veh, crop); rows
+    are -1 where the box (or, for crop, both boxes) is missing.
+    """
+    ped_rect = clip_boxes(xywh_to_xyxy(scale_boxes(ped, scale)), frame_shape)
+    veh_rect = clip_boxes(xywh_to_xyxy(scale_boxes(veh, scale)), frame_shape)
+
+    def rect_to_xywh(rect):
+        out = xyxy_to_xywh(rect.astype(np.float64))
+        out[rect[:, 0] < 0] = np.nan
+        return out
+
+    combined = union_boxes(rect_to_xywh(ped_rect), rect_to_xywh(veh_rect))
+    crop = xywh_to_xyxy(square_boxes(combined, scale))
+    crop_rect = clip_boxes(crop, frame_shape)
+    return ped_rect, veh_rect, crop_rect
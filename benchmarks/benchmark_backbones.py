@@ -0,0 +1,136 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from frame_pack import FrameResolver
+from spaceom_infer import MAX_TOKENS, MAX_NEW_TOKENS, load_images, extract_choice, answer_of
+from model_registry import BACKBONES, ModelPool, register, parse_spec, reset_peak_memory, peak_memory_mb
+
+# Side-by-side VQA comparison of the backbones in model_registry.py:
+#
+#   python benchmarks/benchmark_backbones.py --backbones videollama3-2b spaceom-lora llava-1.5-7b
+#   python benchmarks/benchmark_backbones.py --backbones tiny-qwen tiny-llava --limit 20    # CPU smoke run
+#   python benchmarks/benchmark_backbones.py --register mine=hf:org/model --backbones mine spaceom
+#
+# Every backbone answers the same samples of vqa_spaceom_val.json one at a
+# time (batch size 1, so latency is per question) and is unloaded before the
+# next one loads, so peak memory is its own. Reported per backbone: accuracy
+# (overall and per view), latency p50 / p90 / p99, generated tokens per
+# second, load time, weight size and peak memory (GPU allocation, or peak
+# RSS on CPU).
+
+DATA_JSON = "vqa_spaceom_val.json"      # image paths are relative to the repo root
+IMAGE_ROOT = Path(".")
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) if values else None
+
+
+def run_backbone(pool, name, samples, resolver, args):
+    reset_peak_memory(pool.device)
+    backbone = pool.get(name)
+    latencies, tokens, predictions = [], [], []
+    per_view = defaultdict(lambda: [0, 0])
+    for s in tqdm(samples, desc=name):
+        images = load_images(s, resolver)
+        start = time.perf_counter()
+        responses, counts = backbone.answer([s], [images], args.max_new_tokens)
+        latencies.append(time.perf_counter() - start)
+        tokens.append(counts[0])
+        prediction = extract_choice(responses[0])
+        predictions.append(prediction)
+        per_view[s["view"]][0] += int(prediction == answer_of(s))
+        per_view[s["view"]][1] += 1
+    correct = sum(c for c, _ in per_view.values())
+    result = dict(
+        model_id=backbone.model_id,
+        adapter=backbone.adapter,
+        load_seconds=round(backbone.load_seconds, 2),
+        model_mb=round(backbone.measured_mb, 1),
+        peak_mb=peak_memory_mb(pool.device),
+        accuracy=correct / max(len(samples), 1),
+        accuracy_per_view={view: c / n for view, (c, n) in sorted(per_view.items())},
+        latency_p50_s=percentile(latencies, 50),
+        latency_p90_s=percentile(latencies, 90),
+        latency_p99_s=percentile(latencies, 99),
+        tokens_per_s=sum(tokens) / sum(latencies) if latencies else None,
+        unanswered=sum(p is None for p in predictions),
+    )
+    if not args.keep_loaded:
+        pool.unload(name)
+    return result, predictions
+
+
+def table(results):
+    header = f"{'backbone':<18} {'acc':>7} {'p50 s':>8} {'p90 s':>8} {'p99 s':>8} {'tok/s':>8} {'model MB':>9} {'peak MB':>9}"
+    lines = [header, "-" * len(header)]
+    for name, r in results.items():
+        lines.append(f"{name:<18} {r['accuracy']:>7.4f} {r['latency_p50_s']:>8.3f} {r['latency_p90_s']:>8.3f} "
+                     f"{r['latency_p99_s']:>8.3f} {r['tokens_per_s']:>8.1f} {r['model_mb']:>9.0f} {r['peak_mb'] or 0:>9.0f}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare VQA backbones (accuracy, latency, tokens/s, memory).")
+    parser.add_argument("--backbones", nargs="+", required=True, help=f"registered names: {', '.join(BACKBONES)}")
+    parser.add_argument("--register", action="append", default=[], metavar="NAME=KIND:MODEL[:ADAPTER]",
+                        help="register an extra backbone (kind: qwen, hf or videollama3)")
+    parser.add_argument("--data", type=str, default=DATA_JSON)
+    parser.add_argument("--image-root", type=Path, default=IMAGE_ROOT)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--device", type=str, default=None)
+    parser.add_argument("--budget-mb", type=float, default=None, help="memory budget of the model pool")
+    parser.add_argument("--keep-loaded", action="store_true", help="keep backbones loaded while the budget allows")
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", type=str, default="benchmarks/results/backbones.json")
+    args = parser.parse_args()
+
+    for spec in args.register:
+        name, kind, model_id, extra = parse_spec(spec)
+        register(name, kind, model_id, **extra)
+    unknown = [b for b in args.backbones if b not in BACKBONES]
+    if unknown:
+        parser.error(f"unknown backbones {unknown}; registered: {', '.join(BACKBONES)}")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    with open(args.data) as f:
+        samples = json.load(f)[:args.limit]
+
+    pool = ModelPool(args.budget_mb, args.device, args.max_tokens)
+    resolver = FrameResolver(args.image_root)
+    results, predictions = dict(), dict()
+    for name in args.backbones:
+        results[name], predictions[name] = run_backbone(pool, name, samples, resolver, args)
+    reference = predictions[args.backbones[0]]
+    for name, preds in predictions.items():
+        results[name]["agreement"] = sum(p == r for p, r in zip(preds, reference)) / max(len(samples), 1)
+    print(table(results))
+
+    out = dict(
+        meta=dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), data=args.data, samples=len(samples),
+                  device=pool.device, budget_mb=round(pool.budget_mb), threads=torch.get_num_threads(),
+                  python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count()),
+        backbones=results,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(out, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
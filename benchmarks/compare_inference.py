@@ -0,0 +1,121 @@
+import os
+import gc
+import sys
+import json
+import time
+import platform
+import argparse
+from pathlib import Path
+
+import numpy as np
+import torch
+from tqdm import tqdm
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from frame_pack import FrameResolver
+from spaceom_infer import (MODEL_ID, MAX_TOKENS, MAX_NEW_TOKENS, load_model, load_images, prepare, collate,
+                           generate, extract_choice, answer_of, model_megabytes)
+
+# Latency / accuracy of the CPU inference variants on the same VQA samples:
+#
+#   adapter   base + LoRA through peft (what notebooks do today, on CPU)
+#   merged    adapter folded into the base weights (export_merged.py)
+#   int8      merged, with dynamically quantized int8 linear layers
+#
+#   python benchmarks/compare_inference.py --adapter spaceom_lora --limit 100
+#   python benchmarks/compare_inference.py --merged spaceom_merged --variants merged int8
+#
+# Every variant sees identical prompts (same token budget, batch size 1).
+# Agreement is measured against the first variant, so int8 drift shows up
+# even on samples every variant gets wrong.
+
+DATA_JSON = "vqa_spaceom_val.json"      # image paths are relative to the repo root
+IMAGE_ROOT = Path(".")
+VARIANTS = ["adapter", "merged", "int8"]
+
+
+def load_variant(variant, model_id, adapter, merged):
+    if variant == "adapter":
+        return load_model(model_id, adapter, device="cpu")
+    if merged:
+        return load_model(merged, None, device="cpu", int8=variant == "int8")
+    return load_model(model_id, adapter, device="cpu", merge=True, int8=variant == "int8")
+
+
+def run_variant(variant, samples, args):
+    start = time.perf_counter()
+    model, processor = load_variant(variant, args.model, args.adapter, args.merged)
+    load_seconds = time.perf_counter() - start
+    resolver = FrameResolver(args.image_root)
+
+    latencies, predictions = [], []
+    for s in tqdm(samples, desc=variant):
+        text, images, plan = prepare(processor, s, load_images(s, resolver), args.max_tokens)
+        start = time.perf_counter()
+        response = generate(model, processor, collate(processor, [(text, images, plan)], model.device),
+                            args.max_new_tokens)[0]
+        latencies.append(time.perf_counter() - start)
+        predictions.append(extract_choice(response))
+
+    answers = [answer_of(s) for s in samples]
+    result = dict(
+        load_seconds=round(load_seconds, 2),
+        model_mb=round(model_megabytes(model), 1),
+        accuracy=sum(p == a for p, a in zip(predictions, answers)) / max(len(samples), 1),
+        latency_mean_s=float(np.mean(latencies)) if latencies else None,
+        latency_p50_s=float(np.percentile(latencies, 50)) if latencies else None,
+        latency_p90_s=float(np.percentile(latencies, 90)) if latencies else None,
+    )
+    del model, processor
+    gc.collect()
+    return result, predictions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare CPU inference variants (adapter / merged / int8) on VQA.")
+    parser.add_argument("--data", type=str, default=DATA_JSON)
+    parser.add_argument("--image-root", type=Path, default=IMAGE_ROOT)
+    parser.add_argument("--model", type=str, default=MODEL_ID)
+    parser.add_argument("--adapter", type=str, default=None, help="LoRA adapter (train.py OUTPUT_DIR)")
+    parser.add_argument("--merged", type=str, default=None, help="checkpoint from export_merged.py")
+    parser.add_argument("--variants", nargs="+", default=VARIANTS, choices=VARIANTS)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--threads", type=int, default=None, help="torch intra-op threads")
+    parser.add_argument("--output", type=str, default="benchmarks/results/inference_cpu.json")
+    args = parser.parse_args()
+
+    if "adapter" in args.variants and not args.adapter:
+        parser.error("the adapter variant needs --adapter")
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    with open(args.data) as f:
+        samples = json.load(f)[:args.limit]
+
+    variants, reference = dict(), None
+    for variant in args.variants:
+        result, predictions = run_variant(variant, samples, args)
+        if reference is None:
+            reference = predictions
+        result["agreement"] = sum(p == r for p, r in zip(predictions, reference)) / max(len(samples), 1)
+        variants[variant] = result
+        print(f"{variant:<8} acc {result['accuracy']:.4f}  agree {result['agreement']:.4f}  "
+              f"p50 {result['latency_p50_s']:.3f}s  p90 {result['latency_p90_s']:.3f}s  "
+              f"{result['model_mb']:.0f} MB  load {result['load_seconds']:.1f}s")
+
+    results = dict(
+        meta=dict(timestamp=time.strftime("%Y-%m-%dT%H:%M:%S"), data=args.data, samples=len(samples),
+                  model=args.model, adapter=args.adapter, merged=args.merged, threads=torch.get_num_threads(),
+                  python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count()),
+        variants=variants,
+    )
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Saved results to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
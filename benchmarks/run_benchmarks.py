@@ -0,0 +1,184 @@
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import argparse
+import subprocess
+from pathlib import Path
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from synthetic_data import make_tree
+
+# name -> (videos, frames per video, overhead cameras)
+SCALES = {
+    'small': (2, 90, 2),
+    'medium': (4, 180, 3),
+    'large': (8, 300, 4),
+}
+
+# Stages in pipeline order. Every stage runs as its own process with the
+# synthetic tree as working directory, exactly like the real scripts.
+# extract_val.py hard-codes absolute paths, so it is driven through its main().
+STAGES = [
+    ('extract_frames_bbox', ['extract_frames_bbox.py']),
+    ('space_om_extract', ['space_om_extract.py']),
+    ('space_om_format', ['space_om_format.py']),
+    ('get_best_view', ['get_best_view.py', '--save-path', 'processed_anno/best_view_for_scenario.json']),
+    ('extract_val', ['-c', 'import extract_val as m; from pathlib import Path; '
+                           'm.VAL_VIDEO_ROOT = Path("data/videos/val").resolve(); '
+                           'm.OUTPUT_ROOT = Path("data/bbox_global/val").resolve(); m.main()']),
+    ('vqa_space_om', ['vqa_space_om.py']),
+]
+
+
+def run_stage(argv, cwd):
+    if argv[0] != '-c':
+        argv = [os.path.join(REPO_ROOT, argv[0])] + argv[1:]
+    env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable] + argv, cwd=cwd, env=env, capture_output=True, text=True)
+    seconds = time.perf_counter() - start
+    if proc.returncode != 0:
+        print(proc.stderr[-2000:], file=sys.stderr)
+    return dict(seconds=seconds, returncode=proc.returncode)
+
+
+def count_files(root, suffix):
+    return sum(1 for _, _, files in os.walk(root) for f in files if f.endswith(suffix))
+
+
+class StubProcessor:
+    """
+    Stands in for the Qwen2.5-VL processor so the dataset benchmark measures
+    JSON access + image decode/resize only, without downloading a model.
+    Text is "tokenized" by whitespace, images count as their three marker tokens.
+    """
+
+    def tokenizer(self, text, add_special_tokens=False):
+        return dict(input_ids=text.split())
+
+    def apply_chat_template(self, chat, tokenize=False, add_generation_prompt=True):
+        return ' '.join('<vs> <pad> <ve>' if c['type'] == 'image' else c.get('text', '')
+                        for turn in chat for c in turn['content'])
+
+    def __call__(self, text, images, return_tensors='pt', padding=None, truncation=None, max_length=None):
+        import numpy as np
+        import torch
+        pixels = [torch.from_numpy(np.asarray(img, dtype=np.uint8).copy()).flatten() for img in images]
+        return dict(input_ids=torch.zeros((1, max_length or 1), dtype=torch.long),
+                    pixel_values=torch.cat(pixels) if pixels else torch.zeros(0),
+                    image_grid_thw=torch.zeros((len(images), 3), dtype=torch.long))
+
+
+def bench_dataset(cwd, json_name, image_root, max_items):
+    from train import SpaceOmJsonDataset
+    json_path = Path(cwd) / json_name
+    if not json_path.exists():
+        return None
+    ds = SpaceOmJsonDataset(json_path, StubProcessor(), Path(cwd) / image_root)
+    n = min(len(ds), max_items)
+    if n == 0:
+        return dict(samples=0, seconds=0.0, samples_per_sec=0.0)
+    start = time.perf_counter()
+    for i in range(n):
+        ds[i]
+    seconds = time.perf_counter() - start
+    return dict(samples=n, seconds=seconds, samples_per_sec=n / seconds)
+
+
+def bench_scale(name, videos, frames, cameras, repeat, keep):
+    workdir = tempfile.mkdtemp(prefix=f'bench_{name}_')
+    try:
+        start = time.perf_counter()
+        summary = make_tree(workdir, videos, frames, cameras)
+        summary['generate_seconds'] = time.perf_counter() - start
+
+        stages = dict()
+        for stage, argv in STAGES:
+            runs = [run_stage(argv, workdir) for _ in range(repeat)]
+            stages[stage] = dict(seconds=min(r['seconds'] for r in runs),
+                                 returncode=max(r['returncode'] for r in runs))
+            print(f"[{name}] {stage}: {stages[stage]['seconds']:.2f}s (rc={stages[stage]['returncode']})")
+
+        summary['images_written'] = count_files(os.path.join(workdir, 'data/bbox_global'), '.jpg') \
+            + count_files(os.path.join(workdir, 'data/bbox_local'), '.jpg')
+
+        datasets = dict()
+        # space_om_format stores paths from the tree root, vqa_space_om relative to bbox_global/val
+        for json_name, image_root in [('data_preprocess/wts_bdd_train.json', '.'),
+                                      ('vqa_spaceom_val_multiframe.json', 'data/bbox_global/val')]:
+            result = bench_dataset(workdir, json_name, image_root, max_items=200)
+            if result is not None:
+                datasets[json_name] = result
+                print(f"[{name}] dataset {json_name}: {result['samples_per_sec']:.1f} samples/s")
+
+        return dict(name=name, videos=videos, frames=frames, cameras=cameras,
+                    summary=summary, stages=stages, dataset=datasets)
+    finally:
+        if keep:
+            print(f'[{name}] kept synthetic tree at {workdir}')
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                              text=True).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def compare(results, baseline, tolerance):
+    """Print stage-by-stage ratios against a previous results file. Returns #regressions."""
+    base_scales = {s['name']: s for s in baseline['scales']}
+    regressions = 0
+    for scale in results['scales']:
+        base = base_scales.get(scale['name'])
+        if base is None:
+            continue
+        for stage, cur in scale['stages'].items():
+            if stage not in base['stages'] or base['stages'][stage]['seconds'] <= 0:
+                continue
+            ratio = cur['seconds'] / base['stages'][stage]['seconds']
+            flag = 'REGRESSION' if ratio > 1 + tolerance else ''
+            regressions += bool(flag)
+            print(f"[{scale['name']}] {stage}: {ratio:.2f}x baseline {flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time every preprocessing stage on synthetic data (CPU, offline).')
+    parser.add_argument('--scales', nargs='+', default=['small', 'medium'], choices=sorted(SCALES))
+    parser.add_argument('--repeat', type=int, default=1, help='runs per stage, the fastest is reported')
+    parser.add_argument('--output', type=str, default='benchmarks/results/latest.json')
+    parser.add_argument('--baseline', type=str, default=None, help='previous results file to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown before flagging')
+    parser.add_argument('--keep', action='store_true', help='keep the synthetic trees for inspection')
+    args = parser.parse_args()
+
+    results = dict(
+        meta=dict(timestamp=time.strftime('%Y-%m-%dT%H:%M:%S'), commit=git_commit(),
+                  python=platform.python_version(), platform=platform.platform(), cpu_count=os.cpu_count()),
+        scales=[bench_scale(name, *SCALES[name], repeat=args.repeat, keep=args.keep) for name in args.scales],
+    )
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f'Saved results to {args.output}')
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if compare(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
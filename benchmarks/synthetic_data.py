@@ -0,0 +1,142 @@
+import os
+import csv
+import json
+import cv2
+import numpy as np
+
+# Synthetic WTS-style data tree for the benchmarks. The layout mirrors what
+# the preprocessing scripts expect under `data/`:
+#   videos/{train,val}/<scenario>/{overhead_view,vehicle_view}/*.mp4
+#   videos/train/normal_trimmed/<scenario>/overhead_view/*.mp4
+#   annotations/caption/train/...            (extract_frames_bbox, space_om_format, get_best_view)
+#   annotations/bbox_annotated/{pedestrian,vehicle}/train/...
+#   annotations/vqa/val/<scenario>/{environment,overhead_view,vehicle_view}/<scenario>.json
+#   external/BDD_PC_5K/videos/train, view_used_as_main_reference_for_multiview_scenario.csv
+
+FPS = 30
+FRAME_SIZE = (320, 180)   # (width, height)
+PHASES = ['prerecognition', 'recognition', 'judgement', 'action', 'avoidance']
+
+
+def write_json(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(data, f, indent=2)
+
+
+def write_video(path, num_frames, rng, size=FRAME_SIZE, fps=FPS):
+    """Noise background with a moving box, so codecs do real work."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    width, height = size
+    writer = cv2.VideoWriter(path, cv2.VideoWriter_fourcc(*'mp4v'), fps, (width, height))
+    background = rng.integers(0, 255, size=(height, width, 3), dtype=np.uint8)
+    for i in range(num_frames):
+        frame = background.copy()
+        x = int((i * 3) % max(1, width - 40))
+        cv2.rectangle(frame, (x, height // 3), (x + 20, height // 3 + 50), (0, 255, 0), -1)
+        writer.write(frame)
+    writer.release()
+
+
+def phase_frames(num_frames):
+    """One annotated frame id per phase, spread over the video."""
+    step = max(1, num_frames // (len(PHASES) + 1))
+    return [min(num_frames - 1, step * (i + 1)) for i in range(len(PHASES))]
+
+
+def bbox_annotations(num_frames, rng, size=FRAME_SIZE):
+    width, height = size
+    annotations = []
+    for phase, frame_id in enumerate(phase_frames(num_frames)):
+        w, h = float(rng.uniform(10, 40)), float(rng.uniform(30, 80))
+        x, y = float(rng.uniform(0, width - w)), float(rng.uniform(0, height - h))
+        annotations.append(dict(image_id=frame_id, bbox=[x, y, w, h], phase_number=phase))
+    return annotations
+
+
+def event_phases(num_frames, fps=FPS, conversations=None):
+    phases = []
+    frames = phase_frames(num_frames)
+    for phase, frame_id in enumerate(frames):
+        start = frame_id / fps
+        end = (frames[phase + 1] if phase + 1 < len(frames) else num_frames) / fps
+        event = dict(labels=[str(phase)], start_time=f'{start:.3f}', end_time=f'{end:.3f}')
+        if conversations is None:
+            event['caption_pedestrian'] = f'Synthetic pedestrian caption for phase {phase}.'
+            event['caption_vehicle'] = f'Synthetic vehicle caption for phase {phase}.'
+        else:
+            event['conversations'] = conversations
+        phases.append(event)
+    return phases
+
+
+def vqa_question(text):
+    return dict(question=text, a='yes', b='no', c='maybe', d='unknown', correct='a')
+
+
+def make_train_scenario(root, sid, num_frames, num_cameras, rng, normal=False):
+    base = os.path.join('normal_trimmed', sid) if normal else sid
+    cameras = [f'{sid}_Camera{c + 1}_0.mp4' for c in range(num_cameras)]
+    for camera in cameras:
+        write_video(os.path.join(root, 'data/videos/train', base, 'overhead_view', camera), num_frames, rng)
+        for kind in ['pedestrian', 'vehicle']:
+            write_json(os.path.join(root, 'data/annotations/bbox_annotated', kind, 'train', base, 'overhead_view',
+                                    camera.replace('.mp4', '_bbox.json')),
+                       dict(annotations=bbox_annotations(num_frames, rng)))
+    write_json(os.path.join(root, 'data/annotations/caption/train', base, 'overhead_view', f'{sid}_caption.json'),
+               dict(overhead_videos=cameras, event_phase=event_phases(num_frames)))
+
+    if normal:
+        return cameras
+    vehicle = f'{sid}_vehicle_view.mp4'
+    write_video(os.path.join(root, 'data/videos/train', base, 'vehicle_view', vehicle), num_frames, rng)
+    for kind in ['pedestrian', 'vehicle']:
+        write_json(os.path.join(root, 'data/annotations/bbox_annotated', kind, 'train', base, 'vehicle_view',
+                                vehicle.replace('.mp4', '_bbox.json')),
+                   dict(annotations=bbox_annotations(num_frames, rng)))
+    write_json(os.path.join(root, 'data/annotations/caption/train', base, 'vehicle_view', f'{sid}_caption.json'),
+               dict(vehicle_view=vehicle, event_phase=event_phases(num_frames)))
+    return cameras
+
+
+def make_val_scenario(root, sid, num_frames, num_cameras, rng):
+    cameras = [f'{sid}_Camera{c + 1}_0.mp4' for c in range(num_cameras)]
+    for camera in cameras:
+        write_video(os.path.join(root, 'data/videos/val', sid, 'overhead_view', camera), num_frames, rng)
+    vehicle = f'{sid}_vehicle_view.mp4'
+    write_video(os.path.join(root, 'data/videos/val', sid, 'vehicle_view', vehicle), num_frames, rng)
+
+    vqa_root = os.path.join(root, 'data/annotations/vqa/val', sid)
+    convs = [vqa_question('Is the pedestrian crossing?'), vqa_question('Is the vehicle moving?')]
+    write_json(os.path.join(vqa_root, 'environment', f'{sid}.json'),
+               [dict(environment=[vqa_question('What is the weather?'), vqa_question('Is it daytime?')])])
+    write_json(os.path.join(vqa_root, 'overhead_view', f'{sid}.json'),
+               [dict(overhead_videos=cameras, event_phase=event_phases(num_frames, conversations=convs))])
+    write_json(os.path.join(vqa_root, 'vehicle_view', f'{sid}.json'),
+               [dict(vehicle_view=vehicle, event_phase=event_phases(num_frames, conversations=convs))])
+
+
+def make_tree(root, num_videos, num_frames, num_cameras, seed=0):
+    """
+    Build a synthetic tree under `root` with `num_videos` scenarios per split
+    (plus one normal_trimmed scenario), each with `num_cameras` overhead
+    cameras of `num_frames` frames. Returns a small summary dict.
+    """
+    rng = np.random.default_rng(seed)
+    reference_rows = []
+    for i in range(num_videos):
+        sid = f'20230707_{i + 1}_SN{i + 1}_T1'
+        cameras = make_train_scenario(root, sid, num_frames, num_cameras, rng)
+        reference_rows.append([sid] + cameras[:1])
+        make_val_scenario(root, f'20230922_{i + 1}_CN{i + 1}_T1', num_frames, num_cameras, rng)
+    make_train_scenario(root, '20230922_1_CN1_T1_normal_0', num_frames, 1, rng, normal=True)
+
+    with open(os.path.join(root, 'data/view_used_as_main_reference_for_multiview_scenario.csv'), 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['scenario', 'view'])
+        writer.writerows(reference_rows)
+    os.makedirs(os.path.join(root, 'data/external/BDD_PC_5K/videos/train'), exist_ok=True)
+
+    num_train_videos = num_videos * (num_cameras + 1) + 1
+    return dict(train_videos=num_train_videos, val_videos=num_videos * (num_cameras + 1),
+                frames_per_video=num_frames, cameras=num_cameras, scenarios=num_videos)
@@ -0,0 +1,278 @@
+import re
+import json
+import time
+import argparse
+from pathlib import Path
+from collections import defaultdict
+
+import numpy as np
+from tqdm import tqdm
+
+import metrics
+from frame_pack import FrameResolver
+from model_registry import BACKBONES, ModelPool
+from spaceom_infer import MAX_TOKENS, MAX_NEW_TOKENS, load_images, user_turn, answer_of, extract_choice, accuracy_report
+
+# Confidence-gated VQA cascade: a small backbone answers every question from
+# its choice-letter probabilities (one forward pass, model_registry.py
+# choice_probs); questions whose top probability is below the threshold of
+# their perspective (environment / overhead / vehicle) are escalated to the
+# large backbone, which answers as in spaceom_infer.py.
+#
+#   python cascade.py --calibrate --limit 2000          # tune thresholds on vqa_spaceom_val.json
+#   python cascade.py --data vqa_spaceom_val_multiframe.json --image-root data/bbox_global/val
+#
+# --calibrate runs both backbones on every sample, tunes on a random
+# CALIB_FRACTION of them and reports on the rest. Per perspective, the
+# threshold is the lowest one (fewest escalations) whose cascade accuracy on
+# the calibration part stays within MAX_ACCURACY_DROP of the large model
+# alone. Thresholds and the large model's mean latency per perspective go to
+# THRESHOLDS_JSON; a normal run reads them, answers with the cascade and
+# estimates the latency saved against running the large model on everything.
+# The two backbones are swapped through one ModelPool, so they never need to
+# fit in memory together.
+
+# ========= CONFIG ========= #
+SMALL_BACKBONE    = "videollama3-2b"
+LARGE_BACKBONE    = "spaceom-lora"
+DATA_JSON         = "vqa_spaceom_val.json"      # image paths are relative to the repo root
+IMAGE_ROOT        = Path(".")
+THRESHOLDS_JSON   = "cascade_thresholds.json"
+OUTPUT_JSON       = "predictions_cascade.json"
+REPORT_JSON       = "cascade_report.json"
+CALIB_FRACTION    = 0.5
+MAX_ACCURACY_DROP = 0.0                         # allowed cascade accuracy loss vs the large model, per perspective
+SEED              = 0
+BATCH_SIZE        = 1
+# ========================== #
+
+OPTION_RE = re.compile(r"^([a-d]):", re.IGNORECASE | re.MULTILINE)
+CHOICES = "abcd"
+
+
+def offered_choices(sample):
+    """Choice letters listed in the question ("a: ..." lines)."""
+    text = "\n".join(c["text"] for c in user_turn(sample)["content"] if c["type"] == "text")
+    return {m.lower() for m in OPTION_RE.findall(text)} or set(CHOICES)
+
+
+def timed_batches(samples, resolver, batch_size, fn):
+    """fn(batch, images) over `samples`; returns (concatenated results, per-sample seconds)."""
+    results, seconds = [], []
+    for start in tqdm(range(0, len(samples), batch_size), desc=fn.__name__):
+        batch = samples[start:start + batch_size]
+        images = [load_images(s, resolver) for s in batch]
+        t = time.perf_counter()
+        out = fn(batch, images)
+        seconds += [(time.perf_counter() - t) / len(batch)] * len(batch)
+        results += list(out)
+    return results, seconds
+
+
+def small_pass(backbone, samples, resolver, batch_size):
+    """(predicted letters, confidences, per-sample seconds) of the small backbone."""
+    def small_model(batch, images):
+        probs = backbone.choice_probs(batch, images, CHOICES)
+        for row, s in zip(probs, batch):
+            row *= [c in offered_choices(s) for c in CHOICES]
+        return probs / probs.sum(1, keepdims=True).clip(1e-12)
+    probs, seconds = timed_batches(samples, resolver, batch_size, small_model)
+    probs = np.asarray(probs).reshape(len(samples), len(CHOICES))
+    return [CHOICES[i] for i in probs.argmax(1)], probs.max(1), seconds
+
+
+def large_pass(backbone, samples, resolver, batch_size, max_new_tokens):
+    """(responses, per-sample seconds) of the large backbone."""
+    def large_model(batch, images):
+        return backbone.answer(batch, images, max_new_tokens)[0]
+    return timed_batches(samples, resolver, batch_size, large_model)
+
+
+def fit_threshold(confidence, small_ok, large_ok, max_drop=MAX_ACCURACY_DROP):
+    """
+    Lowest confidence threshold (answers at or above it stay with the small
+    model) whose cascade accuracy is within `max_drop` of the large model.
+    None escalates everything.
+    """
+    order = np.argsort(-confidence, kind="stable")
+    conf, small_ok, large_ok = confidence[order], small_ok[order], large_ok[order]
+    n = len(conf)
+    # k most confident answers kept: accuracy = small hits among them + large hits among the rest
+    kept_hits = np.concatenate([[0], np.cumsum(small_ok)])
+    rest_hits = np.concatenate([np.cumsum(large_ok[::-1])[::-1], [0]])
+    accuracy = (kept_hits + rest_hits) / max(n, 1)
+    target = large_ok.mean() - max_drop if n else 0.0
+    best = None
+    for k in range(1, n + 1):
+        # a threshold can only split between distinct confidences
+        if (k == n or conf[k - 1] > conf[k]) and accuracy[k] >= target - 1e-9:
+            best = float(conf[k - 1])
+    return best
+
+
+def escalated(confidence, views, thresholds):
+    return np.array([t is None or c < t for c, t in zip(confidence, (thresholds.get(v) for v in views))], dtype=bool)
+
+
+def cascade_report(views, escalate, small_ok, cascade_ok, small_s, large_s, large_ok=None, large_only_s=None):
+    """
+    Per perspective (and overall): escalation rate, accuracies, latency of the
+    cascade and of the large model alone. Accuracies need answers; the large
+    model's are measured when `large_ok` is given. `large_only_s` (large-model
+    seconds per sample) defaults to `large_s`, which must then cover every sample.
+    """
+    large_only_s = large_s if large_only_s is None else large_only_s
+    report = dict()
+    groups = defaultdict(list)
+    for i, v in enumerate(views):
+        groups[v].append(i)
+    groups["all"] = list(range(len(views)))
+    for view, idx in sorted(groups.items()):
+        idx = np.asarray(idx)
+        esc = escalate[idx]
+        cascade_s = float(np.sum(small_s[idx]) + np.sum(large_s[idx][esc]))
+        base_s = float(np.sum(large_only_s[idx]))
+        row = dict(
+            samples=len(idx),
+            escalation_rate=float(esc.mean()),
+            small_accuracy=float(small_ok[idx].mean()),
+            cascade_accuracy=float(cascade_ok[idx].mean()),
+            cascade_s=cascade_s,
+            large_only_s=base_s,
+            saved_s=base_s - cascade_s,
+            saved_fraction=(base_s - cascade_s) / base_s if base_s else None,
+        )
+        if large_ok is not None:
+            row["large_accuracy"] = float(large_ok[idx].mean())
+            row["accuracy_delta"] = row["cascade_accuracy"] - row["large_accuracy"]
+        report[view] = row
+    return report
+
+
+def format_report(report, title):
+    lines = [title, f"  {'view':<12} {'n':>6} {'escalated':>9} {'small':>7} {'large':>7} {'cascade':>7} {'delta':>7} {'saved s':>9} {'saved':>6}"]
+    for view, r in report.items():
+        large = f"{r['large_accuracy']:>7.4f}" if "large_accuracy" in r else f"{'-':>7}"
+        delta = f"{r['accuracy_delta']:>+7.4f}" if "accuracy_delta" in r else f"{'-':>7}"
+        saved = f"{r['saved_fraction']:>6.1%}" if r["saved_fraction"] is not None else f"{'-':>6}"
+        lines.append(f"  {view:<12} {r['samples']:>6} {r['escalation_rate']:>9.1%} {r['small_accuracy']:>7.4f} {large} "
+                     f"{r['cascade_accuracy']:>7.4f} {delta} {r['saved_s']:>9.1f} {saved}")
+    return "\n".join(lines)
+
+
+def calibrate(pool, samples, resolver, args):
+    answers = [answer_of(s) for s in samples]
+    views = [s["view"] for s in samples]
+    small_pred, confidence, small_s = small_pass(pool.get(args.small), samples, resolver, args.batch_size)
+    responses, large_s = large_pass(pool.swap(args.small, args.large), samples, resolver, args.batch_size, args.max_new_tokens)
+    large_pred = [extract_choice(r) for r in responses]
+    small_ok = np.array([p == a for p, a in zip(small_pred, answers)])
+    large_ok = np.array([p == a for p, a in zip(large_pred, answers)])
+    small_s, large_s = np.asarray(small_s), np.asarray(large_s)
+
+    rng = np.random.default_rng(args.seed)
+    calib = np.zeros(len(samples), dtype=bool)
+    calib[rng.permutation(len(samples))[:int(round(args.calib_fraction * len(samples)))]] = True
+    heldout = ~calib if (~calib).any() else calib
+
+    # thresholds and the large model's latency come from the calibration split only
+    thresholds, large_latency = dict(), dict()
+    for view in sorted(set(views)):
+        idx = np.array([v == view for v in views]) & calib
+        thresholds[view] = fit_threshold(confidence[idx], small_ok[idx], large_ok[idx], args.max_drop) if idx.any() else None
+        if idx.any():
+            large_latency[view] = float(large_s[idx].mean())
+
+    escalate = escalated(confidence, views, thresholds)
+    cascade_ok = np.where(escalate, large_ok, small_ok)
+    sel = np.flatnonzero(heldout)
+    report = cascade_report([views[i] for i in sel], escalate[sel], small_ok[sel], cascade_ok[sel],
+                            small_s[sel], large_s[sel], large_ok[sel])
+    calib_report = cascade_report([views[i] for i in np.flatnonzero(calib)], escalate[calib], small_ok[calib],
+                                  cascade_ok[calib], small_s[calib], large_s[calib], large_ok[calib])
+    return dict(small=args.small, large=args.large, max_drop=args.max_drop, data=args.data,
+                calibration_samples=int(calib.sum()), heldout_samples=len(sel),
+                thresholds=thresholds, large_latency_s=large_latency,
+                calibration_report=calib_report, heldout_report=report)
+
+
+def run(pool, samples, resolver, calibration, args):
+    views = [s["view"] for s in samples]
+    thresholds = calibration["thresholds"]
+    small_pred, confidence, small_s = small_pass(pool.get(calibration["small"]), samples, resolver, args.batch_size)
+    escalate = escalated(confidence, views, thresholds)
+    hard = [s for s, e in zip(samples, escalate) if e]
+    responses, hard_s = [], []
+    if hard:
+        responses, hard_s = large_pass(pool.swap(calibration["small"], calibration["large"]), hard, resolver,
+                                       args.batch_size, args.max_new_tokens)
+    large_s = np.zeros(len(samples))
+    large_s[escalate] = hard_s
+    large_response = iter(responses)
+
+    predictions = []
+    for s, p, c, e in zip(samples, small_pred, confidence, escalate):
+        response = next(large_response) if e else None
+        predictions.append(dict(id=s["id"], view=s["view"], segment=s["segment"],
+                                prediction=extract_choice(response) if e else p, answer=answer_of(s),
+                                confidence=float(c), escalated=bool(e), small_prediction=p, response=response))
+
+    # the large model's time on samples it did not see is estimated from calibration
+    large_only_s = np.array([calibration["large_latency_s"].get(v, np.mean(list(calibration["large_latency_s"].values())))
+                             for v in views])
+    small_ok = np.array([p["small_prediction"] == p["answer"] for p in predictions])
+    cascade_ok = np.array([p["prediction"] == p["answer"] for p in predictions])
+    report = cascade_report(views, escalate, small_ok, cascade_ok, np.asarray(small_s), large_s, large_only_s=large_only_s)
+    return predictions, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confidence-gated VQA cascade: small backbone first, escalate when unsure.")
+    parser.add_argument("--calibrate", action="store_true", help="run both backbones and tune per-perspective thresholds")
+    parser.add_argument("--small", type=str, default=SMALL_BACKBONE, choices=sorted(BACKBONES))
+    parser.add_argument("--large", type=str, default=LARGE_BACKBONE, choices=sorted(BACKBONES))
+    parser.add_argument("--data", type=str, default=DATA_JSON)
+    parser.add_argument("--image-root", type=Path, default=IMAGE_ROOT)
+    parser.add_argument("--thresholds", type=str, default=THRESHOLDS_JSON, help="written by --calibrate, read otherwise")
+    parser.add_argument("--output", type=str, default=OUTPUT_JSON)
+    parser.add_argument("--report", type=str, default=REPORT_JSON, help="per-perspective escalation / accuracy / latency report")
+    parser.add_argument("--calib-fraction", type=float, default=CALIB_FRACTION, help="share of samples thresholds are tuned on")
+    parser.add_argument("--max-drop", type=float, default=MAX_ACCURACY_DROP, help="allowed accuracy loss vs the large model")
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--budget-mb", type=float, default=None, help="memory budget of the model pool")
+    parser.add_argument("--device", type=str, default=None)
+    args = parser.parse_args()
+
+    metrics.init("cascade")
+    with open(args.data) as f:
+        samples = json.load(f)[:args.limit]
+    pool = ModelPool(args.budget_mb, args.device, args.max_tokens)
+    resolver = FrameResolver(args.image_root)
+
+    if args.calibrate:
+        calibration = calibrate(pool, samples, resolver, args)
+        with open(args.thresholds, "w") as f:
+            json.dump(calibration, f, indent=2)
+        print("thresholds: " + ", ".join(f"{v} {t if t is None else round(t, 4)}" for v, t in calibration["thresholds"].items()))
+        print(format_report(calibration["heldout_report"], f"held-out ({calibration['heldout_samples']} samples)"))
+        print(f"Saved thresholds to {args.thresholds}")
+        return
+
+    with open(args.thresholds) as f:
+        calibration = json.load(f)
+    predictions, report = run(pool, samples, resolver, calibration, args)
+    with open(args.output, "w") as f:
+        json.dump(predictions, f, indent=2)
+    with open(args.report, "w") as f:
+        json.dump(dict(small=calibration["small"], large=calibration["large"], thresholds=calibration["thresholds"],
+                       report=report), f, indent=2)
+    print(accuracy_report(predictions))
+    print(format_report(report, f"cascade {calibration['small']} -> {calibration['large']} (large-only latency estimated)"))
+
+
+if __name__ == "__main__":
+    main()
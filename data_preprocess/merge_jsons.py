@@ -1,10 +1,43 @@
-import json
+import os
+import sys
+import argparse
 
-with open('caption_spaceom_train.json') as f1, open('vqa_spaceom_train_multiframe.json') as f2:
-    captions = json.load(f1)
-    vqa = json.load(f2)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from shards import iter_json_samples, dedup_samples, shuffle_samples, write_shards
 
-combined = captions + vqa
 
-with open('train_all.json', 'w') as out:
-    json.dump(combined, out, indent=2)
\ No newline at end of file
+def iter_inputs(paths, stats):
+    for path in paths:
+        for sample in iter_json_samples(path):
+            stats['read'] = stats.get('read', 0) + 1
+            yield sample
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stream sample files into balanced JSONL shards.')
+    parser.add_argument('inputs', nargs='*', default=['caption_spaceom_train.json', 'vqa_spaceom_train_multiframe.json'],
+                        help='.json arrays, .jsonl files or existing shard indexes')
+    parser.add_argument('--output-prefix', type=str, default='train_all')
+    parser.add_argument('--num-shards', type=int, default=8)
+    parser.add_argument('--dedup', action='store_true', help='drop exact duplicate samples')
+    parser.add_argument('--shuffle-buffer', type=int, default=0, help='0 keeps input order')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    stats = dict()
+    samples = iter_inputs(args.inputs, stats)
+    if args.dedup:
+        samples = dedup_samples(samples, stats)
+    if args.shuffle_buffer > 0:
+        samples = shuffle_samples(samples, args.shuffle_buffer, args.seed)
+
+    meta = dict(format='jsonl', inputs=args.inputs, dedup=args.dedup,
+                shuffle_buffer=args.shuffle_buffer, seed=args.seed)
+    index = write_shards(samples, args.output_prefix, args.num_shards, meta)
+
+    print(f"Read {stats.get('read', 0)} samples, dropped {stats.get('duplicates', 0)} duplicates")
+    print(f"Wrote {index['num_samples']} samples to {args.num_shards} shards ({args.output_prefix}.index.json)")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+import os
+import math
+
+import torch
+from torch.utils.data import DataLoader, Sampler
+
+from sample_store import cached_array
+
+# Helpers for multi-process training under torchrun (train.py).
+#
+#   torchrun --nproc_per_node 4 train.py                      # one node, 4 GPUs
+#   torchrun --nproc_per_node 2 train.py                      # CPU + gloo works too
+#   srun torchrun --nnodes $SLURM_NNODES --nproc_per_node 1 \
+#        --rdzv_backend c10d --rdzv_endpoint $HEAD:29500 train.py
+#
+# Every rank reads only the samples its sampler hands it from the shared
+# sample store. LengthGroupedDistributedSampler shuffles per epoch, sorts
+# "mega-batches" by an estimated sample cost and deals them out so the ranks
+# of one step get samples of similar cost (the slowest rank sets the pace of
+# every gradient all-reduce). Only LoRA weights require grad, so DDP only
+# all-reduces adapter gradients.
+
+MEGA_BATCH_MULT = 50
+IMAGE_COST = 256        # rough tokens of one image before token_budget.py shrinks it
+LENGTHS_SUFFIX = '.store.lengths.npy'
+
+
+def distributed_env():
+    """(rank, world_size, local_rank) from the torchrun environment, or None outside torchrun."""
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return None
+    return int(os.environ['RANK']), int(os.environ['WORLD_SIZE']), int(os.environ.get('LOCAL_RANK', 0))
+
+
+def sample_length(item):
+    """Cheap cost estimate of a sample: text words plus IMAGE_COST per image."""
+    length = 0
+    for turn in item['conversations']:
+        content = turn['content']
+        if isinstance(content, str):
+            length += len(content.split())
+            continue
+        for c in content:
+            length += IMAGE_COST if c['type'] == 'image' else len(c.get('text', '').split())
+    return length
+
+
+def store_lengths(store):
+    """sample_length() of every sample of a SampleStore, cached next to the store."""
+    return cached_array(store, LENGTHS_SUFFIX, sample_length)
+
+
+class LengthGroupedDistributedSampler(Sampler):
+    """
+    Drop-in for DistributedSampler (same num_samples, padding and set_epoch)
+    that groups samples of similar length into the same global step.
+    """
+
+    def __init__(self, lengths, batch_size, num_replicas, rank, seed=0, mega_batch_mult=MEGA_BATCH_MULT):
+        self.lengths = lengths
+        self.batch_size = batch_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.mega_batch_mult = mega_batch_mult
+        self.epoch = 0
+        self.num_samples = math.ceil(len(lengths) / num_replicas)
+        self.total_size = self.num_samples * num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return self.num_samples
+
+    def __iter__(self):
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        perm = torch.randperm(len(self.lengths), generator=g).tolist()
+        mega = self.batch_size * self.num_replicas * self.mega_batch_mult
+        indices = []
+        for start in range(0, len(perm), mega):
+            indices += sorted(perm[start:start + mega], key=lambda i: -self.lengths[i])
+        # pad like DistributedSampler so every rank runs the same number of steps
+        indices += indices[:self.total_size - len(indices)]
+        # consecutive runs of num_replicas * batch_size indices make up one step
+        return iter(indices[self.rank:self.total_size:self.num_replicas])
+
+
+class EpochDataLoader(DataLoader):
+    """DataLoader exposing set_epoch(), which Trainer calls at the start of every epoch."""
+
+    def set_epoch(self, epoch):
+        self.sampler.set_epoch(epoch)
@@ -0,0 +1,53 @@
+import os
+import json
+import time
+import argparse
+
+import torch
+from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
+from peft import PeftModel
+
+from spaceom_infer import MODEL_ID
+
+# Merge the LoRA adapter saved by train.py into the SpaceOm base weights and
+# write a standalone checkpoint (model + processor) that loads without peft
+# or bitsandbytes:
+#
+#   python export_merged.py --adapter spaceom_lora --output spaceom_merged
+#   python spaceom_infer.py --model spaceom_merged --int8
+#
+# The base is loaded in full precision for the merge (8-bit weights cannot
+# absorb the LoRA delta); --dtype picks what is written. Merged inference
+# skips the extra low-rank matmuls on every q_proj / v_proj / o_proj call.
+
+ADAPTER_DIR = "spaceom_lora"      # train.py OUTPUT_DIR
+EXPORT_DIR = "spaceom_merged"
+DTYPES = dict(float32=torch.float32, bfloat16=torch.bfloat16, float16=torch.float16)
+
+
+def merge_adapter(model_id=MODEL_ID, adapter=ADAPTER_DIR):
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_id, torch_dtype=torch.float32)
+    model = PeftModel.from_pretrained(model, adapter)
+    return model.merge_and_unload()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into SpaceOm and save a standalone checkpoint.")
+    parser.add_argument("--model", type=str, default=MODEL_ID)
+    parser.add_argument("--adapter", type=str, default=ADAPTER_DIR)
+    parser.add_argument("--output", type=str, default=EXPORT_DIR)
+    parser.add_argument("--dtype", choices=sorted(DTYPES), default="bfloat16")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    print(f"Merging {args.adapter} into {args.model} …")
+    model = merge_adapter(args.model, args.adapter).to(DTYPES[args.dtype])
+    model.save_pretrained(args.output, safe_serialization=True)
+    AutoProcessor.from_pretrained(args.model).save_pretrained(args.output)
+    with open(os.path.join(args.output, "export_info.json"), "w") as f:
+        json.dump(dict(base=args.model, adapter=os.path.abspath(args.adapter), dtype=args.dtype), f, indent=2)
+    print(f"Saved merged checkpoint to {args.output} ({time.perf_counter() - start:.1f}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,6 +2,8 @@ import json
 import os
 from tqdm import tqdm
 import argparse
+import metrics
+from metrics import load_json, path_exists, list_dir
 
 class Args:
     root = 'data'
@@ -9,6 +11,8 @@ class Args:
     save_folder = 'processed_anno'
 
 args = Args()
+metrics.init('extract_frames_bbox')
+
 
 video_path = os.path.join(args.root, 'videos', args.split)
 annotation_path = os.path.join(args.root, 'annotations/caption', args.split)
@@ -16,7 +20,7 @@ bbox_path = os.path.join(args.root, 'annotations/bbox_annotated')
 
 video_with_bbox_results = dict()
 
-for item in tqdm(os.listdir(video_path)):
+for item in tqdm(list_dir(video_path)):
     if 'normal' in item:
         continue
     
@@ -27,9 +31,9 @@ for item in tqdm(os.listdir(video_path)):
 
         # vehicle bbox extraction
         if view == 'overhead':
-            assert os.path.exists(caption_anno_path), f'{caption_anno_path} not exists'
+            assert path_exists(caption_anno_path), f'{caption_anno_path} not exists'
         try:
-            vehicle_annotation = json.load(open(caption_anno_path))['event_phase']
+            vehicle_annotation = load_json(caption_anno_path)['event_phase']
         except:
             continue
         start_time, end_time = None, None
@@ -43,26 +47,26 @@ for item in tqdm(os.listdir(video_path)):
             else:
                 end_time = max(float(phase['end_time']), end_time)
         
-        for camera in os.listdir(current_view):
+        for camera in list_dir(current_view):
             camera_base = camera.replace('.mp4', '')
             video_with_bbox_results[os.path.join(current_view, camera)] = dict(start_time=start_time, end_time=end_time, ped_bboxes=dict(), veh_bboxes=dict(), phase_number=dict())
             pedestrian_bbox_anno_path = os.path.join(bbox_path, 'pedestrian', args.split, item, f'{view}_view', f'{camera_base}_bbox.json')
     
-            if os.path.exists(pedestrian_bbox_anno_path):
-                pedestrian_bbox = json.load(open(pedestrian_bbox_anno_path))['annotations']
+            if path_exists(pedestrian_bbox_anno_path):
+                pedestrian_bbox = load_json(pedestrian_bbox_anno_path)['annotations']
                 for bbox in pedestrian_bbox:
                     video_with_bbox_results[os.path.join(current_view, camera)]['ped_bboxes'][bbox['image_id']] = bbox['bbox']
                     video_with_bbox_results[os.path.join(current_view, camera)]['phase_number'][bbox['image_id']] = bbox['phase_number']
                 
             vehicle_bbox_anno_path = os.path.join(bbox_path, 'vehicle', args.split, item, f'{view}_view', f'{camera_base}_bbox.json')
-            if os.path.exists(vehicle_bbox_anno_path):
-                vehicle_bbox = json.load(open(vehicle_bbox_anno_path))['annotations']
+            if path_exists(vehicle_bbox_anno_path):
+                vehicle_bbox = load_json(vehicle_bbox_anno_path)['annotations']
                 for bbox in vehicle_bbox:
                     video_with_bbox_results[os.path.join(current_view, camera)]['veh_bboxes'][bbox['image_id']] = bbox['bbox']
                     video_with_bbox_results[os.path.join(current_view, camera)]['phase_number'][bbox['image_id']] = bbox['phase_number']
 
 
-for item in tqdm(os.listdir(os.path.join(video_path, 'normal_trimmed'))):
+for item in tqdm(list_dir(os.path.join(video_path, 'normal_trimmed'))):
     ori_time = item
     item = f'normal_trimmed/{item}'
     for view in ['overhead', 'vehicle']:
@@ -72,9 +76,9 @@ for item in tqdm(os.listdir(os.path.join(video_path, 'normal_trimmed'))):
 
         # vehicle bbox extraction
         if view == 'overhead':
-            assert os.path.exists(caption_anno_path), caption_anno_path
+            assert path_exists(caption_anno_path), caption_anno_path
         try:
-            vehicle_annotation = json.load(open(caption_anno_path))['event_phase']
+            vehicle_annotation = load_json(caption_anno_path)['event_phase']
         except:
             continue
         start_time, end_time = None, None
@@ -88,24 +92,26 @@ for item in tqdm(os.listdir(os.path.join(video_path, 'normal_trimmed'))):
             else:
                 end_time = max(float(phase['end_time']), end_time)
         
-        for camera in os.listdir(current_view):
+        for camera in list_dir(current_view):
             camera_base = camera.replace('.mp4', '')
             video_with_bbox_results[os.path.join(current_view, camera)] = dict(start_time=start_time, end_time=end_time, ped_bboxes=dict(), veh_bboxes=dict(), phase_number=dict())
             pedestrian_bbox_anno_path = os.path.join(bbox_path, 'pedestrian', args.split, item, f'{view}_view', f'{camera_base}_bbox.json')
     
-            if os.path.exists(pedestrian_bbox_anno_path):
-                pedestrian_bbox = json.load(open(pedestrian_bbox_anno_path))['annotations']
+            if path_exists(pedestrian_bbox_anno_path):
+                pedestrian_bbox = load_json(pedestrian_bbox_anno_path)['annotations']
                 for bbox in pedestrian_bbox:
                     video_with_bbox_results[os.path.join(current_view, camera)]['ped_bboxes'][bbox['image_id']] = bbox['bbox']
                     video_with_bbox_results[os.path.join(current_view, camera)]['phase_number'][bbox['image_id']] = bbox['phase_number']
                 
             vehicle_bbox_anno_path = os.path.join(bbox_path, 'vehicle', args.split, item, f'{view}_view', f'{camera_base}_bbox.json')
-            if os.path.exists(vehicle_bbox_anno_path):
-                vehicle_bbox = json.load(open(vehicle_bbox_anno_path))['annotations']
+            if path_exists(vehicle_bbox_anno_path):
+                vehicle_bbox = load_json(vehicle_bbox_anno_path)['annotations']
                 for bbox in vehicle_bbox:
                     video_with_bbox_results[os.path.join(current_view, camera)]['veh_bboxes'][bbox['image_id']] = bbox['bbox']
                     video_with_bbox_results[os.path.join(current_view, camera)]['phase_number'][bbox['image_id']] = bbox['phase_number']
 
 os.makedirs(args.save_folder, exist_ok=True)
 with open(os.path.join(args.save_folder, f'wts_{args.split}_all_video_with_bbox_anno_first_frame.json'), 'w') as f:
-    f.write(json.dumps(video_with_bbox_results, indent=4))
\ No newline at end of file
+    with metrics.span('write'):
+        f.write(json.dumps(video_with_bbox_results, indent=4))
+metrics.count('videos', len(video_with_bbox_results))
@@ -1,51 +1,89 @@
 import cv2
 import os
+import argparse
 from pathlib import Path
+import metrics
+from frame_pack import PackWriter, PACK_SUFFIX
+from sharding import add_shard_args, resolve_shard, in_shard
 
 # Paths (adjust these)
 VAL_VIDEO_ROOT = Path("/home/rornelas/Desktop/Mi3_Lab/AI_CIY_CHALLENGE/data/videos/val")  # path to validation videos
 OUTPUT_ROOT = Path("/home/rornelas/Desktop/Mi3_Lab/AI_CIY_CHALLENGE/data/bbox_global/val")  # where to save extracted frames
 
-def extract_frames_from_video(video_path, output_folder, frame_interval=500):
+def extract_frames_from_video(video_path, output_folder, frame_interval=500, pack=False):
     """
     Extract frames every `frame_interval` frames and save to output_folder.
     frame_interval=30 means approx 1 frame per second if video fps is ~30.
+    With pack=True the frames go to `<output_folder>.pack` instead (see frame_pack.py).
     """
     cap = cv2.VideoCapture(str(video_path))
     if not cap.isOpened():
         print(f"Failed to open video {video_path}")
         return
     
-    output_folder.mkdir(parents=True, exist_ok=True)
+    writer = PackWriter(str(output_folder) + PACK_SUFFIX) if pack else None
+    if writer is None:
+        output_folder.mkdir(parents=True, exist_ok=True)
     
     frame_count = 0
     saved_count = 0
     while True:
-        ret, frame = cap.read()
+        with metrics.span('decode'):
+            ret, frame = cap.read()
         if not ret:
             break
         
         if frame_count % frame_interval == 0:
             # Save frame as jpg
             frame_filename = output_folder / f"{saved_count:05d}.jpg"
-            cv2.imwrite(str(frame_filename), frame)
+            with metrics.span('encode'):
+                ok, buf = cv2.imencode('.jpg', frame)
+            if not ok:
+                raise ValueError(f"could not encode frame {frame_count} of {video_path} as JPEG")
+            with metrics.span('write'):
+                if writer is not None:
+                    writer.add_file(str(frame_filename), buf, height=frame.shape[0], width=frame.shape[1])
+                else:
+                    frame_filename.write_bytes(buf.tobytes())
+            metrics.count('bytes_written', len(buf))
             saved_count += 1
         
         frame_count += 1
     
     cap.release()
+    if writer is not None:
+        writer.close()
+    metrics.count('frames_decoded', frame_count)
+    metrics.count('images_written', saved_count)
     print(f"Extracted {saved_count} frames from {video_path}")
 
+def scenario_of(relative_path):
+    parts = relative_path.parts
+    return parts[1] if parts[0] == "normal_trimmed" and len(parts) > 1 else parts[0]
+
 def main():
-    for root, dirs, files in os.walk(VAL_VIDEO_ROOT):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--video-root', type=Path, default=VAL_VIDEO_ROOT)
+    parser.add_argument('--output-root', type=Path, default=OUTPUT_ROOT)
+    parser.add_argument('--pack', action='store_true', help='write one .pack container per video')
+    add_shard_args(parser)
+    args = parser.parse_args()
+    # one frame folder per video, shards write disjoint files: nothing to gather
+    num_shards, shard_index = resolve_shard(args)
+
+    metrics.init('extract_val')
+    for root, dirs, files in os.walk(args.video_root):
         for file in files:
             if file.endswith(".mp4"):
                 video_path = Path(root) / file
                 # Build output path mirroring the video folder structure
-                relative_path = video_path.relative_to(VAL_VIDEO_ROOT)
-                output_folder = OUTPUT_ROOT / relative_path.parent / relative_path.stem
+                relative_path = video_path.relative_to(args.video_root)
+                if not in_shard(scenario_of(relative_path), num_shards, shard_index):
+                    continue
+                output_folder = args.output_root / relative_path.parent / relative_path.stem
                 print(f"Processing video: {video_path}")
-                extract_frames_from_video(video_path, output_folder, frame_interval=150)
+                metrics.count('videos')
+                extract_frames_from_video(video_path, output_folder, frame_interval=150, pack=args.pack)
 
 if __name__ == "__main__":
     main()
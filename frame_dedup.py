@@ -0,0 +1,242 @@
+import os
+import json
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+from tqdm import tqdm
+
+import metrics
+from frame_pack import FrameResolver
+from token_budget import smart_resize, image_tokens
+
+# Perceptual-hash frame selection for multi-frame samples.
+#
+# Static overhead cameras give long runs of near-identical frames, and every
+# frame costs hundreds of visual tokens. select_frames() hashes the candidate
+# frames (64-bit DCT or average hash), visits them in a temporally spread
+# order (first, last, middle, quarters, ...) and keeps a frame only if it is
+# less than `threshold` similar to every frame kept so far, until the budget
+# is full. Kept frames are returned in their original order.
+#
+# Hashes are cached per image in a JSON file keyed by the image path and its
+# size/mtime (or pack member location), so re-running only hashes new frames.
+#
+#   python frame_dedup.py vqa_spaceom_val_multiframe.json --root data/bbox_global/val
+#
+# rewrites the image lists of an existing sample file and reports the token savings.
+
+HASH_SIZE = 8               # 8x8 = 64-bit hashes
+DCT_SIZE = 32               # the DCT hash keeps the low 8x8 frequencies of a 32x32 thumbnail
+THRESHOLD = 0.9             # drop a frame at >= 90% matching hash bits with a kept frame
+CACHE_PATH = 'processed_anno/frame_hashes.json'
+
+
+def _dct_matrix(n):
+    k = np.arange(n)[:, None]
+    i = np.arange(n)[None, :]
+    m = np.cos(np.pi * (2 * i + 1) * k / (2 * n)) * np.sqrt(2.0 / n)
+    m[0] /= np.sqrt(2.0)
+    return m
+
+
+_DCT = _dct_matrix(DCT_SIZE)
+
+
+def average_hash(gray):
+    small = cv2.resize(gray, (HASH_SIZE, HASH_SIZE), interpolation=cv2.INTER_AREA).astype(np.float32)
+    return (small > small.mean()).ravel()
+
+
+def dct_hash(gray):
+    small = cv2.resize(gray, (DCT_SIZE, DCT_SIZE), interpolation=cv2.INTER_AREA).astype(np.float64)
+    low = (_DCT @ small @ _DCT.T)[:HASH_SIZE, :HASH_SIZE].ravel()
+    # median without the DC term, which only tracks overall brightness
+    return low > np.median(low[1:])
+
+
+HASHES = dict(dct=dct_hash, average=average_hash)
+
+
+def pack_bits(bits):
+    return int(np.packbits(bits.astype(np.uint8)).tobytes().hex(), 16)
+
+
+def similarity(a, b):
+    """Fraction of matching bits between two 64-bit hashes."""
+    return 1.0 - bin(a ^ b).count('1') / (HASH_SIZE * HASH_SIZE)
+
+
+def visual_tokens(height, width):
+    """Visual tokens Qwen2.5-VL spends on an image at native resolution."""
+    return image_tokens(*smart_resize(height, width))
+
+
+class HashCache:
+    """Per-image {hash, height, width}, invalidated when the file (or pack member) changes."""
+
+    def __init__(self, resolver, path=CACHE_PATH, method='dct'):
+        self.resolver = resolver
+        self.path = path
+        self.method = method
+        self.entries = dict()
+        self.dirty = False
+        if path and os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f).get(method, dict())
+
+    def _key(self, image):
+        return Path(image).as_posix()
+
+    def get(self, image):
+        key = self._key(image)
+        signature = self.resolver.signature(image)
+        entry = self.entries.get(key)
+        if entry is not None and entry['signature'] == signature:
+            metrics.count('hash_cache_hits')
+            return entry
+        metrics.count('hash_cache_misses')
+        with metrics.span('hash'):
+            data = np.frombuffer(self.resolver.read_bytes(image), dtype=np.uint8)
+            gray = cv2.imdecode(data, cv2.IMREAD_GRAYSCALE)
+            entry = dict(signature=signature, hash=f'{pack_bits(HASHES[self.method](gray)):016x}',
+                         height=int(gray.shape[0]), width=int(gray.shape[1]))
+        self.entries[key] = entry
+        self.dirty = True
+        return entry
+
+    def hash(self, image):
+        return int(self.get(image)['hash'], 16)
+
+    def tokens(self, image):
+        entry = self.get(image)
+        return visual_tokens(entry['height'], entry['width'])
+
+    def save(self):
+        if not self.path or not self.dirty:
+            return
+        data = dict()
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                data = json.load(f)
+        data[self.method] = self.entries
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def spread_order(n):
+    """0, n-1, then midpoints of the widest gaps: a coarse-to-fine walk over n frames."""
+    if n <= 2:
+        return list(range(n))
+    order, seen = [0, n - 1], {0, n - 1}
+    gaps = [(0, n - 1)]
+    while gaps:
+        next_gaps = []
+        for lo, hi in gaps:
+            mid = (lo + hi) // 2
+            if mid not in seen:
+                seen.add(mid)
+                order.append(mid)
+            if mid - lo > 1:
+                next_gaps.append((lo, mid))
+            if hi - mid > 1:
+                next_gaps.append((mid, hi))
+        gaps = next_gaps
+    return order
+
+
+def select_frames(images, cache, max_frames, threshold=THRESHOLD):
+    """Up to `max_frames` mutually distinct images from `images`, temporally spread, original order kept."""
+    if not images:
+        return []
+    kept = []
+    for i in spread_order(len(images)):
+        h = cache.hash(images[i])
+        if all(similarity(h, cache.hash(images[j])) < threshold for j in kept):
+            kept.append(i)
+            if len(kept) == max_frames:
+                break
+    return [images[i] for i in sorted(kept)]
+
+
+class DedupStats:
+    def __init__(self):
+        self.samples = 0
+        self.frames_before = self.frames_after = 0
+        self.tokens_before = self.tokens_after = 0
+
+    def add(self, cache, before, after, weight=1):
+        """`weight` samples share the frame lists `before` (baseline) and `after` (selected)."""
+        self.samples += weight
+        self.frames_before += weight * len(before)
+        self.frames_after += weight * len(after)
+        self.tokens_before += weight * sum(cache.tokens(p) for p in before)
+        self.tokens_after += weight * sum(cache.tokens(p) for p in after)
+        metrics.count('frames_dropped', weight * (len(before) - len(after)))
+
+    def summary(self, name):
+        saved = self.tokens_before - self.tokens_after
+        pct = 100.0 * saved / self.tokens_before if self.tokens_before else 0.0
+        return (f'{name}: {self.samples} samples, frames {self.frames_before} -> {self.frames_after}, '
+                f'visual tokens {self.tokens_before} -> {self.tokens_after} ({saved} saved, {pct:.1f}%)')
+
+    def as_dict(self):
+        return dict(samples=self.samples, frames_before=self.frames_before, frames_after=self.frames_after,
+                    tokens_before=self.tokens_before, tokens_after=self.tokens_after)
+
+
+def dedup_sample(sample, cache, max_frames, threshold, stats):
+    """Re-select the images of one multi-frame sample in place."""
+    for conv in sample['conversations']:
+        if conv['role'] != 'user' or not isinstance(conv['content'], list):
+            continue
+        images = [c['image'] for c in conv['content'] if c['type'] == 'image']
+        if len(images) < 2:
+            continue
+        keep = set(select_frames(images, cache, max_frames, threshold))
+        stats.add(cache, images, [p for p in images if p in keep])
+        conv['content'] = [c for c in conv['content'] if c['type'] != 'image' or c['image'] in keep]
+        if sample.get('image') not in keep:
+            sample['image'] = next(p for p in images if p in keep)
+    return sample
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop near-duplicate frames from multi-frame sample files.')
+    parser.add_argument('inputs', nargs='+', help='sample .json files (lists of conversations)')
+    parser.add_argument('--root', type=str, required=True, help='directory the image paths are relative to')
+    parser.add_argument('--packed', action='store_true', help='also read frames from .pack containers')
+    parser.add_argument('--max-frames', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=THRESHOLD)
+    parser.add_argument('--method', choices=sorted(HASHES), default='dct')
+    parser.add_argument('--cache', type=str, default=CACHE_PATH)
+    parser.add_argument('--suffix', type=str, default='.dedup', help='output is <input stem><suffix>.json')
+    args = parser.parse_args()
+
+    metrics.init('frame_dedup')
+    cache = HashCache(FrameResolver(args.root, packed=args.packed), args.cache, args.method)
+    report = dict()
+    for path in args.inputs:
+        with open(path) as f:
+            samples = json.load(f)
+        stats = DedupStats()
+        for sample in tqdm(samples, desc=path):
+            dedup_sample(sample, cache, args.max_frames, args.threshold, stats)
+        root, ext = os.path.splitext(path)
+        with open(f'{root}{args.suffix}{ext}', 'w') as f:
+            json.dump(samples, f, indent=2)
+        print(stats.summary(path))
+        report[path] = stats.as_dict()
+        cache.save()
+
+    with open(os.path.splitext(args.inputs[0])[0] + args.suffix + '.report.json', 'w') as f:
+        json.dump(dict(method=args.method, threshold=args.threshold, datasets=report), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
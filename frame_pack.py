@@ -0,0 +1,237 @@
+import io
+import os
+import json
+import mmap
+import struct
+from pathlib import Path
+
+import metrics
+
+# Packed frame containers: one `.pack` file per video instead of one JPEG
+# per frame. Layout:
+#
+#   [jpeg bytes][jpeg bytes]...[index json][u64 index offset][b'AICPACK1']
+#
+# The index maps member names to {offset, length, ...metadata}. Member names
+# are relative to the directory holding the pack, so
+#   bbox_global/train/<sid>/overhead_view/<camera>.pack
+# with member `<camera>/3_action.jpg` serves the virtual path
+#   bbox_global/train/<sid>/overhead_view/<camera>/3_action.jpg
+# and the relative image paths stored in our JSON files keep working through
+# FrameResolver.
+
+PACK_SUFFIX = '.pack'
+MAGIC = b'AICPACK1'
+FOOTER = struct.Struct('<Q')
+
+
+def pack_path_for(video_key, root):
+    """Pack that holds the frames extracted from `video_key` (a data/videos/... path) under `root`."""
+    return video_key.replace('/videos', f'/{root}').replace('.mp4', PACK_SUFFIX)
+
+
+class PackWriter:
+    def __init__(self, path):
+        self.path = str(path)
+        self.base = os.path.dirname(self.path)
+        self.members = dict()
+        self._tmp = self.path + '.tmp'
+        self._f = None
+        self._offset = 0
+
+    def add(self, name, data, **meta):
+        if self._f is None:
+            os.makedirs(self.base or '.', exist_ok=True)
+            self._f = open(self._tmp, 'wb')
+        data = bytes(data)
+        self._f.write(data)
+        # a repeated name points at the newest bytes, like overwriting a file
+        self.members[name] = dict(offset=self._offset, length=len(data), **meta)
+        self._offset += len(data)
+
+    def add_file(self, file_name, data, **meta):
+        """Add under the name `file_name` would have relative to the pack directory."""
+        name = os.path.relpath(file_name, self.base or '.').replace(os.sep, '/')
+        self.add(name, data, **meta)
+
+    def close(self):
+        if self._f is None:
+            return
+        index = json.dumps(dict(version=1, members=self.members)).encode('utf-8')
+        self._f.write(index)
+        self._f.write(FOOTER.pack(self._offset))
+        self._f.write(MAGIC)
+        self._f.close()
+        self._f = None
+        os.replace(self._tmp, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+
+def read_index(path):
+    """Member index of a pack, read from its footer without touching the frame data."""
+    if os.path.getsize(path) < FOOTER.size + len(MAGIC):
+        raise ValueError(f'{path} is not a frame pack')
+    with open(path, 'rb') as f:
+        f.seek(-(FOOTER.size + len(MAGIC)), os.SEEK_END)
+        tail = f.read()
+        if tail[FOOTER.size:] != MAGIC:
+            raise ValueError(f'{path} is not a frame pack')
+        (index_offset,) = FOOTER.unpack(tail[:FOOTER.size])
+        f.seek(index_offset)
+        raw = f.read(os.path.getsize(path) - index_offset - FOOTER.size - len(MAGIC))
+    return json.loads(raw)['members']
+
+
+class PackReader:
+    """mmap-backed reader; the mapping is opened lazily so readers can be created before fork."""
+
+    def __init__(self, path, members=None):
+        self.path = str(path)
+        self.members = members if members is not None else read_index(self.path)
+        self._mm = None
+
+    def _map(self):
+        if self._mm is None:
+            with open(self.path, 'rb') as f:
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mm
+
+    def names(self):
+        return list(self.members)
+
+    def read(self, name):
+        entry = self.members[name]
+        metrics.count('pack_bytes_read', entry['length'])
+        return memoryview(self._map())[entry['offset']:entry['offset'] + entry['length']]
+
+    def close(self):
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+
+
+class FrameResolver:
+    """
+    Resolves image paths relative to `root` (e.g. data/bbox_global/val) to loose
+    files or, with `packed=True`, to members of the `.pack` files under root.
+    Loose files win when both exist.
+    """
+
+    def __init__(self, root, packed=False):
+        self.root = Path(root)
+        self.packed = packed
+        self._members = None      # virtual dir (posix, relative to root) -> {file name: (pack path, member)}
+        self._dirs = None         # every virtual dir that holds packed frames, plus its parents
+        self._readers = dict()
+
+    def _relative(self, path):
+        path = Path(path)
+        if path.is_absolute() or str(path).startswith(str(self.root)):
+            try:
+                return path.relative_to(self.root)
+            except ValueError:
+                return path.resolve().relative_to(self.root.resolve())
+        return path
+
+    def _catalog(self):
+        if self._members is None:
+            self._members, self._dirs = dict(), set()
+            with metrics.span('dir_scan'):
+                for dirpath, _, files in os.walk(self.root):
+                    for f in files:
+                        if not f.endswith(PACK_SUFFIX):
+                            continue
+                        pack = os.path.join(dirpath, f)
+                        for member in read_index(pack):
+                            virtual = (Path(dirpath) / member).relative_to(self.root)
+                            self._members.setdefault(virtual.parent.as_posix(), dict())[virtual.name] = (pack, member)
+                            self._dirs.update(p.as_posix() for p in virtual.parents)
+        return self._members
+
+    def _reader(self, pack):
+        if pack not in self._readers:
+            self._readers[pack] = PackReader(pack)
+        return self._readers[pack]
+
+    def _lookup(self, path):
+        rel = self._relative(path)
+        return self._catalog().get(rel.parent.as_posix(), dict()).get(rel.name)
+
+    def exists(self, path):
+        if (self.root / self._relative(path)).is_file():
+            return True
+        return self.packed and self._lookup(path) is not None
+
+    def isdir(self, path):
+        if (self.root / self._relative(path)).is_dir():
+            return True
+        if not self.packed:
+            return False
+        self._catalog()
+        return self._relative(path).as_posix() in self._dirs
+
+    def listdir(self, path):
+        """File names in a (possibly virtual) directory, loose and packed, sorted."""
+        rel = self._relative(path)
+        folder = self.root / rel
+        names = set()
+        if folder.is_dir():
+            names.update(p.name for p in folder.iterdir() if p.is_file())
+        if self.packed:
+            names.update(self._catalog().get(rel.as_posix(), dict()))
+        return sorted(names)
+
+    def subdirs(self, path):
+        rel = self._relative(path)
+        folder = self.root / rel
+        names = set()
+        if folder.is_dir():
+            names.update(p.name for p in folder.iterdir() if p.is_dir())
+        if self.packed:
+            self._catalog()
+            prefix = '' if rel.as_posix() == '.' else rel.as_posix() + '/'
+            names.update(d[len(prefix):] for d in self._dirs
+                         if d.startswith(prefix) and d != rel.as_posix() and '/' not in d[len(prefix):])
+        return sorted(names)
+
+    def signature(self, path):
+        """[size, mtime_ns] of a loose file, or [pack mtime_ns, offset, length] of a packed member; for caches."""
+        full = self.root / self._relative(path)
+        if full.is_file() or not self.packed:
+            st = full.stat()
+            return [st.st_size, st.st_mtime_ns]
+        hit = self._lookup(path)
+        if hit is None:
+            raise FileNotFoundError(full)
+        pack, member = hit
+        entry = self._reader(pack).members[member]
+        return [os.stat(pack).st_mtime_ns, entry['offset'], entry['length']]
+
+    def read_bytes(self, path):
+        full = self.root / self._relative(path)
+        if full.is_file() or not self.packed:
+            return full.read_bytes()
+        hit = self._lookup(path)
+        if hit is None:
+            raise FileNotFoundError(full)
+        pack, member = hit
+        return self._reader(pack).read(member)
+
+    def open_image(self, path):
+        """PIL RGB image."""
+        from PIL import Image
+        with metrics.span('decode'):
+            return Image.open(io.BytesIO(self.read_bytes(path))).convert('RGB')
+
+    def imread(self, path):
+        """BGR numpy image, like cv2.imread."""
+        import cv2
+        import numpy as np
+        with metrics.span('decode'):
+            return cv2.imdecode(np.frombuffer(self.read_bytes(path), dtype=np.uint8), cv2.IMREAD_COLOR)
@@ -0,0 +1,195 @@
+import torch
+from transformers import LogitsProcessor, LogitsProcessorList, StoppingCriteria, StoppingCriteriaList
+
+import metrics
+
+# Tag-aware generation for the <think>…</think><answer>…</answer> format our
+# system prompts ask for (space_om_format.py, spaceom_infer.py).
+#
+#   AnswerStop    ends a row once it has written </answer> (or reached its own
+#                 new-token limit); rows stop independently in a batch
+#   ThinkBudget   after `think_budget` tokens inside an open <think> block,
+#                 forces "</think>\n<answer>" so the row has to answer; rows
+#                 that never open <think>, or already answer, are left alone
+#   NO_THINK      prefill that skips reasoning altogether (short VQA answers)
+#
+# generate_tagged() wires these into model.generate() and returns the texts
+# plus a per-row report (tokens generated / saved, forced answers). Finished
+# rows only receive padding, so a batch stops as soon as every row is done.
+
+ANSWER_OPEN = "<answer>"
+ANSWER_CLOSE = "</answer>"
+THINK_OPEN = "<think>"
+THINK_CLOSE = "</think>"
+FORCED_ANSWER = "</think>\n<answer>"
+NO_THINK = "<think>\n</think>\n<answer>"
+TAIL_TOKENS = 8                 # decoded per step to spot closing tags split over several tokens
+
+
+def _tails(tokenizer, input_ids, start=0, n=TAIL_TOKENS):
+    """Last `n` tokens of every row (from column `start` on), decoded."""
+    return tokenizer.batch_decode(input_ids[:, max(start, input_ids.shape[1] - n):], skip_special_tokens=False)
+
+
+class AnswerStop(StoppingCriteria):
+    """Per-row stop at </answer> and/or after `limits[i]` new tokens."""
+
+    def __init__(self, tokenizer, prompt_len, limits=None, stop_at_answer=True):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.limits = limits
+        self.stop_at_answer = stop_at_answer
+        self.answered = None
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = torch.zeros(input_ids.shape[0], dtype=torch.bool, device=input_ids.device)
+        if self.answered is None:
+            self.answered = [False] * input_ids.shape[0]
+        if self.stop_at_answer:
+            for i, tail in enumerate(_tails(self.tokenizer, input_ids, self.prompt_len)):
+                if ANSWER_CLOSE in tail:
+                    self.answered[i] = True
+                    done[i] = True
+        if self.limits:
+            steps = input_ids.shape[1] - self.prompt_len
+            done |= torch.tensor([steps >= limit for limit in self.limits], device=input_ids.device)
+        return done
+
+
+class ThinkBudget(LogitsProcessor):
+    """
+    Forces FORCED_ANSWER into rows that have thought for `budget` tokens
+    inside an open <think> block. Counting stops for good once a row closes
+    </think>, opens <answer> or ends (an `eos_ids` token). `budget` is one
+    value or one per row (None: unlimited).
+    """
+
+    BEFORE, THINKING, DONE = range(3)
+
+    def __init__(self, tokenizer, prompt_len, budget, limits=None, eos_ids=()):
+        self.tokenizer = tokenizer
+        self.prompt_len = prompt_len
+        self.budget = budget
+        self.limits = limits
+        self.eos_ids = set(eos_ids)
+        self.forced_ids = tokenizer(FORCED_ANSWER, add_special_tokens=False)["input_ids"]
+        self.state = None           # per row: BEFORE <think>, THINKING or DONE
+        self.forcing = None         # position in forced_ids, None when not forcing
+        self.think_tokens = None
+        self.forced = None
+
+    @classmethod
+    def next_state(cls, state, tail):
+        if state != cls.DONE and (THINK_CLOSE in tail or ANSWER_OPEN in tail):
+            return cls.DONE
+        if state == cls.BEFORE and THINK_OPEN in tail:
+            return cls.THINKING
+        return state
+
+    def __call__(self, input_ids, scores):
+        batch = input_ids.shape[0]
+        if self.state is None:
+            # the prompt may end inside a block: a NO_THINK prefill has already opened <answer>
+            self.state = [self.next_state(self.BEFORE, tail) for tail in _tails(self.tokenizer, input_ids)]
+            self.forcing = [None] * batch
+            self.think_tokens = [0] * batch
+            self.forced = [False] * batch
+            if not isinstance(self.budget, (list, tuple)):
+                self.budget = [self.budget] * batch
+            if input_ids.shape[1] == self.prompt_len:
+                return scores
+        tails = _tails(self.tokenizer, input_ids, self.prompt_len)
+        steps = input_ids.shape[1] - self.prompt_len
+        for i in range(batch):
+            if self.budget[i] is None or (self.limits and steps >= self.limits[i]):
+                continue        # unlimited, or the row has already stopped
+            if self.forcing[i] is not None:
+                token = self.forced_ids[self.forcing[i]]
+                scores[i, :] = -float("inf")
+                scores[i, token] = 0.0
+                self.forcing[i] += 1
+                if self.forcing[i] == len(self.forced_ids):
+                    self.forcing[i] = None
+                    self.state[i] = self.DONE
+                continue
+            if int(input_ids[i, -1]) in self.eos_ids:
+                self.state[i] = self.DONE       # finished row, only padding follows
+            self.state[i] = self.next_state(self.state[i], tails[i])
+            if self.state[i] != self.THINKING:
+                continue
+            self.think_tokens[i] += 1
+            if self.think_tokens[i] >= self.budget[i]:
+                self.forced[i] = True
+                self.forcing[i] = 1 if len(self.forced_ids) > 1 else None
+                if self.forcing[i] is None:
+                    self.state[i] = self.DONE
+                scores[i, :] = -float("inf")
+                scores[i, self.forced_ids[0]] = 0.0
+        return scores
+
+
+def with_prefill(prepared, prefill):
+    """prepare() results with `prefill` appended to each prompt (the assistant turn starts with it)."""
+    if not prefill:
+        return prepared
+    return [(text + prefill, images, plan) for text, images, plan in prepared]
+
+
+@torch.no_grad()
+def generate_tagged(model, processor, inputs, max_new_tokens, limits=None, stop_at_answer=True,
+                    think_budget=None, prefill=""):
+    """
+    Greedy generation with per-row early stopping. `prefill` is what the
+    prompts were extended with (with_prefill; one string or one per row) and
+    is put back in front of each text. `think_budget` is one value or one per
+    row. Returns (texts, report), one report dict per row.
+    """
+    tokenizer = processor.tokenizer
+    prompt_len = inputs["input_ids"].shape[1]
+    batch = inputs["input_ids"].shape[0]
+    limits = limits or [max_new_tokens] * batch
+    prefills = prefill if isinstance(prefill, (list, tuple)) else [prefill] * batch
+    stop = AnswerStop(tokenizer, prompt_len, limits, stop_at_answer)
+    processors = LogitsProcessorList()
+    budget = None
+    if think_budget is not None and think_budget != [None] * batch:
+        eos = getattr(model.generation_config, "eos_token_id", None)
+        eos_ids = [t for t in (eos if isinstance(eos, (list, tuple)) else [eos]) + [tokenizer.pad_token_id] if t is not None]
+        budget = ThinkBudget(tokenizer, prompt_len, think_budget, limits, eos_ids)
+        processors.append(budget)
+
+    with metrics.span("generate"):
+        out = model.generate(**inputs, max_new_tokens=max(limits), do_sample=False,
+                             stopping_criteria=StoppingCriteriaList([stop]), logits_processor=processors)
+    new_tokens = out[:, prompt_len:]
+
+    texts, report = [], []
+    for i, row in enumerate(new_tokens):
+        row = row[:limits[i]]
+        generated = int((row != tokenizer.pad_token_id).sum())
+        texts.append(prefills[i] + tokenizer.decode(row, skip_special_tokens=True))
+        report.append(dict(
+            generated=generated,
+            saved=limits[i] - generated,
+            answered=bool(stop.answered and stop.answered[i]),
+            think_tokens=budget.think_tokens[i] if budget and budget.think_tokens else None,
+            forced_answer=bool(budget and budget.forced and budget.forced[i]),
+        ))
+    metrics.count("generated_tokens", sum(r["generated"] for r in report))
+    metrics.count("tokens_saved", sum(r["saved"] for r in report))
+    metrics.count("forced_answers", sum(r["forced_answer"] for r in report))
+    return texts, report
+
+
+def summarize(report):
+    """One-line totals over generate_tagged() reports."""
+    n = len(report)
+    if not n:
+        return "no generations"
+    generated = sum(r["generated"] for r in report)
+    saved = sum(r["saved"] for r in report)
+    answered = sum(r["answered"] for r in report)
+    forced = sum(r["forced_answer"] for r in report)
+    return (f"{n} generations: {generated} tokens generated, {saved} saved "
+            f"({saved / max(generated + saved, 1):.1%} of the budget), "
+            f"{answered} stopped at {ANSWER_CLOSE}, {forced} forced to answer")
@@ -1,23 +1,40 @@
 import os, json, csv, glob
+from pathlib import Path
 from tqdm import tqdm 
 from collections import defaultdict
 import argparse
+import metrics
+from metrics import load_json, path_exists
+from bbox_geometry import area
+from sharding import add_shard_args, resolve_shard, in_shard, shard_output_path, gather_json
 
-def get_best_view_wts(ann_path, bbox_path, scnearios, reference_views):
+
+def view_score(bbox):
+    """Mean pedestrian bbox area of a view; larger means the pedestrian is seen closer."""
+    return area([box['bbox'] for box in bbox["annotations"]]).sum()/len(bbox["annotations"])
+
+
+def get_best_view_wts(ann_path, bbox_path, scnearios, reference_views, rankings=None):
+    """
+    {scenario: best video}. If `rankings` is given it is filled with
+    {scenario: [videos, best score first]} (unscored cameras last).
+    """
     best_view_video = {}
     for scneario in tqdm(scnearios):
         if '.DS_Store' in scneario: 
             continue
         if '_normal_' in scneario:
-            if os.path.exists(os.path.join(bbox_path, f'normal_trimmed/{scneario}/overhead_view')) or not os.path.exists(os.path.join(bbox_path, f'normal_trimmed/{scneario}/vehicle_view')):
+            if path_exists(os.path.join(bbox_path, f'normal_trimmed/{scneario}/overhead_view')) or not path_exists(os.path.join(bbox_path, f'normal_trimmed/{scneario}/vehicle_view')):
                 best_view_video[scneario] = scneario + '.mp4'
             else:
                 best_view_video[scneario] = scneario +'_vehicle_view.mp4'
+            if rankings is not None:
+                rankings[scneario] = [best_view_video[scneario]]
         else:
             if scneario == '20231006_18_CN29_T1':
                 print('f')
             try:
-                overhead_view_json = json.load(open(glob.glob(os.path.join(ann_path, f'{scneario}/overhead_view/*.json'))[0]))
+                overhead_view_json = load_json(glob.glob(os.path.join(ann_path, f'{scneario}/overhead_view/*.json'))[0])
             except:
                 overhead_view_json = None
 
@@ -31,25 +48,27 @@ def get_best_view_wts(ann_path, bbox_path, scnearios, reference_views):
                     views.append(overhand)
             best_view_score = 0
             best_view = None
+            scores = {}
             for view in views:
-                if os.path.exists(os.path.join(bbox_path, f"{scneario}/overhead_view/{view.replace('.mp4', '')}_bbox.json")):
-                     bbox = json.load(open(os.path.join(bbox_path, f"{scneario}/overhead_view/{view.replace('.mp4', '')}_bbox.json")))
-                elif os.path.exists(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json")):
-                    bbox = json.load(open(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json")))
+                if path_exists(os.path.join(bbox_path, f"{scneario}/overhead_view/{view.replace('.mp4', '')}_bbox.json")):
+                     bbox = load_json(os.path.join(bbox_path, f"{scneario}/overhead_view/{view.replace('.mp4', '')}_bbox.json"))
+                elif path_exists(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json")):
+                    bbox = load_json(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json"))
                 else:
                     print(f'no bbox: {scneario}')
                     continue
+                scores[view] = view_score(bbox)
 
                 if len(bbox["annotations"]) == 5:
-                    avg_human_area = sum([box['bbox'][2]*box['bbox'][3] for box in bbox["annotations"]])/5.
+                    avg_human_area = area([box['bbox'] for box in bbox["annotations"]]).sum()/5.
                     if avg_human_area > best_view_score:
                         best_view_score = avg_human_area
                         best_view = view
                     
-                if best_view == None and os.path.exists(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json")):
+                if best_view == None and path_exists(os.path.join(bbox_path, f"{scneario}/vehicle_view/{scneario}_vehicle_view_bbox.json")):
                     best_view = scneario +'_vehicle_view.mp4'
                 else:
-                    avg_human_area = sum([box['bbox'][2]*box['bbox'][3] for box in bbox["annotations"]])/len(bbox["annotations"])
+                    avg_human_area = area([box['bbox'] for box in bbox["annotations"]]).sum()/len(bbox["annotations"])
                     if avg_human_area > best_view_score:
                         best_view_score = avg_human_area
                         best_view = view    
@@ -57,23 +76,86 @@ def get_best_view_wts(ann_path, bbox_path, scnearios, reference_views):
             # We found that the bounding boxes of 20230728_13_CN21_T1_Camera2_5.mp4 and 20230728_13_CN21_T2_Camera2_5 is incorrect
             if scneario == '20230728_13_CN21_T1' or scneario == '20230728_13_CN21_T2':
                 best_view=scneario +'_vehicle_view.mp4'
+                scores.pop(scneario + '_Camera2_5.mp4', None)
 
             best_view_video[scneario] = best_view
+            if rankings is not None:
+                # sorted() is stable: ties and unscored cameras keep the annotation order
+                rankings[scneario] = sorted(views, key=lambda v: -scores.get(v, -1))
 
     return best_view_video
 
 
+def load_view_ranking(path):
+    """
+    {scenario: [camera stems, best first]} from a ranking file, or from a
+    best-view map ({scenario: video}), which ranks just that one camera.
+    """
+    with open(path) as f:
+        data = json.load(f)
+    return {sid: [Path(v).stem for v in ([views] if isinstance(views, str) else views or [])]
+            for sid, views in data.items()}
+
+
+def top_views(ranking, sid, stems, k):
+    """
+    The `k` best of `stems` (camera folder / video stems) for scenario `sid`,
+    ranked cameras first. Without a ranking for `sid`, or when none of `stems`
+    is ranked (e.g. a map of another split), every stem is kept in order.
+    """
+    if not ranking or not k:
+        return list(stems)
+    ranked = [v for v in ranking.get(sid, []) if v in stems]
+    if not ranked:
+        return list(stems)
+    return (ranked + [v for v in stems if v not in ranked])[:k]
+
+
+def prune_sample_views(sample, ranking, k):
+    """
+    Copy of a multi-camera VQA sample keeping only images of its top-`k`
+    cameras (the image's parent folder is its camera). Samples with a single
+    camera, or whose cameras are all unranked, are returned unchanged.
+    """
+    user = next(c for c in sample["conversations"] if c["role"] == "user")
+    images = [c for c in user["content"] if c["type"] == "image"]
+    cameras = list(dict.fromkeys(Path(c["image"]).parent.name for c in images))
+    keep = set(top_views(ranking, sample["id"], cameras, k))
+    if len(cameras) <= 1 or len(keep) == len(cameras):
+        return sample
+    content = [c for c in user["content"] if c["type"] != "image" or Path(c["image"]).parent.name in keep]
+    metrics.count('images_pruned', len(user["content"]) - len(content))
+    conversations = [dict(c, content=content) if c is user else c for c in sample["conversations"]]
+    return dict(sample, conversations=conversations)
+
+
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--test-root', type=str, default='./data/test_part')
     parser.add_argument('--save-path', type=str, default='./processed_anno/best_view_for_test.json')
+    parser.add_argument('--split', type=str, default='train', help='annotation split to rank (train / val)')
+    parser.add_argument('--ranking-path', type=str, default=None,
+                        help='also write {scenario: [cameras, best first]} here (vqa_space_om.py / spaceom_infer.py --views-map)')
+    add_shard_args(parser)
     args = parser.parse_args()
-    wts_ann_path = 'data/annotations/caption/train'
-    wts_bbox_path = 'data/annotations/bbox_annotated/pedestrian/train'
-    bdd_video_path = 'data/external/BDD_PC_5K/videos/train'
+    num_shards, shard_index = resolve_shard(args)
+
+    if args.gather:
+        for path in filter(None, [args.save_path, args.ranking_path]):
+            merged = gather_json(path, num_shards)
+            with open(path, 'w') as f:
+                f.write(json.dumps(merged, indent=2, ensure_ascii=False))
+            print(f'Gathered {len(merged)} scenarios from {num_shards} shards into {path}')
+        raise SystemExit(0)
+
+    metrics.init('get_best_view')
+    wts_ann_path = f'data/annotations/caption/{args.split}'
+    wts_bbox_path = f'data/annotations/bbox_annotated/pedestrian/{args.split}'
+    bdd_video_path = f'data/external/BDD_PC_5K/videos/{args.split}'
     reference_view_path = 'data/view_used_as_main_reference_for_multiview_scenario.csv'
-    save_path = args.save_path
+    save_path = shard_output_path(args.save_path, num_shards, shard_index)
+    rankings = {} if args.ranking_path else None
 
     # get the official recommended perspectives
     with open(reference_view_path, 'r') as file:
@@ -86,20 +168,39 @@ if __name__ == '__main__':
     rest_videos = defaultdict(list)
 
     # get the best bdd views 
-    scnearios1 = os.listdir(wts_ann_path) 
-    scnearios1.remove('normal_trimmed')
-    best_view_wts1 = get_best_view_wts(wts_ann_path, wts_bbox_path, scnearios1, reference_views)
+    with metrics.span('dir_scan'):
+        scnearios1 = os.listdir(wts_ann_path)
+    if 'normal_trimmed' in scnearios1:
+        scnearios1.remove('normal_trimmed')
+    scnearios1 = [s for s in scnearios1 if in_shard(s, num_shards, shard_index)]
+    best_view_wts1 = get_best_view_wts(wts_ann_path, wts_bbox_path, scnearios1, reference_views, rankings)
     rest_videos.update(best_view_wts1)
 
-    scnearios2 = os.listdir(os.path.join(wts_ann_path, 'normal_trimmed'))
-    best_view_wts2 = get_best_view_wts(wts_ann_path, wts_bbox_path, scnearios2, reference_views)
-    rest_videos.update(best_view_wts2)
+    if path_exists(os.path.join(wts_ann_path, 'normal_trimmed')):
+        with metrics.span('dir_scan'):
+            scnearios2 = os.listdir(os.path.join(wts_ann_path, 'normal_trimmed'))
+        scnearios2 = [s for s in scnearios2 if in_shard(s, num_shards, shard_index)]
+        best_view_wts2 = get_best_view_wts(wts_ann_path, wts_bbox_path, scnearios2, reference_views, rankings)
+        rest_videos.update(best_view_wts2)
 
     # get the best bdd views 
-    for bdd_video in os.listdir(bdd_video_path):
-        rest_videos[bdd_video.split('.')[0]] = bdd_video
+    if path_exists(bdd_video_path):
+        with metrics.span('dir_scan'):
+            bdd_videos = os.listdir(bdd_video_path)
+        for bdd_video in bdd_videos:
+            if not in_shard(bdd_video.split('.')[0], num_shards, shard_index):
+                continue
+            rest_videos[bdd_video.split('.')[0]] = bdd_video
+            if rankings is not None:
+                rankings[bdd_video.split('.')[0]] = [bdd_video]
 
     os.makedirs(os.path.dirname(save_path), exist_ok=True)
     
     with open(save_path, 'w') as f:
-        f.write(json.dumps(rest_videos, indent=2, ensure_ascii=False))      
\ No newline at end of file
+        f.write(json.dumps(rest_videos, indent=2, ensure_ascii=False))
+
+    if rankings is not None:
+        ranking_path = shard_output_path(args.ranking_path, num_shards, shard_index)
+        os.makedirs(os.path.dirname(os.path.abspath(ranking_path)), exist_ok=True)
+        with open(ranking_path, 'w') as f:
+            f.write(json.dumps(rankings, indent=2, ensure_ascii=False))      
\ No newline at end of file
@@ -0,0 +1,367 @@
+import os
+import json
+import time
+import queue
+import argparse
+import threading
+import socketserver
+from pathlib import Path
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+import metrics
+from frame_pack import FrameResolver
+from generation import NO_THINK, generate_tagged
+from get_best_view import load_view_ranking, prune_sample_views
+from spaceom_infer import (MODEL_ID, ADAPTER_DIR, IMAGE_ROOT, MAX_TOKENS, MAX_NEW_TOKENS, SYSTEM_PROMPT,
+                           load_model, load_images, prepare, collate, extract_choice)
+
+# Long-running SpaceOm (+ LoRA) service: the model is loaded once and
+# concurrent requests are batched together.
+#
+#   python inference_server.py --adapter spaceom_lora --port 8765
+#   curl -N localhost:8765/v1/generate -d @request.json
+#
+# A request is one sample in our conversation format (the user turn with
+# image paths relative to --image-root, as written by vqa_space_om.py /
+# space_om_format.py), plus optional "task" ("vqa" or "caption"),
+# "max_new_tokens", "think_budget" and "no_think" (generation.py). POST
+# /v1/batch takes {"requests": [...]}. Rows stop at </answer>.
+#
+# Responses stream as NDJSON: a "queued" event, then "result" (text,
+# choice letter for VQA, timings) as soon as that request's batch finishes;
+# /v1/batch streams results in completion order. GET /metrics reports
+# queue depth, batch sizes, latency percentiles and throughput.
+#
+# Requests are prepared (image decode + token budget) in their handler
+# thread, then a single worker takes everything queued, up to
+# --batch-tokens (prompt + new tokens) and --max-batch, waiting at most
+# --max-wait-ms for the batch to fill. generate() runs whole batches, so new
+# requests join at the next batch rather than mid-decode.
+
+HOST = "127.0.0.1"
+PORT = 8765
+BATCH_TOKENS = 8192
+MAX_BATCH = 8
+MAX_WAIT_MS = 20
+LATENCY_WINDOW = 1000           # recent requests kept for percentiles
+CAPTION_SYSTEM_PROMPT = (
+    "You are VL-Thinking, a helpful assistant with excellent reasoning and descriptive abilities. "
+    "You should first think about the reasoning process and then provide the answer. "
+    "Use <think>...</think> and <answer>...</answer> tags."
+)
+CAPTION_MAX_NEW_TOKENS = 700
+CAPTION_THINK_BUDGET = 400
+
+
+class Request:
+    def __init__(self, payload, text, images, plan, max_new_tokens, think_budget=None, prefill=""):
+        self.payload = payload
+        self.text = text + prefill
+        self.prefill = prefill
+        self.think_budget = think_budget
+        self.images = images
+        self.plan = plan
+        self.max_new_tokens = max_new_tokens
+        self.tokens = plan["total_tokens"] + max_new_tokens
+        self.events = queue.Queue()
+        self.created = time.perf_counter()
+        self.started = None
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.requests = 0
+        self.completed = 0
+        self.failed = 0
+        self.batches = 0
+        self.batched_requests = 0
+        self.prompt_tokens = 0
+        self.generated_tokens = 0
+        self.generate_seconds = 0.0
+        self.queue_wait = deque(maxlen=LATENCY_WINDOW)
+        self.latency = deque(maxlen=LATENCY_WINDOW)
+
+    def record_batch(self, batch, seconds):
+        with self.lock:
+            self.batches += 1
+            self.batched_requests += len(batch)
+            self.prompt_tokens += sum(r.plan["total_tokens"] for r in batch)
+            self.generate_seconds += seconds
+
+    def record_done(self, request, generated=0, ok=True):
+        now = time.perf_counter()
+        with self.lock:
+            if ok:
+                self.completed += 1
+                self.generated_tokens += generated
+                self.queue_wait.append(request.started - request.created)
+                self.latency.append(now - request.created)
+            else:
+                self.failed += 1
+
+    @staticmethod
+    def percentiles(values):
+        if not values:
+            return dict(p50=None, p90=None, p99=None)
+        p = np.percentile(np.asarray(values), [50, 90, 99])
+        return dict(p50=round(float(p[0]), 4), p90=round(float(p[1]), 4), p99=round(float(p[2]), 4))
+
+    def snapshot(self, queue_depth, in_flight):
+        with self.lock:
+            return dict(
+                uptime_s=round(time.time() - self.started, 1),
+                queue_depth=queue_depth,
+                in_flight=in_flight,
+                requests=self.requests,
+                completed=self.completed,
+                failed=self.failed,
+                batches=self.batches,
+                mean_batch_size=round(self.batched_requests / self.batches, 3) if self.batches else None,
+                prompt_tokens_per_s=round(self.prompt_tokens / self.generate_seconds, 1) if self.generate_seconds else None,
+                generated_tokens_per_s=round(self.generated_tokens / self.generate_seconds, 1) if self.generate_seconds else None,
+                queue_wait_s=self.percentiles(list(self.queue_wait)),
+                latency_s=self.percentiles(list(self.latency)),
+            )
+
+
+class Engine:
+    """Model + batching worker thread."""
+
+    def __init__(self, model, processor, resolver, max_tokens=MAX_TOKENS, batch_tokens=BATCH_TOKENS,
+                 max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS, view_ranking=None, top_k_views=None):
+        self.model = model
+        self.processor = processor
+        self.resolver = resolver
+        self.max_tokens = max_tokens
+        self.batch_tokens = batch_tokens
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.view_ranking = view_ranking
+        self.top_k_views = top_k_views
+        self.queue = queue.Queue()
+        self.pending = None             # request taken from the queue that did not fit the last batch
+        self.in_flight = 0
+        self.stats = Stats()
+        self.worker = threading.Thread(target=self._loop, name="batcher", daemon=True)
+        self.worker.start()
+
+    def prepare_request(self, payload):
+        """Validate one payload and decode its images; raises on a bad request, queues nothing."""
+        task = payload.get("task", "vqa")
+        system_prompt = CAPTION_SYSTEM_PROMPT if task == "caption" else SYSTEM_PROMPT
+        default_new = CAPTION_MAX_NEW_TOKENS if task == "caption" else MAX_NEW_TOKENS
+        max_new_tokens = int(payload.get("max_new_tokens", default_new))
+        think_budget = payload.get("think_budget", CAPTION_THINK_BUDGET if task == "caption" else None)
+        prefill = NO_THINK if payload.get("no_think") else ""
+        if self.view_ranking:
+            payload = prune_sample_views(payload, self.view_ranking, payload.get("top_k_views", self.top_k_views))
+        images = load_images(payload, self.resolver)
+        text, images, plan = prepare(self.processor, payload, images, self.max_tokens, system_prompt)
+        return Request(payload, text, images, plan, max_new_tokens,
+                       None if think_budget is None else int(think_budget), prefill)
+
+    def enqueue(self, request):
+        with self.stats.lock:
+            self.stats.requests += 1
+        request.events.put(dict(event="queued", id=request.payload.get("id"), position=self.queue.qsize(),
+                                prompt_tokens=request.plan["total_tokens"]))
+        self.queue.put(request)
+        return request
+
+    def submit(self, payload):
+        return self.enqueue(self.prepare_request(payload))
+
+    def _next_batch(self):
+        first = self.pending or self.queue.get()
+        self.pending = None
+        batch, tokens = [first], first.tokens
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.perf_counter()
+            try:
+                request = self.queue.get(timeout=max(timeout, 0)) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if tokens + request.tokens > self.batch_tokens:
+                self.pending = request
+                break
+            batch.append(request)
+            tokens += request.tokens
+        return batch
+
+    def _loop(self):
+        while True:
+            batch = self._next_batch()
+            self.in_flight = len(batch)
+            start = time.perf_counter()
+            for r in batch:
+                r.started = start
+            try:
+                inputs = collate(self.processor, [(r.text, r.images, r.plan) for r in batch], self.model.device)
+                texts, rows = generate_tagged(self.model, self.processor, inputs, MAX_NEW_TOKENS,
+                                              limits=[r.max_new_tokens for r in batch],
+                                              think_budget=[r.think_budget for r in batch],
+                                              prefill=[r.prefill for r in batch])
+            except Exception as e:
+                for r in batch:
+                    self.stats.record_done(r, ok=False)
+                    r.events.put(dict(event="error", id=r.payload.get("id"), error=repr(e)))
+                    r.events.put(None)
+                continue
+            finally:
+                self.in_flight = 0
+            seconds = time.perf_counter() - start
+            self.stats.record_batch(batch, seconds)
+            metrics.count("batches")
+            metrics.count("batched_requests", len(batch))
+            for r, text, row in zip(batch, texts, rows):
+                self.stats.record_done(r, row["generated"])
+                result = dict(event="result", id=r.payload.get("id"), text=text,
+                              prompt_tokens=r.plan["total_tokens"], generated_tokens=row["generated"],
+                              tokens_saved=row["saved"], forced_answer=row["forced_answer"], batch_size=len(batch),
+                              queue_wait_s=round(r.started - r.created, 4),
+                              latency_s=round(time.perf_counter() - r.created, 4))
+                if r.payload.get("task", "vqa") == "vqa":
+                    result["choice"] = extract_choice(text)
+                r.events.put(result)
+                r.events.put(None)
+
+    def metrics(self):
+        return self.stats.snapshot(self.queue.qsize() + (self.pending is not None), self.in_flight)
+
+
+class Handler(BaseHTTPRequestHandler):
+    engine = None
+
+    def address_string(self):
+        # Unix socket clients have no (host, port)
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+    def _send_json(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+
+    def _emit(self, event):
+        self.wfile.write((json.dumps(event) + "\n").encode("utf-8"))
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path == "/health":
+            self._send_json(200, dict(status="ok"))
+        elif self.path == "/metrics":
+            self._send_json(200, self.engine.metrics())
+        else:
+            self._send_json(404, dict(error="not found"))
+
+    def do_POST(self):
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            body = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError as e:
+            self._send_json(400, dict(error=f"bad request: {e}"))
+            return
+
+        if self.path not in ("/v1/generate", "/v1/batch"):
+            self._send_json(404, dict(error="not found"))
+            return
+
+        # every payload of a batch is validated (and its images decoded) before any is queued
+        try:
+            if not isinstance(body, dict):
+                raise ValueError(f"expected a JSON object, got {type(body).__name__}")
+            payloads = [body] if self.path == "/v1/generate" else body.get("requests", [])
+            if not isinstance(payloads, list) or not all(isinstance(p, dict) for p in payloads):
+                raise ValueError('"requests" must be a list of JSON objects')
+            requests = [self.engine.prepare_request(p) for p in payloads]
+        except Exception as e:         # malformed payload, missing or corrupt image, ...
+            self._send_json(400, dict(error=f"bad request: {e!r}"))
+            return
+        requests = [self.engine.enqueue(r) for r in requests]
+
+        self._start_stream()
+        # merge the event streams of all requests, forwarding events as they arrive
+        merged = queue.Queue()
+
+        def forward(r):
+            while True:
+                event = r.events.get()
+                merged.put(event)
+                if event is None:
+                    return
+
+        for r in requests:
+            threading.Thread(target=forward, args=(r,), daemon=True).start()
+        remaining = len(requests)
+        while remaining:
+            event = merged.get()
+            if event is None:
+                remaining -= 1
+                continue
+            self._emit(event)
+
+    def log_message(self, fmt, *args):
+        pass
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local SpaceOm inference server with request batching.")
+    parser.add_argument("--model", type=str, default=MODEL_ID, help="model id or path (a tiny checkpoint works on CPU)")
+    parser.add_argument("--adapter", type=str, default=ADAPTER_DIR)
+    parser.add_argument("--int8", action="store_true", help="CPU inference with dynamic int8 linear layers")
+    parser.add_argument("--image-root", type=Path, default=IMAGE_ROOT)
+    parser.add_argument("--packed", action="store_true", help="also read frames from .pack containers")
+    parser.add_argument("--host", type=str, default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--unix-socket", type=str, default=None, help="serve on a Unix socket instead of TCP")
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS, help="prompt budget per request")
+    parser.add_argument("--batch-tokens", type=int, default=BATCH_TOKENS, help="prompt + new tokens per batch")
+    parser.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    parser.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    parser.add_argument("--views-map", type=str, default=None, help="camera ranking from get_best_view.py; prunes multi-camera requests")
+    parser.add_argument("--top-k", type=int, default=1, help="cameras kept per request with --views-map")
+    args = parser.parse_args()
+
+    metrics.init("inference_server")
+    with metrics.span("model_load"):
+        model, processor = load_model(args.model, args.adapter, int8=args.int8)
+    Handler.engine = Engine(model, processor, FrameResolver(args.image_root, packed=args.packed),
+                            args.max_tokens, args.batch_tokens, args.max_batch, args.max_wait_ms,
+                            load_view_ranking(args.views_map) if args.views_map else None, args.top_k)
+
+    if args.unix_socket:
+        if os.path.exists(args.unix_socket):
+            os.remove(args.unix_socket)
+        server = UnixHTTPServer(args.unix_socket, Handler)
+        where = args.unix_socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), Handler)
+        where = f"http://{args.host}:{args.port}"
+    print(f"Serving {args.model} on {where}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
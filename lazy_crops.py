@@ -0,0 +1,154 @@
+import os
+import json
+from collections import OrderedDict
+from pathlib import Path
+
+import cv2
+import numpy as np
+from PIL import Image
+
+import metrics
+from frame_pack import FrameResolver
+
+# Lazy local crops: instead of writing a cropped copy of every frame to
+# bbox_local, space_om_extract.py --lazy-crops writes the frames to
+# bbox_global without boxes drawn on them, plus one sidecar per video
+#
+#   bbox_global/train/<sid>/overhead_view/<camera>.crops.json
+#   {"version": 2, "scale": 1.5, "frames": {"<camera>/3_action.jpg": {
+#       "global": {"ped": [x0, y0, x1, y1], "veh": null},
+#       "local": {"ped": [...], "veh": null}, "crop": [x0, y0, x1, y1]}, ...}}
+#
+# holding the boxes draw_and_save_bboxes (tight, thickness 4) and
+# draw_and_save_bboxes_scale_version (enlarged, thickness 3) would have drawn
+# and the crop rectangle of the latter. Member names are relative to the
+# sidecar directory, like pack members (see frame_pack.py). CropResolver
+# draws the boxes of its view on the clean frame at load time: view="global"
+# gives the bbox_global image, view="local" the bbox_local crop, so a loader
+# switches between them by its resolver. Frames without a crop rectangle are
+# returned whole, matching the original fallback to the full frame.
+#
+# Boxes and crops match the written images exactly; the frame itself went
+# through JPEG once before the boxes were drawn rather than after.
+
+CROPS_SUFFIX = '.crops.json'
+CROPS_VERSION = 2
+CACHE_SIZE = 16                 # decoded clean frames kept per resolver
+VIEWS = {'global': 4, 'local': 3}       # line thickness of the boxes drawn in each view
+PED_COLOR = (0, 255, 0)                 # RGB; space_om_extract.py draws BGR (0, 255, 0) / (255, 0, 0)
+VEH_COLOR = (0, 0, 255)
+
+
+def crop_index_path(video_key, root='bbox_global'):
+    """Sidecar holding the boxes and crop rectangles of the frames extracted from `video_key`."""
+    return video_key.replace('/videos', f'/{root}').replace('.mp4', CROPS_SUFFIX)
+
+
+def box_or_none(box):
+    """xyxy list of ints, or None for a missing (-1 / NaN) box."""
+    if box is None or not box[0] >= 0:
+        return None
+    return [int(v) for v in box]
+
+
+def write_crop_index(path, frames, scale):
+    """
+    `frames` maps frame file names (as written) to dict(global=dict(ped, veh),
+    local=dict(ped, veh), crop) xyxy boxes, None where missing.
+    """
+    base = os.path.dirname(path)
+    members = {os.path.relpath(name, base or '.').replace(os.sep, '/'): entry for name, entry in frames.items()}
+    os.makedirs(base or '.', exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(dict(version=CROPS_VERSION, scale=scale, frames=members), f)
+
+
+class CropResolver:
+    """
+    FrameResolver-compatible reader that renders the clean frames under
+    `root` as their `view` ("global" or "local", see above). The last
+    `cache_size` decoded clean frames are kept, so several crops of one frame
+    decode it once. Frames without a sidecar entry are returned as stored.
+    """
+
+    def __init__(self, root, packed=False, view='local', cache_size=CACHE_SIZE):
+        if view not in VIEWS:
+            raise ValueError(f'unknown view {view!r}, expected one of {list(VIEWS)}')
+        self.frames = FrameResolver(root, packed=packed)
+        self.root = self.frames.root
+        self.view = view
+        self.cache_size = cache_size
+        self._entries = None
+        self._cache = OrderedDict()
+
+    def _catalog(self):
+        if self._entries is None:
+            self._entries = dict()
+            with metrics.span('dir_scan'):
+                for dirpath, _, files in os.walk(self.root):
+                    for f in files:
+                        if not f.endswith(CROPS_SUFFIX):
+                            continue
+                        with open(os.path.join(dirpath, f)) as fp:
+                            index = json.load(fp)
+                        if index.get('version') != CROPS_VERSION:
+                            raise ValueError(f'{os.path.join(dirpath, f)}: crop index version {index.get("version")}, '
+                                             f'expected {CROPS_VERSION}; re-run space_om_extract.py --lazy-crops')
+                        for member, entry in index['frames'].items():
+                            virtual = (Path(dirpath) / member).relative_to(self.root)
+                            self._entries[virtual.as_posix()] = entry
+        return self._entries
+
+    def _entry(self, path):
+        return self._catalog().get(self.frames._relative(path).as_posix())
+
+    def crop_rect(self, path):
+        """xyxy rectangle `path` is cropped to in this view, or None when it is returned whole."""
+        entry = self._entry(path)
+        if self.view != 'local' or entry is None or entry['crop'] is None:
+            return None
+        return tuple(entry['crop'])
+
+    def clean_image(self, path):
+        key = self.frames._relative(path).as_posix()
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            metrics.count('crop_cache_hits')
+            return self._cache[key]
+        metrics.count('crop_cache_misses')
+        img = np.asarray(self.frames.open_image(path))
+        self._cache[key] = img
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return img
+
+    def open_image(self, path):
+        """PIL RGB image of `path` in this view: its boxes drawn, cropped for the local view."""
+        entry = self._entry(path)
+        if entry is None:
+            return self.frames.open_image(path)
+        img = self.clean_image(path)
+        with metrics.span('draw'):
+            frame = img.copy()
+            boxes = entry[self.view]
+            for box, color in ((boxes['ped'], PED_COLOR), (boxes['veh'], VEH_COLOR)):
+                if box is not None:
+                    cv2.rectangle(frame, tuple(box[:2]), tuple(box[2:]), color=color, thickness=VIEWS[self.view])
+        rect = self.crop_rect(path)
+        if rect is not None:
+            with metrics.span('crop'):
+                x0, y0, x1, y1 = rect
+                frame = frame[y0:y1, x0:x1]
+        return Image.fromarray(np.ascontiguousarray(frame))
+
+    def exists(self, path):
+        return self.frames.exists(path)
+
+    def isdir(self, path):
+        return self.frames.isdir(path)
+
+    def listdir(self, path):
+        return self.frames.listdir(path)
+
+    def subdirs(self, path):
+        return self.frames.subdirs(path)
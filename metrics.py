@@ -0,0 +1,227 @@
+import os
+import json
+import time
+import atexit
+import threading
+from collections import defaultdict
+
+# Lightweight stage instrumentation shared by every entry point.
+#
+#   import metrics
+#   metrics.init('space_om_extract')        # once, at the top of the script
+#   with metrics.span('decode'):            # timed span
+#       ...
+#   metrics.count('frames_decoded', n)      # counter
+#
+# Collection is off unless AICITY_METRICS is set. It may point to a JSON file
+# or to a directory (the report is then written to <dir>/<stage>.metrics.json).
+# When disabled, span() returns a shared no-op object and count() returns
+# immediately, so instrumented code pays one global lookup per call.
+#
+# multiprocessing.Pool workers do not run atexit hooks, so pooled jobs are
+# wrapped with `metrics.pooled(fn)` and results passed through
+# `metrics.collect(...)`: every job ships its worker's counters back to the
+# parent, which aggregates them in total and per worker pid.
+#
+# load_json / path_exists / list_dir are the instrumented file helpers the
+# data scripts share (json_parse and dir_scan spans, files_stat counter).
+
+METRICS_ENV = 'AICITY_METRICS'
+
+_enabled = False
+_stage = None
+_report_path = None
+_start = None
+_owner_pid = None                               # process whose counters these are (see pooled)
+_lock = threading.Lock()
+_spans = defaultdict(lambda: [0, 0.0, 0.0])     # name -> [count, total seconds, max seconds]
+_counters = defaultdict(int)
+_workers = dict()                               # pid -> snapshot merged from pool workers
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+class _Span:
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _record(self.name, time.perf_counter() - self.start)
+        return False
+
+
+def _record(name, seconds):
+    with _lock:
+        entry = _spans[name]
+        entry[0] += 1
+        entry[1] += seconds
+        if seconds > entry[2]:
+            entry[2] = seconds
+
+
+def enabled():
+    return _enabled
+
+
+def init(stage, report_path=None):
+    """Enable collection for `stage` if a report path is given or AICITY_METRICS is set."""
+    global _enabled, _stage, _report_path, _start, _owner_pid
+    report_path = report_path or os.environ.get(METRICS_ENV)
+    if not report_path:
+        return
+    if os.path.isdir(report_path) or report_path.endswith(os.sep):
+        report_path = os.path.join(report_path, f'{stage}.metrics.json')
+    first = _report_path is None
+    _enabled, _stage, _report_path, _start = True, stage, report_path, time.perf_counter()
+    _owner_pid = os.getpid()
+    if first:
+        atexit.register(write_report)
+
+
+def span(name):
+    if not _enabled:
+        return _NULL_SPAN
+    return _Span(name)
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] += n
+
+
+def timed(name):
+    """Decorator form of span()."""
+    def wrap(fn):
+        def inner(*args, **kwargs):
+            with span(name):
+                return fn(*args, **kwargs)
+        inner.__name__ = fn.__name__
+        inner.__doc__ = fn.__doc__
+        return inner
+    return wrap
+
+
+def load_json(path):
+    with span('json_parse'), open(path) as f:
+        return json.load(f)
+
+
+def path_exists(path):
+    count('files_stat')
+    return os.path.exists(path)
+
+
+def list_dir(path):
+    with span('dir_scan'):
+        return os.listdir(path)
+
+
+def snapshot():
+    with _lock:
+        return dict(spans={k: list(v) for k, v in _spans.items()}, counters=dict(_counters))
+
+
+def drain():
+    """Snapshot and reset (used by pool workers between jobs)."""
+    with _lock:
+        snap = dict(pid=os.getpid(), spans={k: list(v) for k, v in _spans.items()}, counters=dict(_counters))
+        _spans.clear()
+        _counters.clear()
+    return snap
+
+
+def _merge_into(spans, counters, snap):
+    for name, (n, total, peak) in snap['spans'].items():
+        entry = spans[name]
+        entry[0] += n
+        entry[1] += total
+        entry[2] = max(entry[2], peak)
+    for name, n in snap['counters'].items():
+        counters[name] += n
+
+
+def merge(snap):
+    with _lock:
+        _merge_into(_spans, _counters, snap)
+        worker = _workers.setdefault(snap.get('pid'), dict(spans=defaultdict(lambda: [0, 0.0, 0.0]),
+                                                            counters=defaultdict(int)))
+        _merge_into(worker['spans'], worker['counters'], snap)
+
+
+class pooled:
+    """Picklable wrapper: run fn in a pool worker and return (result, metrics drained from that worker)."""
+
+    def __init__(self, fn):
+        self.fn = fn
+
+    def __call__(self, *args, **kwargs):
+        global _owner_pid
+        if _enabled and os.getpid() != _owner_pid:
+            # freshly forked worker: drop whatever the parent had recorded before the fork
+            with _lock:
+                _spans.clear()
+                _counters.clear()
+            _owner_pid = os.getpid()
+        result = self.fn(*args, **kwargs)
+        return result, (drain() if _enabled else None)
+
+
+def collect(results):
+    """Unwrap results of a `pooled` function, merging the worker metrics into this process."""
+    for result, snap in results:
+        if snap is not None:
+            merge(snap)
+        yield result
+
+
+def _format_spans(spans):
+    return {
+        name: dict(count=n, total_s=round(total, 6), mean_s=round(total / n, 6) if n else 0.0, max_s=round(peak, 6))
+        for name, (n, total, peak) in sorted(spans.items())
+    }
+
+
+def report():
+    with _lock:
+        return dict(
+            stage=_stage,
+            pid=os.getpid(),
+            wall_s=round(time.perf_counter() - _start, 6) if _start is not None else None,
+            spans=_format_spans(_spans),
+            counters=dict(sorted(_counters.items())),
+            workers={
+                str(pid): dict(spans=_format_spans(w['spans']), counters=dict(sorted(w['counters'].items())))
+                for pid, w in _workers.items()
+            },
+        )
+
+
+def write_report(path=None):
+    if not _enabled:
+        return
+    path = path or _report_path
+    dirname = os.path.dirname(path)
+    if dirname:
+        os.makedirs(dirname, exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump(report(), f, indent=2)
+    print(f'Metrics report written to {path}')
@@ -0,0 +1,388 @@
+import gc
+import time
+from collections import OrderedDict
+
+import torch
+
+import metrics
+from token_budget import fit_conversation
+from generation import NO_THINK, generate_tagged
+from spaceom_infer import MAX_TOKENS, MAX_NEW_TOKENS, SYSTEM_PROMPT, load_model, model_megabytes, prompt_messages
+
+# Vision-language backbones behind one interface, loaded on demand.
+#
+#   pool = ModelPool(budget_mb=16000)
+#   backbone = pool.get('videollama3-2b')          # loads it, unloading others if needed
+#   responses, tokens = backbone.answer(samples, images)
+#   text = backbone.caption(frames, "Describe the pedestrian.")
+#   pool.swap('videollama3-2b', 'spaceom')
+#   probs = backbone.choice_probs(samples, images)  # (n, 4) next-token probabilities of a..d
+#
+# Every backbone answers vqa_space_om.py samples (their own system / user
+# turns) and captions a list of frames with a free prompt. Family-specific
+# code is limited to turning messages + images into model inputs:
+#
+#   qwen          Qwen2.5-VL (SpaceOm, + LoRA adapter), same token budget as
+#                 spaceom_infer.py and stops at </answer>
+#   hf            anything AutoModelForImageTextToText + chat template loads
+#                 (LLaVA-1.5, SpaceLLaVA, small stand-ins)
+#   videollama3   DAMO-NLP-SG/VideoLLaMA3 (remote code, conversation processor)
+#
+# choice_probs() reads the choice letter distribution off one forward pass
+# (no generation); `answer_prefill` is appended to the prompt first so the
+# next token is the letter (an empty <think> block for SpaceOm, which
+# otherwise reasons first).
+#
+# ModelPool keeps loaded backbones under a memory budget: before a load it
+# unloads the least recently used ones until the estimate (params x dtype
+# size, replaced by the measured size once loaded) fits.
+
+MEMORY_BUDGET_MB = None         # None: 80% of free GPU memory, or of available RAM on CPU
+MEMORY_OVERHEAD = 1.2           # activations / buffers on top of the weights
+
+# name -> spec; `params_b` (billions) sizes a backbone before it is loaded
+BACKBONES = {
+    'spaceom': dict(kind='qwen', model_id='remyxai/SpaceOm', params_b=3.8, answer_prefill=NO_THINK),
+    'spaceom-lora': dict(kind='qwen', model_id='remyxai/SpaceOm', adapter='spaceom_lora', params_b=3.8),
+    'videollama3-2b': dict(kind='videollama3', model_id='DAMO-NLP-SG/VideoLLaMA3-2B', params_b=2.0),
+    'llava-1.5-7b': dict(kind='hf', model_id='llava-hf/llava-1.5-7b-hf', params_b=7.1),
+    'spacellava': dict(kind='hf', model_id='salma-remyx/spacellava-1.5-7b', params_b=7.1),
+    # tiny random-weight models: exercise the whole harness on CPU in seconds
+    'tiny-qwen': dict(kind='qwen', model_id='trl-internal-testing/tiny-Qwen2_5_VLForConditionalGeneration', params_b=0.01),
+    'tiny-llava': dict(kind='hf', model_id='trl-internal-testing/tiny-LlavaForConditionalGeneration', params_b=0.01),
+}
+
+
+def register(name, kind, model_id, **spec):
+    """Add (or replace) a backbone spec."""
+    if kind not in BACKBONE_KINDS:
+        raise ValueError(f'unknown backbone kind {kind!r}, expected one of {sorted(BACKBONE_KINDS)}')
+    BACKBONES[name] = dict(kind=kind, model_id=model_id, **spec)
+
+
+def parse_spec(text):
+    """`name=kind:model_id[:adapter]` (the --register flag) -> register() arguments."""
+    name, _, rest = text.partition('=')
+    kind, _, model = rest.partition(':')
+    model_id, _, adapter = model.partition(':')
+    if not (name and kind and model_id):
+        raise ValueError(f'expected name=kind:model_id[:adapter], got {text!r}')
+    return name, kind, model_id, dict(adapter=adapter or None)
+
+
+def default_device():
+    return 'cuda' if torch.cuda.is_available() else 'cpu'
+
+
+def available_mb(device):
+    """Memory a new model may use on `device`."""
+    if device.startswith('cuda'):
+        free, _ = torch.cuda.mem_get_info()
+        return free / 1e6
+    with open('/proc/meminfo') as f:
+        info = dict(line.split(':', 1) for line in f)
+    return int(info['MemAvailable'].split()[0]) / 1e3
+
+
+def reset_peak_memory(device):
+    if device.startswith('cuda'):
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')        # resets VmHWM (Linux)
+    except OSError:
+        pass
+
+
+def peak_memory_mb(device):
+    """Peak GPU allocation, or peak resident set size on CPU, since reset_peak_memory()."""
+    if device.startswith('cuda'):
+        return torch.cuda.max_memory_allocated() / 1e6
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1]) / 1e3
+    return None
+
+
+class Backbone:
+    """One registered model; subclasses turn (messages, images) into inputs for generate()."""
+
+    kind = None
+    batch_size = 8              # rows per generate() call
+    returns_prompt = True       # generate() output starts with the prompt
+
+    def __init__(self, name, model_id, adapter=None, params_b=None, device=None, max_tokens=MAX_TOKENS,
+                 answer_prefill=''):
+        self.name = name
+        self.model_id = model_id
+        self.adapter = adapter
+        self.params_b = params_b
+        self.answer_prefill = answer_prefill     # appended to the prompt by choice_probs()
+        self.device = device or default_device()
+        self.max_tokens = max_tokens
+        self.model = None
+        self.processor = None
+        self.measured_mb = None
+        self.load_seconds = None
+
+    def __repr__(self):
+        state = f'{self.measured_mb:.0f} MB' if self.loaded else 'unloaded'
+        return f'{type(self).__name__}({self.name!r}, {self.model_id!r}, {state})'
+
+    @property
+    def loaded(self):
+        return self.model is not None
+
+    @property
+    def dtype(self):
+        return torch.bfloat16 if self.device.startswith('cuda') else torch.float32
+
+    def estimate_mb(self):
+        if self.measured_mb is not None:
+            return self.measured_mb * MEMORY_OVERHEAD
+        if self.params_b is None:
+            return 0.0
+        return self.params_b * 1e3 * torch.finfo(self.dtype).bits / 8 * MEMORY_OVERHEAD
+
+    def load(self):
+        if self.loaded:
+            return self
+        start = time.perf_counter()
+        with metrics.span('model_load'):
+            self.model, self.processor = self._load()
+        self.model.eval()
+        self.load_seconds = time.perf_counter() - start
+        self.measured_mb = model_megabytes(self.model)
+        metrics.count('models_loaded')
+        return self
+
+    def unload(self):
+        self.model = self.processor = None
+        gc.collect()
+        if self.device.startswith('cuda'):
+            torch.cuda.empty_cache()
+
+    def _load(self):
+        raise NotImplementedError
+
+    def encode(self, conversations, images, prefill=''):
+        """Model inputs for a batch of message lists and their images, `prefill` following the generation prompt."""
+        raise NotImplementedError
+
+    def fold_system(self, messages):
+        """Messages with the system text prepended to the first user turn (for templates without a system role)."""
+        system = [m for m in messages if m['role'] == 'system']
+        messages = [m for m in messages if m['role'] != 'system']
+        if not system:
+            return messages
+        text = ' '.join(c['text'] for m in system for c in m['content'] if c['type'] == 'text')
+        first = next(i for i, m in enumerate(messages) if m['role'] == 'user')
+        messages[first] = dict(messages[first], content=[{'type': 'text', 'text': text}] + messages[first]['content'])
+        return messages
+
+    @torch.no_grad()
+    def respond(self, conversations, images, max_new_tokens):
+        """(decoded replies, generated token counts) for a batch."""
+        inputs = self.encode(conversations, images)
+        with metrics.span('generate'):
+            out = self.model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False)
+        new_tokens = out[:, inputs['input_ids'].shape[1]:] if self.returns_prompt else out
+        pad = self.processor.tokenizer.pad_token_id
+        counts = [int((row != pad).sum()) if pad is not None else len(row) for row in new_tokens]
+        metrics.count('generated_tokens', sum(counts))
+        return [t.strip() for t in self.processor.batch_decode(new_tokens, skip_special_tokens=True)], counts
+
+    def answer(self, samples, images, max_new_tokens=MAX_NEW_TOKENS, system_prompt=SYSTEM_PROMPT):
+        """Replies to vqa_space_om.py samples, `images` holding the decoded frames of each sample."""
+        self.load()
+        responses, counts = [], []
+        for start in range(0, len(samples), self.batch_size):
+            r, c = self.respond([prompt_messages(s, system_prompt) for s in samples[start:start + self.batch_size]],
+                                images[start:start + self.batch_size], max_new_tokens)
+            responses += r
+            counts += c
+        return responses, counts
+
+    def letter_ids(self, letter):
+        """Token ids that start a reply with `letter` (either case, with or without a leading space)."""
+        ids = set()
+        for variant in (letter, letter.upper(), ' ' + letter, ' ' + letter.upper()):
+            tokens = self.processor.tokenizer(variant, add_special_tokens=False)['input_ids']
+            if tokens:
+                ids.add(tokens[-1] if len(tokens) > 1 and variant.startswith(' ') else tokens[0])
+        return sorted(ids)
+
+    @torch.no_grad()
+    def choice_probs(self, samples, images, choices='abcd', system_prompt=SYSTEM_PROMPT):
+        """(n, len(choices)) probabilities of each choice letter as the first answer token, renormalized over `choices`."""
+        self.load()
+        ids = [self.letter_ids(c) for c in choices]
+        out = []
+        for start in range(0, len(samples), self.batch_size):
+            inputs = self.encode([prompt_messages(s, system_prompt) for s in samples[start:start + self.batch_size]],
+                                 images[start:start + self.batch_size], prefill=self.answer_prefill)
+            with metrics.span('forward'):
+                logits = self.model(**inputs).logits[:, -1].float()       # left padded: last position of every row
+            probs = logits.softmax(-1)
+            scores = torch.stack([probs[:, i].sum(-1) for i in ids], dim=1)
+            out.append(scores / scores.sum(1, keepdim=True).clamp_min(1e-12))
+        return torch.cat(out).cpu().numpy()
+
+    def caption(self, frames, prompt, max_new_tokens=MAX_NEW_TOKENS, system_prompt=None):
+        """Free-form reply to `prompt` about a list of frames."""
+        messages = [{'role': 'user', 'content': [{'type': 'image', 'image': ''} for _ in frames] +
+                                                [{'type': 'text', 'text': prompt}]}]
+        if system_prompt:
+            messages.insert(0, {'role': 'system', 'content': [{'type': 'text', 'text': system_prompt}]})
+        self.load()
+        return self.respond([messages], [frames], max_new_tokens)[0][0]
+
+
+class QwenBackbone(Backbone):
+    """Qwen2.5-VL through spaceom_infer.py: same token budget, stops at </answer>."""
+
+    kind = 'qwen'
+
+    def _load(self):
+        return load_model(self.model_id, self.adapter, device=self.device)
+
+    def encode(self, conversations, images, prefill=''):
+        texts, fitted = [], []
+        for messages, imgs in zip(conversations, images):
+            _, imgs, text, _ = fit_conversation(self.processor, messages, imgs, self.max_tokens, add_generation_prompt=True)
+            texts.append(text + prefill)
+            fitted += imgs
+        with metrics.span('processor'):
+            inputs = self.processor(text=texts, images=fitted or None, return_tensors='pt', padding=True)
+        return inputs.to(self.device)
+
+    def respond(self, conversations, images, max_new_tokens):
+        texts, report = generate_tagged(self.model, self.processor, self.encode(conversations, images), max_new_tokens)
+        return [t.strip() for t in texts], [row['generated'] for row in report]
+
+
+class HFChatBackbone(Backbone):
+    """Models with an image-text-to-text head and a chat template (LLaVA family, ...)."""
+
+    kind = 'hf'
+
+    def _load(self):
+        from transformers import AutoModelForImageTextToText, AutoProcessor
+        model = AutoModelForImageTextToText.from_pretrained(self.model_id, torch_dtype=self.dtype).to(self.device)
+        if self.adapter:
+            from peft import PeftModel
+            model = PeftModel.from_pretrained(model, self.adapter)
+        processor = AutoProcessor.from_pretrained(self.model_id)
+        processor.tokenizer.padding_side = 'left'
+        if processor.tokenizer.pad_token is None:
+            processor.tokenizer.pad_token = processor.tokenizer.eos_token
+        return model, processor
+
+    def encode(self, conversations, images, prefill=''):
+        texts = []
+        for messages in conversations:
+            messages = [dict(m, content=[{'type': 'image'} if c['type'] == 'image' else c for c in m['content']])
+                        for m in self.fold_system(messages)]
+            texts.append(self.processor.apply_chat_template(messages, add_generation_prompt=True) + prefill)
+        flat = [img for imgs in images for img in imgs]
+        with metrics.span('processor'):
+            inputs = self.processor(text=texts, images=flat or None, return_tensors='pt', padding=True)
+        return {k: v.to(self.device, self.dtype) if v.is_floating_point() else v.to(self.device) for k, v in inputs.items()}
+
+
+class VideoLLaMA3Backbone(Backbone):
+    """VideoLLaMA3 (trust_remote_code); its processor takes the conversation with the images inline."""
+
+    kind = 'videollama3'
+    batch_size = 1              # the remote processor encodes one conversation at a time
+    returns_prompt = False
+
+    def _load(self):
+        from transformers import AutoModelForCausalLM, AutoProcessor
+        model = AutoModelForCausalLM.from_pretrained(self.model_id, trust_remote_code=True,
+                                                     torch_dtype=self.dtype).to(self.device)
+        processor = AutoProcessor.from_pretrained(self.model_id, trust_remote_code=True)
+        return model, processor
+
+    def encode(self, conversations, images, prefill=''):
+        (messages,), (imgs,) = conversations, images
+        imgs = iter(imgs)
+        conversation = [dict(m, content=[{'type': 'image', 'image': next(imgs)} if c['type'] == 'image' else c
+                                         for c in m['content']]) for m in messages]
+        with metrics.span('processor'):
+            inputs = self.processor(conversation=conversation, add_system_prompt=True, add_generation_prompt=True,
+                                    return_tensors='pt')
+        if prefill:
+            extra = self.processor.tokenizer(prefill, add_special_tokens=False, return_tensors='pt')['input_ids']
+            inputs['input_ids'] = torch.cat([inputs['input_ids'], extra], dim=1)
+            inputs['attention_mask'] = torch.cat([inputs['attention_mask'], torch.ones_like(extra)], dim=1)
+        inputs = {k: v.to(self.device) if torch.is_tensor(v) else v for k, v in inputs.items()}
+        if 'pixel_values' in inputs:
+            inputs['pixel_values'] = inputs['pixel_values'].to(self.dtype)
+        return inputs
+
+
+BACKBONE_KINDS = {cls.kind: cls for cls in (QwenBackbone, HFChatBackbone, VideoLLaMA3Backbone)}
+
+
+def make_backbone(name, device=None, max_tokens=MAX_TOKENS):
+    spec = dict(BACKBONES[name])
+    return BACKBONE_KINDS[spec.pop('kind')](name, device=device, max_tokens=max_tokens, **spec)
+
+
+class ModelPool:
+    """Lazily loaded backbones sharing one memory budget (least recently used is unloaded first)."""
+
+    def __init__(self, budget_mb=MEMORY_BUDGET_MB, device=None, max_tokens=MAX_TOKENS):
+        self.device = device or default_device()
+        self.budget_mb = budget_mb if budget_mb is not None else 0.8 * available_mb(self.device)
+        self.max_tokens = max_tokens
+        self.backbones = dict()
+        self.active = OrderedDict()     # loaded backbones, least recently used first
+
+    def backbone(self, name):
+        """The (possibly unloaded) backbone registered as `name`."""
+        if name not in self.backbones:
+            if name not in BACKBONES:
+                raise KeyError(f'unknown backbone {name!r}, registered: {sorted(BACKBONES)}')
+            self.backbones[name] = make_backbone(name, self.device, self.max_tokens)
+        return self.backbones[name]
+
+    def used_mb(self):
+        return sum(b.estimate_mb() for b in self.active.values())
+
+    def make_room(self, need_mb, keep=None):
+        while self.active and self.used_mb() + need_mb > self.budget_mb:
+            name = next(iter(self.active))
+            if name == keep:
+                break
+            print(f'Unloading {name} to fit {need_mb:.0f} MB (budget {self.budget_mb:.0f} MB)')
+            self.unload(name)
+        if self.used_mb() + need_mb > self.budget_mb:
+            print(f'Warning: loading {need_mb:.0f} MB over a {self.budget_mb:.0f} MB budget')
+
+    def get(self, name):
+        """Loaded backbone `name`."""
+        backbone = self.backbone(name)
+        if not backbone.loaded:
+            self.make_room(backbone.estimate_mb(), keep=name)
+            backbone.load()
+        self.active[name] = backbone
+        self.active.move_to_end(name)
+        return backbone
+
+    def unload(self, name):
+        backbone = self.active.pop(name, None)
+        if backbone is not None:
+            backbone.unload()
+
+    def unload_all(self):
+        for name in list(self.active):
+            self.unload(name)
+
+    def swap(self, old, new):
+        """Unload `old` (if loaded) and return `new`, loaded."""
+        self.unload(old)
+        return self.get(new)
@@ -0,0 +1,165 @@
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+import metrics
+
+# Sequence packing for train.py.
+#
+# A short VQA sample (one frame, a question, a one-letter answer) uses a
+# fraction of MAX_TOKENS; padded to max_length, most of every step is padding.
+# Instead, samples are planned into packs of at most `budget` tokens (their
+# exact lengths come from token_budget.py without decoding any image), and
+# PackingCollator concatenates each pack into one row:
+#
+#   input_ids / labels   samples back to back, labels only on assistant tokens
+#   position_ids         (3, B, L) M-RoPE ids computed per sample, so every
+#                        sample starts at position 0 as if it were alone
+#   attention_mask       (B, 1, L, L) block-diagonal causal mask in the
+#                        model's inverted form (0 = attend, finfo.min = masked),
+#                        so samples never attend to each other
+#   pixel_values         every image of the batch, in token order
+#
+# A sample longer than `budget` gets a row of its own.
+
+PACK_CHUNK = 2000       # samples packed together (first-fit decreasing within a shuffled chunk)
+IGNORE_INDEX = -100
+ASSISTANT_START = "<|im_start|>assistant\n"
+TURN_END = "<|im_end|>"
+
+
+def assistant_labels(input_ids, tokenizer):
+    """
+    Copy of 1-D `input_ids` with everything but assistant replies (and their
+    <|im_end|>) set to IGNORE_INDEX. A reply without its <|im_end|> (a
+    generation prompt, or one cut by truncation) is not labelled.
+    """
+    start = tokenizer(ASSISTANT_START, add_special_tokens=False)["input_ids"]
+    end = tokenizer.convert_tokens_to_ids(TURN_END)
+    ids = input_ids.tolist()
+    labels = torch.full_like(input_ids, IGNORE_INDEX)
+    i, n = 0, len(start)
+    while i <= len(ids) - n:
+        if ids[i:i + n] != start:
+            i += 1
+            continue
+        j = i + n
+        while j < len(ids) and ids[j] != end:
+            j += 1
+        if j == len(ids):
+            break
+        labels[i + n:j + 1] = input_ids[i + n:j + 1]
+        i = j + 1
+    return labels
+
+
+def pack_indices(lengths, budget, seed=0, chunk=PACK_CHUNK):
+    """Packs (lists of sample indices) of at most `budget` tokens each."""
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(lengths))
+    packs = []
+    for start in range(0, len(order), chunk):
+        bins = []       # [tokens left, indices]
+        for i in sorted(order[start:start + chunk].tolist(), key=lambda i: -lengths[i]):
+            need = min(int(lengths[i]), budget)
+            for b in bins:
+                if b[0] >= need:
+                    b[0] -= need
+                    b[1].append(i)
+                    break
+            else:
+                bins.append([budget - need, [i]])
+        packs += [b[1] for b in bins]
+    return packs
+
+
+def packing_summary(lengths, packs, budget):
+    """One line comparing rows and padding with and without packing."""
+    used = int(np.sum(lengths))
+    return (f"packed {len(lengths)} samples into {len(packs)} rows of {budget} tokens: "
+            f"{used / (len(packs) * budget):.1%} of tokens used "
+            f"(unpacked: {used / (len(lengths) * budget):.1%}, {len(lengths) / max(len(packs), 1):.2f}x fewer rows)")
+
+
+class PackedDataset(Dataset):
+    """Map-style view of `dataset` whose items are packs (lists of encoded samples)."""
+
+    def __init__(self, dataset, packs, lengths):
+        self.dataset = dataset
+        self.packs = packs
+        self.pack_lengths = [int(sum(lengths[i] for i in pack)) for pack in packs]
+
+    def __len__(self):
+        return len(self.packs)
+
+    def __getitem__(self, idx):
+        return [self.dataset[i] for i in self.packs[idx]]
+
+
+def rope_index_fn(model):
+    """get_rope_index of a (possibly PEFT-wrapped) Qwen2.5-VL model."""
+    base = model.get_base_model() if hasattr(model, "get_base_model") else model
+    for m in (base, getattr(base, "model", None)):
+        if m is not None and hasattr(m, "get_rope_index"):
+            return m.get_rope_index
+    raise AttributeError("model has no get_rope_index (not a Qwen2-VL family model?)")
+
+
+def block_causal_mask(segments, dtype):
+    """(B, 1, L, L) inverted mask from per-token segment ids (-1 = padding)."""
+    length = segments.shape[1]
+    causal = torch.tril(torch.ones(length, length, dtype=torch.bool))
+    allowed = (segments[:, :, None] == segments[:, None, :]) & causal & (segments[:, :, None] >= 0)
+    allowed |= torch.eye(length, dtype=torch.bool)      # padding attends to itself, no all-masked rows
+    mask = torch.zeros(allowed.shape, dtype=dtype)
+    return mask.masked_fill(~allowed, torch.finfo(dtype).min)[:, None]
+
+
+class PackingCollator:
+    """Collates PackedDataset items (one pack per row) into model inputs."""
+
+    def __init__(self, pad_token_id, rope_index, dtype=torch.float32, device="cpu"):
+        self.pad_token_id = pad_token_id
+        self.rope_index = rope_index
+        self.dtype = dtype
+        self.device = device
+
+    def positions(self, sample):
+        ids = sample["input_ids"][None]
+        with torch.no_grad():
+            pos, _ = self.rope_index(input_ids=ids, image_grid_thw=sample.get("image_grid_thw"),
+                                     attention_mask=torch.ones_like(ids))
+        return pos[:, 0]        # (3, L)
+
+    def __call__(self, batch):
+        rows = [[(s, self.positions(s)) for s in pack] for pack in batch]
+        length = max(sum(len(s["input_ids"]) for s, _ in row) for row in rows)
+        input_ids = torch.full((len(rows), length), self.pad_token_id, dtype=torch.long)
+        labels = torch.full((len(rows), length), IGNORE_INDEX, dtype=torch.long)
+        position_ids = torch.ones((3, len(rows), length), dtype=torch.long)
+        segments = torch.full((len(rows), length), -1, dtype=torch.long)
+        pixel_values, grids = [], []
+        for r, row in enumerate(rows):
+            offset = 0
+            for k, (s, pos) in enumerate(row):
+                n = len(s["input_ids"])
+                input_ids[r, offset:offset + n] = s["input_ids"]
+                labels[r, offset:offset + n] = s["labels"]
+                position_ids[:, r, offset:offset + n] = pos
+                segments[r, offset:offset + n] = k
+                if s.get("image_grid_thw") is not None:
+                    pixel_values.append(s["pixel_values"])
+                    grids.append(s["image_grid_thw"])
+                offset += n
+        metrics.count("packed_rows", len(rows))
+        metrics.count("padding_tokens", int((segments < 0).sum()))
+        out = dict(
+            input_ids=input_ids,
+            labels=labels,
+            position_ids=position_ids,
+            attention_mask=block_causal_mask(segments, self.dtype),
+        )
+        if grids:
+            out["pixel_values"] = torch.cat(pixel_values)
+            out["image_grid_thw"] = torch.cat(grids)
+        return {k: v.to(self.device) for k, v in out.items()}
@@ -0,0 +1,352 @@
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import threading
+import subprocess
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from sharding import SCENARIO_ROOTS, in_shard, scenario_from_video_path, shard_output_path
+
+# Incremental runner for the preprocessing chain
+#
+#   extract_frames_bbox -> space_om_extract -> space_om_format -> merge_jsons -> train
+#   extract_val -> vqa_space_om
+#
+# vqa_space_om builds the val VQA samples that spaceom_infer.py, the
+# benchmarks and cascade.py score on; they are kept out of merge_jsons so no
+# evaluation sample ends up in train_all.
+#
+# Every stage declares its inputs and outputs (paths relative to the data
+# root, directories and globs allowed). Its fingerprint hashes the content of
+# every input file, its script and helper modules, and its arguments. A stage
+# whose fingerprint and outputs match the last successful run is skipped.
+# Stages whose dependencies are done run concurrently (--jobs).
+#
+# Stages that support --num-shards are also tracked per shard: each input
+# file (or entry of an annotation JSON) is assigned to the shard of its
+# scenario, so fixing one scenario re-runs one shard of each affected stage
+# and gathers its output again. Files that belong to no scenario count for
+# every shard.
+#
+# File digests are cached in the state file by (size, mtime), so a no-op run
+# only stats the inputs. train is only run when named on the command line.
+
+REPO_ROOT = os.path.dirname(os.path.abspath(__file__))
+STATE_PATH = '.pipeline_state.json'
+NUM_SHARDS = 8
+JOBS = 2
+CHUNK = 1 << 20
+
+ANNO_JSON = 'processed_anno/wts_train_all_video_with_bbox_anno_first_frame.json'
+CAPTION_JSON = 'data_preprocess/wts_bdd_train.json'
+VQA_JSON = 'vqa_spaceom_val_multiframe.json'
+TRAIN_INDEX = 'data_preprocess/train_all.index.json'
+
+
+class Stage:
+    def __init__(self, name, script, inputs, outputs, deps=(), args=(), code=(),
+                 entries=(), sharded=False, gather=False, default=True):
+        self.name = name
+        self.script = script
+        self.inputs = list(inputs)          # files, directories or globs
+        self.entries = list(entries)        # JSON dicts fingerprinted per top-level key (sharded stages)
+        self.outputs = list(outputs)
+        self.deps = list(deps)
+        self.args = list(args)
+        self.code = [script] + list(code)   # repo files whose content is part of the fingerprint
+        self.sharded = sharded
+        self.gather = gather                # shards write <output>.shard-* files merged by --gather
+        self.default = default
+
+
+STAGES = [
+    Stage('extract_frames_bbox', 'extract_frames_bbox.py',
+          inputs=['data/videos/train', 'data/annotations/caption/train', 'data/annotations/bbox_annotated'],
+          outputs=[ANNO_JSON]),
+    Stage('space_om_extract', 'space_om_extract.py',
+          inputs=['data/videos/train'], entries=[ANNO_JSON],
+          outputs=['data/bbox_global/train', 'data/bbox_local/train'],
+          deps=['extract_frames_bbox'], code=['bbox_geometry.py', 'frame_pack.py', 'lazy_crops.py', 'video_meta.py'], sharded=True),
+    Stage('space_om_format', 'space_om_format.py',
+          inputs=['data/annotations/caption/train', 'data/bbox_global/train'],
+          outputs=[CAPTION_JSON], deps=['space_om_extract'], sharded=True, gather=True),
+    Stage('extract_val', 'extract_val.py',
+          inputs=['data/videos/val'], outputs=['data/bbox_global/val'],
+          args=['--video-root', 'data/videos/val', '--output-root', 'data/bbox_global/val'],
+          code=['frame_pack.py'], sharded=True),
+    Stage('vqa_space_om', 'vqa_space_om.py',
+          inputs=['data/annotations/vqa/val', 'data/bbox_global/val'],
+          outputs=[VQA_JSON], deps=['extract_val'], code=['frame_pack.py', 'frame_dedup.py', 'get_best_view.py'], sharded=True, gather=True),
+    Stage('merge_jsons', 'data_preprocess/merge_jsons.py',
+          inputs=[CAPTION_JSON], outputs=[TRAIN_INDEX],
+          args=[CAPTION_JSON, '--output-prefix', TRAIN_INDEX[:-len('.index.json')]],
+          deps=['space_om_format'], code=['shards.py']),
+    Stage('train', 'train.py',
+          inputs=[TRAIN_INDEX, 'data_preprocess/train_all-*.jsonl', 'data/bbox_global'],
+          outputs=['spaceom_lora'], deps=['merge_jsons'],
+          code=['shards.py', 'frame_pack.py', 'lazy_crops.py', 'token_budget.py'], default=False),
+]
+
+
+def sha256(chunks):
+    h = hashlib.sha256()
+    for chunk in chunks:
+        h.update(chunk if isinstance(chunk, bytes) else str(chunk).encode('utf-8'))
+    return h.hexdigest()
+
+
+class FileHasher:
+    """Content digests cached by (size, mtime_ns); shared by the stage threads."""
+
+    def __init__(self, cache=None):
+        self.cache = cache if cache is not None else dict()
+        self.lock = threading.Lock()
+        self.hashed_bytes = 0
+
+    def digest(self, path):
+        st = os.stat(path)
+        with self.lock:
+            hit = self.cache.get(path)
+        if hit and hit[0] == st.st_size and hit[1] == st.st_mtime_ns:
+            return hit[2]
+        with open(path, 'rb') as f:
+            digest = sha256(iter(lambda: f.read(CHUNK), b''))
+        with self.lock:
+            self.cache[path] = [st.st_size, st.st_mtime_ns, digest]
+            self.hashed_bytes += st.st_size
+        return digest
+
+    def files(self, spec):
+        """(path, digest) of every file matched by a file, directory or glob `spec`, sorted."""
+        out = []
+        for match in sorted(glob.glob(spec)) if glob.has_magic(spec) else [spec]:
+            if os.path.isdir(match):
+                for dirpath, dirnames, names in os.walk(match):
+                    dirnames.sort()
+                    for name in sorted(names):
+                        if not name.endswith('.tmp'):
+                            path = os.path.join(dirpath, name)
+                            out.append((path, self.digest(path)))
+            elif os.path.isfile(match):
+                out.append((match, self.digest(match)))
+        return out
+
+
+def scenario_of(path):
+    """Scenario a file or annotation key belongs to, or None if it is shared by all scenarios."""
+    if not set(Path(path).parts) & set(SCENARIO_ROOTS):
+        return None
+    return scenario_from_video_path(path)
+
+
+def json_entries(path):
+    """(key, digest) of every top-level entry of a JSON dict."""
+    with open(path) as f:
+        data = json.load(f)
+    return [(key, sha256([json.dumps(value, sort_keys=True)])) for key, value in sorted(data.items())]
+
+
+class Runner:
+    def __init__(self, stages, root, num_shards=NUM_SHARDS, jobs=JOBS, force=(), dry_run=False):
+        self.stages = {stage.name: stage for stage in stages}
+        self.root = root
+        self.num_shards = num_shards
+        self.jobs = jobs
+        self.force = set(force)
+        self.dry_run = dry_run
+        self.state_path = os.path.join(root, STATE_PATH)
+        self.state = dict(files=dict(), stages=dict())
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                self.state = json.load(f)
+        self.hasher = FileHasher(self.state['files'])
+        self.lock = threading.Lock()
+
+    # ---------- fingerprints ----------
+    def code_digests(self, stage):
+        return [(name, self.hasher.digest(os.path.join(REPO_ROOT, name))) for name in stage.code]
+
+    def fingerprints(self, stage):
+        """(whole-stage fingerprint, {shard index: fingerprint}); the dict is empty for unsharded stages."""
+        shared = [('args', stage.args)] + self.code_digests(stage)
+        per_shard = {i: [] for i in range(self.num_shards)} if stage.sharded else None
+        items = []
+        for spec in stage.inputs:
+            items.extend(self.hasher.files(spec))
+        for path in stage.entries:
+            if os.path.exists(path):
+                items.extend(json_entries(path))
+
+        for key, digest in items:
+            scenario = scenario_of(key) if per_shard is not None else None
+            if scenario is None:
+                shared.append((key, digest))
+            else:
+                for i, bucket in per_shard.items():
+                    if in_shard(scenario, self.num_shards, i):
+                        bucket.append((key, digest))
+                        break
+
+        base = sha256(json.dumps(shared))
+        shards = dict()
+        if per_shard is not None:
+            shards = {str(i): sha256([base, json.dumps(bucket)]) for i, bucket in per_shard.items()}
+        whole = sha256([base] + [shards[k] for k in sorted(shards)])
+        return whole, shards
+
+    def output_digest(self, stage):
+        items = []
+        for spec in stage.outputs:
+            if not glob.glob(spec):
+                return None
+            items.extend(self.hasher.files(spec))
+        return sha256(json.dumps(items))
+
+    # ---------- execution ----------
+    def command(self, stage, shard_index=None, gather=False):
+        cmd = [sys.executable, os.path.join(REPO_ROOT, stage.script)] + stage.args
+        if shard_index is not None or gather:
+            cmd += ['--num-shards', str(self.num_shards)]
+        if shard_index is not None:
+            cmd += ['--shard-index', str(shard_index)]
+        if gather:
+            cmd += ['--gather']
+        return cmd
+
+    def call(self, stage, cmd):
+        print(f'[{stage.name}] $ {" ".join(cmd)}', flush=True)
+        if self.dry_run:
+            return
+        env = dict(os.environ, PYTHONPATH=REPO_ROOT + os.pathsep + os.environ.get('PYTHONPATH', ''))
+        log_path = os.path.join(self.root, 'logs', 'pipeline', f'{stage.name}.log')
+        os.makedirs(os.path.dirname(log_path), exist_ok=True)
+        with open(log_path, 'a') as log:
+            proc = subprocess.run(cmd, cwd=self.root, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if proc.returncode != 0:
+            raise RuntimeError(f'{stage.name} failed with exit code {proc.returncode}, see {log_path}')
+
+    def missing_shard_outputs(self, stage):
+        return [i for i in range(self.num_shards)
+                if not all(os.path.exists(shard_output_path(out, self.num_shards, i)) for out in stage.outputs)]
+
+    def run_stage(self, stage):
+        start = time.perf_counter()
+        whole, shards = self.fingerprints(stage)
+        previous = self.state['stages'].get(stage.name, dict())
+        outputs_ok = previous.get('outputs') is not None and self.output_digest(stage) == previous['outputs']
+        same_layout = previous.get('num_shards') == (self.num_shards if stage.sharded else 1)
+
+        if stage.name not in self.force and outputs_ok and previous.get('fingerprint') == whole:
+            print(f'[{stage.name}] up to date')
+            return 'skipped'
+
+        if stage.sharded and self.num_shards > 1:
+            stale = [int(i) for i, fp in shards.items()
+                     if stage.name in self.force or not outputs_ok or not same_layout
+                     or previous.get('shards', dict()).get(i) != fp]
+            if stage.gather:
+                stale = sorted(set(stale) | set(self.missing_shard_outputs(stage)))
+            print(f'[{stage.name}] re-running {len(stale)}/{self.num_shards} shards')
+            for i in stale:
+                self.call(stage, self.command(stage, shard_index=i))
+            if stage.gather:
+                self.call(stage, self.command(stage, gather=True))
+        else:
+            self.call(stage, self.command(stage))
+
+        if not self.dry_run:
+            with self.lock:
+                self.state['stages'][stage.name] = dict(
+                    fingerprint=whole, shards=shards, outputs=self.output_digest(stage),
+                    num_shards=self.num_shards if stage.sharded else 1,
+                    seconds=round(time.perf_counter() - start, 3))
+                self.save()
+        return 'ran'
+
+    def save(self):
+        # other stage threads keep adding digests to state['files'] (FileHasher.cache) under the hasher's lock
+        with self.hasher.lock:
+            files = dict(self.state['files'])
+        tmp = self.state_path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(dict(self.state, files=files), f)
+        os.replace(tmp, self.state_path)
+
+    def plan(self, targets):
+        """Targets plus everything they depend on, in declaration order."""
+        needed, todo = set(), list(targets)
+        while todo:
+            name = todo.pop()
+            if name not in self.stages:
+                raise KeyError(f'unknown stage {name}')
+            if name not in needed:
+                needed.add(name)
+                todo.extend(self.stages[name].deps)
+        return [name for name in self.stages if name in needed]
+
+    def run(self, targets):
+        order = self.plan(targets)
+        status = dict()
+        running = dict()
+        with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+            while len(status) < len(order):
+                for name in order:
+                    if name in status or name in running.values():
+                        continue
+                    deps = self.stages[name].deps
+                    if any(status.get(d) == 'failed' or status.get(d) == 'blocked' for d in deps if d in order):
+                        status[name] = 'blocked'
+                    elif all(d in status for d in deps if d in order):
+                        running[pool.submit(self.run_stage, self.stages[name])] = name
+                if not running:
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    try:
+                        status[name] = future.result()
+                    except Exception as e:
+                        print(f'[{name}] {e}')
+                        status[name] = 'failed'
+        return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the preprocessing stages that are out of date.')
+    parser.add_argument('targets', nargs='*', help='stages to bring up to date (default: every stage but train)')
+    parser.add_argument('--root', type=str, default='.', help='data root the stage paths are relative to')
+    parser.add_argument('--num-shards', type=int, default=NUM_SHARDS,
+                        help='shards tracked for stages that support --num-shards (1 disables)')
+    parser.add_argument('--jobs', type=int, default=JOBS, help='stages run at the same time')
+    parser.add_argument('--force', nargs='*', default=[], help='re-run these stages even if up to date')
+    parser.add_argument('--dry-run', action='store_true', help='print the commands that would run')
+    parser.add_argument('--list', action='store_true', help='list the stages and exit')
+    args = parser.parse_args()
+
+    if args.list:
+        for stage in STAGES:
+            deps = ', '.join(stage.deps) or '-'
+            print(f'{stage.name:<22} deps: {deps:<32} outputs: {", ".join(stage.outputs)}')
+        return
+
+    root = os.path.abspath(args.root)
+    os.chdir(root)
+    runner = Runner(STAGES, root, args.num_shards, args.jobs, args.force, args.dry_run)
+    targets = args.targets or [stage.name for stage in STAGES if stage.default]
+    start = time.perf_counter()
+    status = runner.run(targets)
+
+    for name, result in status.items():
+        print(f'{name:<22} {result}')
+    print(f'Hashed {runner.hasher.hashed_bytes / 1e6:.1f} MB in {time.perf_counter() - start:.1f}s')
+    if any(result in ('failed', 'blocked') for result in status.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
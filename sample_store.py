@@ -0,0 +1,157 @@
+import os
+import json
+import mmap
+import argparse
+
+import numpy as np
+
+from shards import INDEX_SUFFIX, iter_json_samples, load_index, shard_path
+
+# Offset-indexed sample store: random access to samples without holding them
+# as Python objects.
+#
+#   train_all.store.bin           compact JSON records, back to back
+#   train_all.store.offsets.npy   int64[n + 1], record i is bin[offsets[i]:offsets[i + 1]]
+#
+# A list of nested dicts in a map-style Dataset is slowly copied into every
+# forked DataLoader worker (refcount updates dirty the pages). SampleStore
+# keeps only two read-only mappings, opened lazily in each worker, and parses
+# one record per __getitem__, so worker memory does not grow with the dataset.
+#
+#   python sample_store.py data_preprocess/train_all.index.json
+#
+# builds the store next to its source; open_store() does the same on demand
+# and rebuilds when the source is newer.
+
+BIN_SUFFIX = '.store.bin'
+OFFSETS_SUFFIX = '.store.offsets.npy'
+
+
+def store_prefix(path):
+    """`x.json`, `x.jsonl` or `x.index.json` -> `x`."""
+    path = str(path)
+    for suffix in (INDEX_SUFFIX, '.jsonl', '.json'):
+        if path.endswith(suffix):
+            return path[:-len(suffix)]
+    return path
+
+
+def source_mtime(path):
+    """Newest mtime of a sample file, or of a shard index and all its shards."""
+    path = str(path)
+    mtime = os.stat(path).st_mtime_ns
+    if path.endswith(INDEX_SUFFIX):
+        for shard in load_index(path)['shards']:
+            mtime = max(mtime, os.stat(shard_path(path, shard)).st_mtime_ns)
+    return mtime
+
+
+def build_store(source, prefix=None):
+    """Stream `source` into `<prefix>.store.bin` / `.store.offsets.npy`. Returns the number of samples."""
+    prefix = prefix or store_prefix(source)
+    bin_path, offsets_path = prefix + BIN_SUFFIX, prefix + OFFSETS_SUFFIX
+    offsets = [0]
+    with open(bin_path + '.tmp', 'wb') as f:
+        for sample in iter_json_samples(source):
+            record = json.dumps(sample, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+            f.write(record)
+            offsets.append(offsets[-1] + len(record))
+    with open(offsets_path + '.tmp', 'wb') as f:
+        np.save(f, np.asarray(offsets, dtype=np.int64))
+    # offsets last: a store whose offsets exist is complete
+    os.replace(bin_path + '.tmp', bin_path)
+    os.replace(offsets_path + '.tmp', offsets_path)
+    return len(offsets) - 1
+
+
+def is_fresh(source, prefix=None):
+    prefix = prefix or store_prefix(source)
+    offsets_path = prefix + OFFSETS_SUFFIX
+    return (os.path.exists(offsets_path) and os.path.exists(prefix + BIN_SUFFIX)
+            and os.stat(offsets_path).st_mtime_ns >= source_mtime(source))
+
+
+class SampleStore:
+    """Read-only sequence of samples backed by a store; safe to create before forking workers."""
+
+    def __init__(self, prefix):
+        self.prefix = str(prefix)
+        self.offsets = np.load(self.prefix + OFFSETS_SUFFIX, mmap_mode='r')
+        self._mm = None
+
+    def _map(self):
+        if self._mm is None:
+            with open(self.prefix + BIN_SUFFIX, 'rb') as f:
+                size = os.fstat(f.fileno()).st_size
+                # mmap refuses empty files; an empty store has nothing to read anyway
+                self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if size else b''
+        return self._mm
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, idx):
+        start, end = int(self.offsets[idx]), int(self.offsets[idx + 1])
+        return self._map()[start:end]
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError(idx)
+        return json.loads(self.raw(idx))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __getstate__(self):
+        # spawned workers re-open the mapping themselves
+        return dict(prefix=self.prefix)
+
+    def __setstate__(self, state):
+        self.__init__(state['prefix'])
+
+
+def cached_array(store, suffix, fn, dtype=np.int64):
+    """
+    np.array of fn(sample) for every sample of `store`, cached as `<prefix><suffix>`
+    and recomputed when the store is rebuilt.
+    """
+    path = store.prefix + suffix
+    if os.path.exists(path) and os.stat(path).st_mtime_ns >= os.stat(store.prefix + OFFSETS_SUFFIX).st_mtime_ns:
+        values = np.load(path)
+        if len(values) == len(store):
+            return values
+    values = np.fromiter((fn(sample) for sample in store), dtype=dtype, count=len(store))
+    with open(path + '.tmp', 'wb') as f:
+        np.save(f, values)
+    os.replace(path + '.tmp', path)
+    return values
+
+
+def open_store(source, prefix=None):
+    """SampleStore for `source`, (re)building it first if missing or older than the source."""
+    prefix = prefix or store_prefix(source)
+    if not is_fresh(source, prefix):
+        n = build_store(source, prefix)
+        print(f'Built sample store {prefix}{BIN_SUFFIX} ({n} samples)')
+    return SampleStore(prefix)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build offset-indexed sample stores from .json / .jsonl / shard indexes.')
+    parser.add_argument('inputs', nargs='+')
+    parser.add_argument('--force', action='store_true', help='rebuild even if up to date')
+    args = parser.parse_args()
+    for path in args.inputs:
+        if not args.force and is_fresh(path):
+            print(f'{path}: up to date')
+            continue
+        n = build_store(path)
+        size = os.path.getsize(store_prefix(path) + BIN_SUFFIX)
+        print(f'{path}: {n} samples, {size / 1e6:.1f} MB')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+import argparse
+from pathlib import Path
+
+# Deterministic work splitting for multi-node preprocessing.
+#
+# Every script that supports sharding takes --num-shards/--shard-index (or
+# reads SLURM_ARRAY_TASK_ID / SLURM_ARRAY_TASK_COUNT inside an array job),
+# keeps only the scenarios whose stable hash falls in its shard, and writes
+# `<output>.shard-00003-of-00008.json` instead of `<output>.json`.
+# `--gather` (or `python sharding.py OUTPUT --num-shards N`) then merges the
+# per-shard files back into the usual single-file output.
+
+
+def add_shard_args(parser):
+    parser.add_argument('--num-shards', type=int, default=None,
+                        help='total shards (default: SLURM_ARRAY_TASK_COUNT or 1)')
+    parser.add_argument('--shard-index', type=int, default=None,
+                        help='shard processed by this run (default: SLURM_ARRAY_TASK_ID or 0)')
+    parser.add_argument('--gather', action='store_true',
+                        help='merge the per-shard outputs into the single-file output and exit')
+    return parser
+
+
+def resolve_shard(args):
+    """(num_shards, shard_index) from the CLI, falling back to the SLURM array environment."""
+    num_shards = args.num_shards
+    if num_shards is None:
+        num_shards = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 1))
+    shard_index = args.shard_index
+    if shard_index is None:
+        task_id = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0))
+        shard_index = task_id - int(os.environ.get('SLURM_ARRAY_TASK_MIN', 0))
+    if num_shards < 1 or not 0 <= shard_index < num_shards:
+        raise ValueError(f'invalid shard {shard_index} of {num_shards}')
+    return num_shards, shard_index
+
+
+def stable_hash(key):
+    # hash() is salted per process; md5 gives the same split on every node
+    return int(hashlib.md5(str(key).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def in_shard(key, num_shards, shard_index):
+    return num_shards == 1 or stable_hash(key) % num_shards == shard_index
+
+
+# directories two levels above the scenario folder (<root>/<split>/<scenario>)
+SCENARIO_ROOTS = ('videos', 'bbox_global', 'bbox_local', 'caption', 'vqa', 'pedestrian', 'vehicle')
+
+
+def scenario_from_video_path(path):
+    """
+    Scenario id of a video, extracted frame or annotation path:
+      data/videos/train/<scenario>/overhead_view/x.mp4            -> <scenario>
+      data/videos/train/normal_trimmed/<scenario>/vehicle_view/x.mp4 -> <scenario>
+      data/external/BDD_PC_5K/videos/train/<video>.mp4           -> <video>
+      data/annotations/caption/train/<scenario>/...              -> <scenario>
+    """
+    parts = Path(path).parts
+    for root in SCENARIO_ROOTS:
+        if root in parts:
+            i = parts.index(root) + 2
+            break
+    else:
+        i = 0
+    if i < len(parts) and parts[i] == 'normal_trimmed':
+        i += 1
+    if i >= len(parts):
+        return str(path)
+    return Path(parts[i]).stem if i == len(parts) - 1 else parts[i]
+
+
+def shard_output_path(path, num_shards, shard_index):
+    if num_shards == 1:
+        return path
+    root, ext = os.path.splitext(str(path))
+    sharded = f'{root}.shard-{shard_index:05d}-of-{num_shards:05d}{ext}'
+    return type(path)(sharded) if isinstance(path, Path) else sharded
+
+
+def gather_json(path, num_shards, sort_key=None):
+    """
+    Merge `<path>.shard-*-of-N` files into `path`. Lists are concatenated
+    (then stably sorted by `sort_key` if given), dicts are merged.
+    """
+    merged = None
+    for shard_index in range(num_shards):
+        shard_path = shard_output_path(path, num_shards, shard_index)
+        if not os.path.exists(shard_path):
+            raise FileNotFoundError(f'missing shard output {shard_path}')
+        with open(shard_path) as f:
+            part = json.load(f)
+        if merged is None:
+            merged = part
+        elif isinstance(merged, list):
+            merged.extend(part)
+        else:
+            merged.update(part)
+    if isinstance(merged, list) and sort_key is not None:
+        merged.sort(key=sort_key)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge per-shard JSON outputs into one file.')
+    parser.add_argument('output', type=str)
+    parser.add_argument('--num-shards', type=int, required=True)
+    parser.add_argument('--sort-by', type=str, default=None, help='field to stably sort list outputs by')
+    parser.add_argument('--indent', type=int, default=2)
+    args = parser.parse_args()
+
+    sort_key = (lambda x: x[args.sort_by]) if args.sort_by else None
+    merged = gather_json(args.output, args.num_shards, sort_key)
+    with open(args.output, 'w') as f:
+        json.dump(merged, f, indent=args.indent)
+    print(f'Gathered {len(merged)} entries from {args.num_shards} shards into {args.output}')
+
+
+if __name__ == '__main__':
+    main()
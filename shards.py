@@ -0,0 +1,187 @@
+import os
+import json
+import hashlib
+import random
+
+# Sharded sample files written by data_preprocess/merge_jsons.py.
+# Layout for prefix `train_all` with 4 shards:
+#   train_all-00000-of-00004.jsonl ... train_all-00003-of-00004.jsonl
+#   train_all.index.json   (shard names + sample counts)
+# Every shard is plain JSONL (one sample per line) so any rank / worker can
+# read its own shards without parsing the others.
+
+INDEX_SUFFIX = '.index.json'
+CHUNK_SIZE = 1 << 20
+
+
+def shard_name(prefix, shard_id, num_shards):
+    return f'{prefix}-{shard_id:05d}-of-{num_shards:05d}.jsonl'
+
+
+def _iter_json_array(f, chunk_size=CHUNK_SIZE):
+    """
+    Yield the elements of a top-level JSON array one by one without loading
+    the whole file (works on our `indent=2` / `indent=4` dumps).
+    """
+    decoder = json.JSONDecoder()
+    buf, pos, eof = '', 0, False
+
+    def fill():
+        nonlocal buf, pos, eof
+        chunk = f.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf = buf[pos:] + chunk
+        pos = 0
+
+    def skip(chars):
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in chars:
+                pos += 1
+            if pos < len(buf) or eof:
+                return
+            fill()
+
+    fill()
+    skip(' \t\r\n')
+    if pos >= len(buf) or buf[pos] != '[':
+        raise ValueError(f'{f.name}: expected a JSON array')
+    pos += 1
+
+    while True:
+        skip(' \t\r\n,')
+        if pos >= len(buf):
+            raise ValueError(f'{f.name}: unterminated JSON array')
+        if buf[pos] == ']':
+            return
+        while True:
+            try:
+                obj, end = decoder.raw_decode(buf, pos)
+                # only a delimiter ends an element: a number cut by the chunk boundary decodes short
+                if eof or (end < len(buf) and buf[end] in ' \t\r\n,]'):
+                    break
+            except json.JSONDecodeError:
+                if eof:
+                    raise
+            fill()
+        pos = end
+        yield obj
+
+
+def iter_json_samples(path):
+    """Stream samples from a `.json` array, a `.jsonl` file or a shard index."""
+    path = str(path)
+    if path.endswith(INDEX_SUFFIX):
+        yield from iter_samples(path)
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        if path.endswith('.jsonl'):
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from _iter_json_array(f)
+
+
+def sample_digest(sample):
+    return hashlib.sha1(json.dumps(sample, sort_keys=True, ensure_ascii=False).encode('utf-8')).digest()
+
+
+def dedup_samples(samples, stats=None):
+    seen = set()
+    for sample in samples:
+        digest = sample_digest(sample)
+        if digest in seen:
+            if stats is not None:
+                stats['duplicates'] = stats.get('duplicates', 0) + 1
+            continue
+        seen.add(digest)
+        yield sample
+
+
+def shuffle_samples(samples, buffer_size, seed=0):
+    """Approximate shuffle with a bounded buffer (memory ~ buffer_size samples)."""
+    rng = random.Random(seed)
+    buffer = []
+    for sample in samples:
+        if len(buffer) < buffer_size:
+            buffer.append(sample)
+            continue
+        j = rng.randrange(buffer_size)
+        yield buffer[j]
+        buffer[j] = sample
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+def write_shards(samples, prefix, num_shards, meta=None):
+    """
+    Round-robin `samples` into `num_shards` JSONL files (shard sizes differ by
+    at most one sample) and write `<prefix>.index.json`. Returns the index.
+    """
+    out_dir = os.path.dirname(prefix)
+    if out_dir:
+        os.makedirs(out_dir, exist_ok=True)
+    base = os.path.basename(prefix)
+    names = [shard_name(base, i, num_shards) for i in range(num_shards)]
+    files = [open(os.path.join(out_dir, name), 'w', encoding='utf-8') for name in names]
+    counts = [0] * num_shards
+    sizes = [0] * num_shards
+    try:
+        for n, sample in enumerate(samples):
+            shard_id = n % num_shards
+            line = json.dumps(sample, ensure_ascii=False) + '\n'
+            files[shard_id].write(line)
+            counts[shard_id] += 1
+            sizes[shard_id] += len(line.encode('utf-8'))
+    finally:
+        for f in files:
+            f.close()
+
+    index = dict(meta or {})
+    index['num_samples'] = sum(counts)
+    index['shards'] = [
+        dict(path=name, num_samples=count, bytes=size)
+        for name, count, size in zip(names, counts, sizes)
+    ]
+    with open(prefix + INDEX_SUFFIX, 'w') as f:
+        json.dump(index, f, indent=2)
+    return index
+
+
+def load_index(index_path):
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def shard_path(index_path, shard):
+    return os.path.join(os.path.dirname(str(index_path)), shard['path'])
+
+
+def assigned_shards(num_shards, rank=0, world_size=1):
+    """Shard ids read by `rank` out of `world_size` readers (strided, deterministic)."""
+    return list(range(rank, num_shards, world_size))
+
+
+def iter_shard(index_path, shard_id, index=None):
+    index = index or load_index(index_path)
+    with open(shard_path(index_path, index['shards'][shard_id]), 'r', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def iter_samples(index_path, rank=0, world_size=1):
+    index = load_index(index_path)
+    for shard_id in assigned_shards(len(index['shards']), rank, world_size):
+        yield from iter_shard(index_path, shard_id, index)
+
+
+def load_samples(path):
+    """Load every sample from a `.json` array, a `.jsonl` file or a shard index."""
+    path = str(path)
+    if path.endswith('.json') and not path.endswith(INDEX_SUFFIX):
+        with open(path) as f:
+            return json.load(f)
+    return list(iter_json_samples(path))
@@ -6,11 +6,19 @@ import os
 from tqdm import tqdm
 from multiprocessing import Pool
 import copy
+import argparse
+import metrics
+from bbox_geometry import boxes_from_dict, crop_rects, interpolate_track
+from frame_pack import PackWriter, pack_path_for
+from lazy_crops import box_or_none, crop_index_path, write_crop_index
+from sharding import add_shard_args, resolve_shard, in_shard, scenario_from_video_path
+from video_meta import VideoCatalog, CATALOG_PATH, HIGH_FPS
 
 # Hardcoded parameters
 ANNO_PATH = 'processed_anno/wts_train_all_video_with_bbox_anno_first_frame.json'
 NUM_PROCESSES = 4
 SCALE = 1.5
+DENSE_STEP = 0          # >0: also crop every DENSE_STEP frames between annotated frames (interpolated boxes)
 
 phase_number_map = {
     '0': 'prerecognition',
@@ -21,117 +29,104 @@ phase_number_map = {
 }
 
 
-def extract_frames(video_path, frame_indices, original_frame_indices):
-    vr = VideoReader(video_path)
-    if frame_indices[-1] == len(vr):
-        frame_indices[-1] = len(vr) - 1
-    frames = {ori_idx: vr[frame_idx].asnumpy() for frame_idx, ori_idx in zip(frame_indices, original_frame_indices)}
+def extract_frames(video_path, frame_indices, original_frame_indices, meta):
+    # annotations may point one past the last frame
+    frame_indices = [meta.clamp(i) for i in frame_indices]
+    with metrics.span('decode'):
+        vr = VideoReader(video_path)
+        frames = {ori_idx: vr[frame_idx].asnumpy() for frame_idx, ori_idx in zip(frame_indices, original_frame_indices)}
+    metrics.count('frames_decoded', len(frames))
     return frames
 
 
-def draw_and_save_bboxes(key, frames, ped_bboxes, veh_bboxes, phase_numbers, phase_number_map):
-    for frame_id, frame_np in frames.items():
-        frame = cv2.cvtColor(frame_np, cv2.COLOR_RGB2BGR)
-        if str(frame_id) in ped_bboxes:
-            bbox = ped_bboxes[str(frame_id)]
-            xmin, ymin, width, height = bbox
-            xmax = xmin + width
-            ymax = ymin + height
-            cv2.rectangle(frame, (int(xmin), int(ymin)), (int(xmax), int(ymax)), color=(0, 255, 0), thickness=4)
-        if str(frame_id) in veh_bboxes:
-            bbox = veh_bboxes[str(frame_id)]
-            xmin, ymin, width, height = bbox
-            xmax = xmin + width
-            ymax = ymin + height
-            cv2.rectangle(frame, (int(xmin), int(ymin)), (int(xmax), int(ymax)), color=(255, 0, 0), thickness=4)
+def save_jpg(file_name, image, pack=None):
+    """
+    Encode `image` as `file_name`, or as the matching member of `pack` (a PackWriter) when packing.
+    """
+    with metrics.span('encode'):
+        ok, buf = cv2.imencode('.jpg', image)
+    if not ok:
+        print(f"Failed to encode: {file_name}")
+        return
+    with metrics.span('write'):
+        if pack is not None:
+            pack.add_file(file_name, buf, height=image.shape[0], width=image.shape[1])
+        else:
+            os.makedirs(os.path.dirname(file_name), exist_ok=True)
+            with open(file_name, 'wb') as f:
+                f.write(buf.tobytes())
+    metrics.count('images_written')
+    metrics.count('bytes_written', len(buf))
 
-        phase_number = phase_numbers.get(str(frame_id), "")
-        if str(phase_number):
-            if 'BDD' in key:
-                file_name = key.replace('.mp4', f'_{phase_number_map[str(phase_number)]}.jpg').replace('/videos', '/bbox_global')
-                dirname = os.path.dirname(file_name)
-                os.makedirs(dirname, exist_ok=True)
-            else:
-                key = key.replace('.mp4', '/').replace('/videos', '/bbox_global')
-                os.makedirs(key, exist_ok=True)
-                file_name = f"{key}{phase_number}_{phase_number_map[str(phase_number)]}.jpg"
 
-            cv2.imwrite(file_name, frame)
+def output_file_name(key, root, phase_number, phase_number_map, frame_suffix=''):
+    """
+    Image written for a phase of video `key` under `root` (bbox_global or bbox_local).
+    Dense (interpolated) frames get a frame-number suffix so they never replace the annotated frame.
+    """
+    phase_name = phase_number_map[str(phase_number)]
+    if 'BDD' in key:
+        return key.replace('.mp4', f'_{phase_name}{frame_suffix}.jpg').replace('/videos', f'/{root}')
+    folder = key.replace('.mp4', '/').replace('/videos', f'/{root}')
+    return f"{folder}{phase_number}_{phase_name}{frame_suffix}.jpg"
 
 
-def enlarge_bbox(bbox, scale=1.2):
-    xmin, ymin, width, height = bbox
-    center_x, center_y = xmin + width / 2, ymin + height / 2
-    new_width = width * scale
-    new_height = height * scale
-    new_xmin = center_x - new_width / 2
-    new_ymin = center_y - new_height / 2
-    return new_xmin, new_ymin, new_width, new_height
+def frame_suffix(frame_id, dense_ids):
+    return f'_{frame_id:06d}' if frame_id in dense_ids else ''
 
 
-def enlarge_bbox_square(bbox, scale=1.2):
+def tight_box(bbox):
+    """Integer xyxy rectangle draw_and_save_bboxes draws for an xywh box."""
     xmin, ymin, width, height = bbox
-    center_x, center_y = xmin + width / 2, ymin + height / 2
-    new_width = width * scale
-    new_height = height * scale
-    new_height, new_width = max(new_width, new_height), max(new_width, new_height)
-    new_xmin = center_x - new_width / 2
-    new_ymin = center_y - new_height / 2
-    return new_xmin, new_ymin, new_width, new_height
+    return int(xmin), int(ymin), int(xmin + width), int(ymin + height)
+
 
+def draw_and_save_bboxes(key, frames, ped_bboxes, veh_bboxes, phase_numbers, phase_number_map, dense_ids=(), pack=None, draw=True):
+    """`draw=False` saves the clean frames (lazy crops draw the boxes at load time, see lazy_crops.py)."""
+    for frame_id, frame_np in frames.items():
+        with metrics.span('draw'):
+            frame = cv2.cvtColor(frame_np, cv2.COLOR_RGB2BGR)
+            if draw and str(frame_id) in ped_bboxes:
+                xmin, ymin, xmax, ymax = tight_box(ped_bboxes[str(frame_id)])
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(0, 255, 0), thickness=4)
+            if draw and str(frame_id) in veh_bboxes:
+                xmin, ymin, xmax, ymax = tight_box(veh_bboxes[str(frame_id)])
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(255, 0, 0), thickness=4)
+
+        phase_number = phase_numbers.get(str(frame_id), "")
+        if str(phase_number):
+            file_name = output_file_name(key, 'bbox_global', phase_number, phase_number_map, frame_suffix(frame_id, dense_ids))
+            save_jpg(file_name, frame, pack)
 
-def calculate_combined_bbox(bbox1, bbox2):
-    xmin = min(bbox1[0], bbox2[0])
-    ymin = min(bbox1[1], bbox2[1])
-    xmax = max(bbox1[0] + bbox1[2], bbox2[0] + bbox2[2])
-    ymax = max(bbox1[1] + bbox1[3], bbox2[1] + bbox2[3])
-    return xmin, ymin, xmax - xmin, ymax - ymin
 
+def draw_and_save_bboxes_scale_version(key, frames, ped_bboxes, veh_bboxes, phase_numbers, phase_number_map, scale=1.5, dense_ids=(), pack=None):
+    if not frames:
+        return
+    frame_ids = list(frames)
+    frame_shape = next(iter(frames.values())).shape
 
-def constrain_bbox_within_frame(bbox, frame_shape):
-    xmin, ymin, xmax, ymax = bbox
-    xmin = max(0, int(xmin))
-    ymin = max(0, int(ymin))
-    xmax = min(frame_shape[1], int(xmax))
-    ymax = min(frame_shape[0], int(ymax))
-    return xmin, ymin, xmax, ymax
+    # enlarge / constrain / combine / square for every frame of the video at once
+    with metrics.span('geometry'):
+        ped_rects, veh_rects, crops = crop_rects(boxes_from_dict(ped_bboxes, frame_ids),
+                                                 boxes_from_dict(veh_bboxes, frame_ids), frame_shape, scale)
 
+    for i, frame_id in enumerate(frame_ids):
+        with metrics.span('draw'):
+            frame = cv2.cvtColor(frames[frame_id], cv2.COLOR_RGB2BGR)
 
-def draw_and_save_bboxes_scale_version(key, frames, ped_bboxes, veh_bboxes, phase_numbers, phase_number_map, scale=1.5):
-    for frame_id, frame_np in frames.items():
-        frame = cv2.cvtColor(frame_np, cv2.COLOR_RGB2BGR)
-        combined_bbox = None
-
-        if str(frame_id) in ped_bboxes:
-            bbox = enlarge_bbox(ped_bboxes[str(frame_id)], scale)
-            xmin, ymin, width, height = bbox
-            xmax = xmin + width
-            ymax = ymin + height
-            xmin, ymin, xmax, ymax = constrain_bbox_within_frame((xmin, ymin, xmax, ymax), frame.shape)
-            combined_bbox = (xmin, ymin, xmax - xmin, ymax - ymin)
-            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(0, 255, 0), thickness=3)
-
-        if str(frame_id) in veh_bboxes:
-            bbox = enlarge_bbox(veh_bboxes[str(frame_id)], scale)
-            xmin, ymin, width, height = bbox
-            xmax = xmin + width
-            ymax = ymin + height
-            xmin, ymin, xmax, ymax = constrain_bbox_within_frame((xmin, ymin, xmax, ymax), frame.shape)
-            if combined_bbox is not None:
-                combined_bbox = calculate_combined_bbox(combined_bbox, (xmin, ymin, xmax - xmin, ymax - ymin))
+            if ped_rects[i, 0] >= 0:
+                xmin, ymin, xmax, ymax = map(int, ped_rects[i])
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(0, 255, 0), thickness=3)
+
+            if veh_rects[i, 0] >= 0:
+                xmin, ymin, xmax, ymax = map(int, veh_rects[i])
+                cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(255, 0, 0), thickness=3)
+
+            if crops[i, 0] >= 0:
+                xmin, ymin, xmax, ymax = map(int, crops[i])
+                cropped_frame = frame[ymin:ymax, xmin:xmax]
             else:
-                combined_bbox = (xmin, ymin, xmax - xmin, ymax - ymin)
-            cv2.rectangle(frame, (xmin, ymin), (xmax, ymax), color=(255, 0, 0), thickness=3)
-
-        if combined_bbox is not None:
-            combined_bbox = enlarge_bbox_square(combined_bbox, scale)
-            xmin, ymin, width, height = combined_bbox
-            xmax, ymax = int(xmin + width), int(ymin + height)
-            xmin, ymin = int(xmin), int(ymin)
-            xmin, ymin, xmax, ymax = constrain_bbox_within_frame((xmin, ymin, xmax, ymax), frame.shape)
-            cropped_frame = frame[ymin:ymax, xmin:xmax]
-        else:
-            cropped_frame = frame
+                cropped_frame = frame
 
         if str(frame_id) in phase_numbers:
             phase_number = phase_numbers[str(frame_id)]
@@ -139,43 +134,137 @@ def draw_and_save_bboxes_scale_version(key, frames, ped_bboxes, veh_bboxes, phas
             phase_number = ''
 
         if str(phase_number):
-            if 'BDD' in key:
-                file_name = key.replace('.mp4', f'_{phase_number_map[str(phase_number)]}.jpg').replace('/videos', '/bbox_local')
-                dirname = os.path.dirname(file_name)
-                os.makedirs(dirname, exist_ok=True)
-            else:
-                key = key.replace('.mp4', '/').replace('/videos', '/bbox_local')
-                os.makedirs(key, exist_ok=True)
-                file_name = f"{key}{phase_number}_{phase_number_map[str(phase_number)]}.jpg"
-
+            file_name = output_file_name(key, 'bbox_local', phase_number, phase_number_map, frame_suffix(frame_id, dense_ids))
             if cropped_frame.size > 0:
-                cv2.imwrite(file_name, cropped_frame)
+                save_jpg(file_name, cropped_frame, pack)
             else:
                 print(f"Empty frame: {file_name}")
 
 
+def save_crop_rects(key, frames, ped_bboxes, veh_bboxes, phase_numbers, phase_number_map, scale=1.5, dense_ids=()):
+    """
+    Lazy-crop counterpart of draw_and_save_bboxes_scale_version: record the
+    boxes both versions draw and the crop rectangle of every clean global
+    frame in a sidecar instead of writing the crop.
+    """
+    if not frames:
+        return
+    frame_ids = list(frames)
+    frame_shape = next(iter(frames.values())).shape
+    with metrics.span('geometry'):
+        ped_rects, veh_rects, crops = crop_rects(boxes_from_dict(ped_bboxes, frame_ids),
+                                                 boxes_from_dict(veh_bboxes, frame_ids), frame_shape, scale)
+
+    entries = dict()
+    for i, frame_id in enumerate(frame_ids):
+        phase_number = phase_numbers.get(str(frame_id), '')
+        if not str(phase_number):
+            continue
+        file_name = output_file_name(key, 'bbox_global', phase_number, phase_number_map, frame_suffix(frame_id, dense_ids))
+        ped, veh = ped_bboxes.get(str(frame_id)), veh_bboxes.get(str(frame_id))
+        entry = {'global': dict(ped=None if ped is None else list(tight_box(ped)),
+                                veh=None if veh is None else list(tight_box(veh))),
+                 'local': dict(ped=box_or_none(ped_rects[i]), veh=box_or_none(veh_rects[i])),
+                 'crop': None}
+        if crops[i, 0] < 0:
+            entry['crop'] = [0, 0, frame_shape[1], frame_shape[0]]
+        elif crops[i, 2] > crops[i, 0] and crops[i, 3] > crops[i, 1]:
+            entry['crop'] = box_or_none(crops[i])
+        else:
+            print(f"Empty frame: {file_name}")
+        entries[file_name] = entry
+    with metrics.span('write'):
+        write_crop_index(crop_index_path(key), entries, scale)
+    metrics.count('crop_rects', sum(e['crop'] is not None for e in entries.values()))
+
+
+def add_dense_frames(data, dense_step):
+    """
+    Extend the sparse annotations of one video with interpolated boxes every
+    `dense_step` frames between its first and last annotated frame. Dense
+    frames take the phase of the preceding annotated frame.
+    Returns (data copy, set of added frame ids).
+    """
+    annotated = sorted(map(int, data["phase_number"].keys()))
+    known = set(annotated)
+    extra = [f for f in range(annotated[0], annotated[-1] + 1, dense_step) if f not in known]
+    if not extra:
+        return data, set()
+
+    data = copy.deepcopy(data)
+    ped = interpolate_track(data["ped_bboxes"], extra)
+    veh = interpolate_track(data["veh_bboxes"], extra)
+    previous = np.searchsorted(annotated, extra, side='right') - 1
+    for i, frame_id in enumerate(extra):
+        if not np.isnan(ped[i, 0]):
+            data["ped_bboxes"][str(frame_id)] = ped[i].tolist()
+        if not np.isnan(veh[i, 0]):
+            data["veh_bboxes"][str(frame_id)] = veh[i].tolist()
+        data["phase_number"][str(frame_id)] = data["phase_number"][str(annotated[previous[i]])]
+    return data, set(extra)
+
+
 def process_video(job_args):
-    video_path, data, phase_number_map, scale = job_args
-    frame_indices = list(map(int, data["phase_number"].keys()))
-    if len(frame_indices) == 0:
+    video_path, data, meta, phase_number_map, scale, dense_step, packed, lazy_crops = job_args
+    if len(data["phase_number"]) == 0:
         return
+    dense_ids = set()
+    if dense_step > 0:
+        data, dense_ids = add_dense_frames(data, dense_step)
+    frame_indices = list(map(int, data["phase_number"].keys()))
     frame_indices_process = copy.deepcopy(frame_indices)
-    if 'fps' in data:
-        if float(data['fps']) > 40.0:
-            for i in range(len(frame_indices)):
-                frame_indices_process[i] = frame_indices_process[i] // 2
-    frames = extract_frames(video_path, frame_indices_process, frame_indices)
-    draw_and_save_bboxes(video_path, frames, data["ped_bboxes"], data["veh_bboxes"], data["phase_number"], phase_number_map)
-    draw_and_save_bboxes_scale_version(video_path, frames, data["ped_bboxes"], data["veh_bboxes"], data["phase_number"], phase_number_map, scale)
+    # only an annotation's own fps decides: the frame ids of the others follow ~30 per second of
+    # annotation time whatever the probed fps, so halving them would pick frames of the wrong moment
+    if float(data.get('fps', 0)) > HIGH_FPS:
+        for i in range(len(frame_indices)):
+            frame_indices_process[i] = frame_indices_process[i] // 2
+    frames = extract_frames(video_path, frame_indices_process, frame_indices, meta)
+    global_pack = PackWriter(pack_path_for(video_path, 'bbox_global')) if packed else None
+    local_pack = PackWriter(pack_path_for(video_path, 'bbox_local')) if packed and not lazy_crops else None
+    draw_and_save_bboxes(video_path, frames, data["ped_bboxes"], data["veh_bboxes"], data["phase_number"], phase_number_map, dense_ids, global_pack,
+                         draw=not lazy_crops)
+    if lazy_crops:
+        save_crop_rects(video_path, frames, data["ped_bboxes"], data["veh_bboxes"], data["phase_number"], phase_number_map, scale, dense_ids)
+    else:
+        draw_and_save_bboxes_scale_version(video_path, frames, data["ped_bboxes"], data["veh_bboxes"], data["phase_number"], phase_number_map, scale, dense_ids, local_pack)
+    if global_pack is not None:
+        global_pack.close()
+    if local_pack is not None:
+        local_pack.close()
 
 
 # ==== MAIN EXECUTION START ====
 if __name__ == '__main__':
-    anno = json.load(open(ANNO_PATH))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--num-processes', type=int, default=NUM_PROCESSES)
+    parser.add_argument('--dense-step', type=int, default=DENSE_STEP,
+                        help='also crop every N frames between annotated frames using interpolated boxes')
+    parser.add_argument('--pack', action='store_true',
+                        help='write one .pack container per video instead of loose JPEGs (see frame_pack.py)')
+    parser.add_argument('--lazy-crops', action='store_true',
+                        help='skip bbox_local; write clean bbox_global frames plus a box / crop sidecar (see lazy_crops.py)')
+    parser.add_argument('--video-meta', default=CATALOG_PATH,
+                        help='video metadata catalog (see video_meta.py)')
+    add_shard_args(parser)
+    cli = parser.parse_args()
+    # output is one image tree per video, shards write disjoint files: nothing to gather
+    num_shards, shard_index = resolve_shard(cli)
+
+    metrics.init('space_om_extract')
+    anno = metrics.load_json(ANNO_PATH)
+
+    videos = [v for v in anno if in_shard(scenario_from_video_path(v), num_shards, shard_index)]
+    catalog = VideoCatalog(cli.video_meta)
+    errors = catalog.probe_all(videos, cli.num_processes)
+    for video_path, error in errors.items():
+        print(f"Failed to probe {video_path}: {error}")
 
-    with Pool(processes=NUM_PROCESSES) as pool:
+    with Pool(processes=cli.num_processes) as pool:
         jobs = []
-        for video_path, data in tqdm(anno.items(), desc="Scheduling jobs"):
-            job = (video_path, data, phase_number_map, SCALE)
+        for video_path in tqdm(videos, desc="Scheduling jobs"):
+            if video_path in errors:
+                continue
+            job = (video_path, anno[video_path], catalog[video_path], phase_number_map, SCALE, cli.dense_step, cli.pack, cli.lazy_crops)
             jobs.append(job)
-        results = list(tqdm(pool.imap(process_video, jobs), total=len(jobs), desc="Processing videos"))
+        results = list(tqdm(metrics.collect(pool.imap(metrics.pooled(process_video), jobs)), total=len(jobs), desc="Processing videos"))
+    metrics.count('videos', len(jobs))
@@ -2,6 +2,9 @@ import os
 import json
 import copy
 import argparse
+import metrics
+from metrics import load_json, path_exists, list_dir
+from sharding import add_shard_args, resolve_shard, in_shard, shard_output_path, gather_json
 
 class Args:
     root = 'data'
@@ -14,6 +17,22 @@ class Args:
 
 args = Args()
 
+parser = argparse.ArgumentParser()
+add_shard_args(parser)
+cli = parser.parse_args()
+num_shards, shard_index = resolve_shard(cli)
+output_path = os.path.join(args.save_folder, f'wts_bdd_{args.split}.json')
+
+if cli.gather:
+    merged = gather_json(output_path, num_shards)
+    with open(output_path, 'w+') as f:
+        f.write(json.dumps(merged, indent=4))
+    print(f'Gathered {len(merged)} samples from {num_shards} shards')
+    raise SystemExit(0)
+
+metrics.init('space_om_format')
+
+
 phrase_number_map = {
     '0': 'prerecognition',
     '1': 'recognition',
@@ -34,14 +53,16 @@ overhead = 'overhead_view'
 vehicle = 'vehicle_view'
 
 # --- Load WTS annotations ---
-for item in os.listdir(wts_anno_path):
+for item in list_dir(wts_anno_path):
+    if not in_shard(item, num_shards, shard_index):
+        continue
     overhead_flag, vehicle_flag = True, True
     try:
-        overhead_view = json.load(open(f'{wts_anno_path}/{item}/{overhead}/{item}_caption.json'))
+        overhead_view = load_json(f'{wts_anno_path}/{item}/{overhead}/{item}_caption.json')
     except:
         overhead_flag = False
     try:
-        vehicle_view = json.load(open(f'{wts_anno_path}/{item}/{vehicle}/{item}_caption.json'))
+        vehicle_view = load_json(f'{wts_anno_path}/{item}/{vehicle}/{item}_caption.json')
     except:
         vehicle_flag = False
     sample_id = item
@@ -184,18 +205,20 @@ for item in os.listdir(wts_anno_path):
 
 # Build camera_path_mapping for global images
 global_image_path = os.path.join(args.wts_global_image_path, args.split)
-for event in os.listdir(global_image_path):
-    if 'normal_trimmed' in event:
+for event in list_dir(global_image_path):
+    if 'normal_trimmed' in event or not in_shard(event, num_shards, shard_index):
         continue
-    for view in os.listdir(os.path.join(global_image_path, event)):
+    for view in list_dir(os.path.join(global_image_path, event)):
         parent_path = os.path.join(global_image_path, event, view)
-        for camera in os.listdir(parent_path):
+        for camera in list_dir(parent_path):
             camera_path_mapping[camera] = os.path.join(parent_path, camera)
 
-for event in os.listdir(os.path.join(global_image_path, 'normal_trimmed')):
-    for view in os.listdir(os.path.join(global_image_path, 'normal_trimmed', event)):
+for event in list_dir(os.path.join(global_image_path, 'normal_trimmed')):
+    if not in_shard(event, num_shards, shard_index):
+        continue
+    for view in list_dir(os.path.join(global_image_path, 'normal_trimmed', event)):
         parent_path = os.path.join(global_image_path, 'normal_trimmed', event, view)
-        for camera in os.listdir(parent_path):
+        for camera in list_dir(parent_path):
             camera_path_mapping[camera] = os.path.join(parent_path, camera)
 
 # Finalize train samples with correct image paths and update conversation images
@@ -211,7 +234,7 @@ for item in train_samples:
 
     if image_key in camera_path_mapping:
         final_image_path = os.path.join(camera_path_mapping[image_key], train_image_name)
-        if os.path.exists(final_image_path):
+        if path_exists(final_image_path):
             # Update top-level image path
             item['image'] = final_image_path.replace('./data/', '')
 
@@ -225,5 +248,7 @@ for item in train_samples:
             reserved_train_samples.append(item)
 
 os.makedirs(args.save_folder, exist_ok=True)
-with open(os.path.join(args.save_folder, f'wts_bdd_{args.split}.json'), 'w+') as f:
-    f.write(json.dumps(reserved_train_samples, indent=4))
+with open(shard_output_path(output_path, num_shards, shard_index), 'w+') as f:
+    with metrics.span('write'):
+        f.write(json.dumps(reserved_train_samples, indent=4))
+metrics.count('samples', len(reserved_train_samples))
@@ -0,0 +1,239 @@
+import re
+import json
+import argparse
+from pathlib import Path
+from collections import defaultdict
+
+import torch
+from tqdm import tqdm
+from transformers import AutoProcessor, Qwen2_5_VLForConditionalGeneration
+
+import metrics
+from frame_pack import FrameResolver
+from token_budget import PlanLog, fit_conversation
+from generation import NO_THINK, generate_tagged, summarize, with_prefill
+from get_best_view import load_view_ranking, prune_sample_views
+
+# Multiple-choice VQA inference with SpaceOm (+ the LoRA adapter from train.py)
+# on the samples written by vqa_space_om.py. Images go through the same
+# token budget as training (token_budget.fit_conversation), so a sample costs
+# the same number of tokens in both.
+#
+#   python spaceom_infer.py --adapter spaceom_lora --limit 100
+#   python spaceom_infer.py --model spaceom_merged --int8     # CPU-only nodes (export_merged.py)
+
+# ========= CONFIG ========= #
+MODEL_ID       = "remyxai/SpaceOm"
+ADAPTER_DIR    = None                           # e.g. "spaceom_lora" (train.py OUTPUT_DIR)
+DATA_JSON      = "vqa_spaceom_val_multiframe.json"
+IMAGE_ROOT     = Path("data/bbox_global/val")   # image paths in DATA_JSON are relative to this
+OUTPUT_JSON    = "predictions_spaceom_val.json"
+MAX_TOKENS     = 1024                           # prompt budget, images are sized to fit
+MAX_NEW_TOKENS = 20
+BATCH_SIZE     = 1
+STOP_AT_ANSWER = True                           # end each row at </answer> (generation.py)
+THINK_BUDGET   = None                           # tokens of <think> before the answer is forced
+SKIP_THINK     = False                          # prefill an empty <think> block and answer directly
+SYSTEM_PROMPT  = (
+    "You are VL-Thinking 🤔, a helpful assistant with excellent reasoning ability."
+    " Answer by choosing the correct letter from the options."
+)
+# ========================== #
+
+CHOICE_RE = re.compile(r"\b([a-d])\b", re.IGNORECASE)
+ANSWER_RE = re.compile(r"<answer>(.*?)(?:</answer>|$)", re.IGNORECASE | re.DOTALL)
+
+
+def quantize_int8(model):
+    """Dynamic int8 quantization of every nn.Linear (weights int8, activations quantized per call). CPU only."""
+    with metrics.span("quantize"):
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def model_megabytes(model):
+    """Size of the weights in MB; counts quantized linears, whose packed weights are not in parameters()."""
+    return sum(t.numel() * t.element_size() for t in model.state_dict().values() if torch.is_tensor(t)) / 1e6
+
+
+def load_model(model_id=MODEL_ID, adapter=ADAPTER_DIR, device=None, merge=False, int8=False):
+    """
+    `model_id` may also be a checkpoint written by export_merged.py. With
+    `merge` the adapter is folded into the base weights after loading;
+    `int8` runs on CPU with dynamically quantized linear layers (implies `merge`).
+    """
+    if int8:
+        device, merge = "cpu", True
+    device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+    dtype = torch.bfloat16 if device.startswith("cuda") else torch.float32
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(model_id, torch_dtype=dtype).to(device)
+    if adapter:
+        from peft import PeftModel
+        model = PeftModel.from_pretrained(model, adapter)
+        if merge:
+            model = model.merge_and_unload()
+    model.eval()
+    if int8:
+        model = quantize_int8(model)
+    processor = AutoProcessor.from_pretrained(model_id, use_fast=True)
+    processor.tokenizer.padding_side = "left"       # generation continues from the right edge
+    return model, processor
+
+
+def user_turn(sample):
+    return next(c for c in sample["conversations"] if c["role"] == "user")
+
+
+def answer_of(sample):
+    turns = [c for c in sample["conversations"] if c["role"] == "assistant"]
+    return turns[0]["content"][0]["text"].strip().lower() if turns else None
+
+
+def load_images(sample, resolver):
+    with metrics.span("decode"):
+        return [resolver.open_image(c["image"]) for c in user_turn(sample)["content"] if c["type"] == "image"]
+
+
+def prompt_messages(sample, system_prompt=SYSTEM_PROMPT):
+    """The sample's own system turn (or `system_prompt`) followed by its first user turn."""
+    messages = [user_turn(sample)]
+    system = next((c for c in sample["conversations"] if c["role"] == "system"), None)
+    if system is None and system_prompt:
+        system = {"role": "system", "content": [{"type": "text", "text": system_prompt}]}
+    if system is not None:
+        messages.insert(0, system)
+    return messages
+
+
+def prepare(processor, sample, images, max_tokens=MAX_TOKENS, system_prompt=SYSTEM_PROMPT):
+    """(prompt text, fitted images, budget plan) for one sample, sized exactly like training."""
+    _, images, text, plan = fit_conversation(
+        processor, prompt_messages(sample, system_prompt), images, max_tokens, add_generation_prompt=True
+    )
+    return text, images, plan
+
+
+def collate(processor, prepared, device):
+    """Batch of prepare() results -> model inputs (left padded)."""
+    texts = [text for text, _, _ in prepared]
+    images = [img for _, imgs, _ in prepared for img in imgs]
+    with metrics.span("processor"):
+        inputs = processor(text=texts, images=images or None, return_tensors="pt", padding=True)
+    return inputs.to(device)
+
+
+@torch.no_grad()
+def generate(model, processor, inputs, max_new_tokens=MAX_NEW_TOKENS, limits=None, **kwargs):
+    """
+    Decoded continuation of every row in the batch. `limits` optionally caps
+    each row at its own number of new tokens (the batch runs to the largest).
+    """
+    if limits:
+        max_new_tokens = max(limits)
+    with metrics.span("generate"):
+        out = model.generate(**inputs, max_new_tokens=max_new_tokens, do_sample=False, **kwargs)
+    new_tokens = out[:, inputs["input_ids"].shape[1]:]
+    metrics.count("generated_tokens", int((new_tokens != processor.tokenizer.pad_token_id).sum()))
+    if limits:
+        new_tokens = [row[:limit] for row, limit in zip(new_tokens, limits)]
+    return processor.batch_decode(new_tokens, skip_special_tokens=True)
+
+
+def extract_choice(text, choices="abcd"):
+    """Choice letter of a response, preferring the <answer> block when there is one."""
+    match = ANSWER_RE.search(text)
+    scope = match.group(1) if match else text
+    for m in CHOICE_RE.finditer(scope):
+        if m.group(1).lower() in choices:
+            return m.group(1).lower()
+    return None
+
+
+def accuracy_report(predictions):
+    per_view = defaultdict(lambda: [0, 0])
+    for p in predictions:
+        per_view[p["view"]][0] += int(p["prediction"] == p["answer"])
+        per_view[p["view"]][1] += 1
+    correct = sum(c for c, _ in per_view.values())
+    total = sum(n for _, n in per_view.values())
+    lines = [f"accuracy {correct}/{total} = {correct / max(total, 1):.4f}"]
+    lines += [f"  {view:<12} {c}/{n} = {c / n:.4f}" for view, (c, n) in sorted(per_view.items())]
+    return "\n".join(lines)
+
+
+def add_inference_args(parser):
+    """Model / generation flags shared with stream_infer.py."""
+    parser.add_argument("--model", type=str, default=MODEL_ID)
+    parser.add_argument("--adapter", type=str, default=ADAPTER_DIR)
+    parser.add_argument("--merge", action="store_true", help="fold the adapter into the base weights after loading")
+    parser.add_argument("--int8", action="store_true", help="CPU inference with dynamic int8 linear layers")
+    parser.add_argument("--output", type=str, default=OUTPUT_JSON)
+    parser.add_argument("--max-tokens", type=int, default=MAX_TOKENS)
+    parser.add_argument("--max-new-tokens", type=int, default=MAX_NEW_TOKENS)
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--think-budget", type=int, default=THINK_BUDGET, help="force the answer after this many thinking tokens")
+    parser.add_argument("--no-think", action="store_true", default=SKIP_THINK, help="skip reasoning, answer directly")
+    parser.add_argument("--no-stop-at-answer", dest="stop_at_answer", action="store_false", default=STOP_AT_ANSWER)
+    parser.add_argument("--limit", type=int, default=None)
+    parser.add_argument("--views-map", type=str, default=None, help="camera ranking from get_best_view.py; prunes multi-camera samples")
+    parser.add_argument("--top-k", type=int, default=1, help="cameras kept per sample with --views-map")
+    parser.add_argument("--token-log", type=str, default=None, help="JSONL of per-sample resolutions / token counts")
+
+
+def batches_from(samples, resolver, batch_size):
+    """(samples, [images per sample]) batches, images decoded on demand."""
+    for start in range(0, len(samples), batch_size):
+        batch = samples[start:start + batch_size]
+        yield batch, [load_images(s, resolver) for s in batch]
+
+
+def run(model, processor, batches, args, total=None):
+    """Predictions and generation report for an iterable of (samples, images) batches."""
+    plan_log = PlanLog(args.token_log)
+    prefill = NO_THINK if args.no_think else ""
+    predictions, report = [], []
+    for batch, images in tqdm(batches, total=total, desc="Inference"):
+        prepared = [prepare(processor, s, imgs, args.max_tokens) for s, imgs in zip(batch, images)]
+        for s, (_, _, plan) in zip(batch, prepared):
+            plan_log.write(s["id"], plan)
+        inputs = collate(processor, with_prefill(prepared, prefill), model.device)
+        responses, rows = generate_tagged(model, processor, inputs, args.max_new_tokens, stop_at_answer=args.stop_at_answer,
+                                          think_budget=args.think_budget, prefill=prefill)
+        report += rows
+        for s, (_, _, plan), response, row in zip(batch, prepared, responses, rows):
+            predictions.append(dict(id=s["id"], view=s["view"], segment=s["segment"],
+                                    prediction=extract_choice(response), answer=answer_of(s),
+                                    response=response, prompt_tokens=plan["total_tokens"],
+                                    generated_tokens=row["generated"]))
+    plan_log.close()
+    return predictions, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multiple-choice VQA inference with SpaceOm.")
+    parser.add_argument("--data", type=str, default=DATA_JSON)
+    parser.add_argument("--image-root", type=Path, default=IMAGE_ROOT)
+    parser.add_argument("--packed", action="store_true", help="also read frames from .pack containers")
+    add_inference_args(parser)
+    args = parser.parse_args()
+
+    metrics.init("spaceom_infer")
+    with open(args.data) as f:
+        samples = json.load(f)[:args.limit]
+    if args.views_map:
+        ranking = load_view_ranking(args.views_map)
+        samples = [prune_sample_views(s, ranking, args.top_k) for s in samples]
+    with metrics.span("model_load"):
+        model, processor = load_model(args.model, args.adapter, merge=args.merge, int8=args.int8)
+    resolver = FrameResolver(args.image_root, packed=args.packed)
+
+    total = -(-len(samples) // args.batch_size)
+    predictions, report = run(model, processor, batches_from(samples, resolver, args.batch_size), args, total)
+
+    with open(args.output, "w") as f:
+        json.dump(predictions, f, indent=2)
+    print(accuracy_report(predictions))
+    print(summarize(report))
+
+
+if __name__ == "__main__":
+    main()
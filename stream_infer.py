@@ -0,0 +1,87 @@
+import os
+import json
+import argparse
+from pathlib import Path
+
+import metrics
+import vqa_space_om
+from video_frames import VideoFrameTree, FramePrefetcher, FRAME_INTERVAL, PREFETCH_BATCHES, CODECS
+from get_best_view import load_view_ranking, prune_sample_views
+from generation import summarize
+from spaceom_infer import add_inference_args, load_model, run, accuracy_report
+
+# VQA inference straight from the val videos: no extract_val.py frames on
+# disk, no JPEG round trip through the file system.
+#
+#   python stream_infer.py --video-root data/videos/val --adapter spaceom_lora
+#
+# The samples are built by vqa_space_om.py over a VideoFrameTree (the frame
+# folders extract_val.py would write, served from the videos), so prompts and
+# image paths match vqa_spaceom_val_multiframe.json exactly; --samples runs
+# any sample file with that layout instead (e.g. captions). Frames are
+# decoded on a prefetch thread while the model runs. With --codec jpeg (the
+# default) every image is pixel-identical to the file-based path.
+
+VIDEO_ROOT = Path("data/videos/val")
+
+
+def build_vqa_samples(vqa_root, tree, view_ranking=None, top_k=None):
+    """
+    vqa_space_om.py samples with `tree` as its frame source, in the same order
+    as its main(). vqa_space_om.py reads its settings from module globals; they
+    are swapped in for the build and restored afterwards.
+    """
+    saved = vqa_space_om.RESOLVER, vqa_space_om.VIEW_RANKING, vqa_space_om.TOP_K_VIEWS
+    vqa_space_om.RESOLVER, vqa_space_om.VIEW_RANKING, vqa_space_om.TOP_K_VIEWS = tree, view_ranking, top_k
+    samples = []
+    try:
+        with metrics.span("build_samples"):
+            for scen in sorted(os.listdir(vqa_root)):
+                if (Path(vqa_root) / scen).is_dir():
+                    vqa_space_om.process_scenario(Path(vqa_root) / scen, scen, samples)
+    finally:
+        vqa_space_om.RESOLVER, vqa_space_om.VIEW_RANKING, vqa_space_om.TOP_K_VIEWS = saved
+    return samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description="VQA inference decoding val frames straight from the videos.")
+    parser.add_argument("--video-root", type=Path, default=VIDEO_ROOT)
+    parser.add_argument("--vqa-root", type=Path, default=vqa_space_om.VQA_ROOT)
+    parser.add_argument("--samples", type=str, default=None, help="sample JSON to run instead of building VQA samples")
+    parser.add_argument("--save-samples", type=str, default=None, help="write the built samples here")
+    parser.add_argument("--interval", type=int, default=FRAME_INTERVAL, help="frame step, as in extract_val.py")
+    parser.add_argument("--codec", choices=CODECS, default="jpeg", help="jpeg: identical to the file path, raw: skip the JPEG round trip")
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_BATCHES, help="batches decoded ahead of the model")
+    add_inference_args(parser)
+    args = parser.parse_args()
+
+    metrics.init("stream_infer")
+    tree = VideoFrameTree(args.video_root, vqa_space_om.BBOX_ROOT, args.interval, args.codec)
+    ranking = load_view_ranking(args.views_map) if args.views_map else None
+    if args.samples:
+        with open(args.samples) as f:
+            samples = json.load(f)
+        if ranking:
+            samples = [prune_sample_views(s, ranking, args.top_k) for s in samples]
+    else:
+        samples = build_vqa_samples(args.vqa_root, tree, ranking, args.top_k)
+    samples = samples[:args.limit]
+    print(f"{len(samples)} samples")
+    if args.save_samples:
+        with open(args.save_samples, "w") as f:
+            json.dump(samples, f, indent=2)
+
+    with metrics.span("model_load"):
+        model, processor = load_model(args.model, args.adapter, merge=args.merge, int8=args.int8)
+    batches = FramePrefetcher(tree, samples, args.batch_size, args.prefetch)
+    predictions, report = run(model, processor, batches, args, total=len(batches))
+
+    with open(args.output, "w") as f:
+        json.dump(predictions, f, indent=2)
+    print(accuracy_report(predictions))
+    print(summarize(report))
+
+
+if __name__ == "__main__":
+    main()
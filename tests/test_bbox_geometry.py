@@ -0,0 +1,150 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from bbox_geometry import (boxes_from_dict, scale_boxes, square_boxes, union_boxes, clip_boxes, xywh_to_xyxy,
+                           crop_rects, interpolate_track, area, iou)
+
+# bbox_geometry.py against the scalar helpers it replaced in
+# space_om_extract.py, copied here verbatim as the reference.
+
+FRAME_SHAPE = (720, 1280, 3)
+
+
+def enlarge_bbox(bbox, scale=1.2):
+    xmin, ymin, width, height = bbox
+    center_x, center_y = xmin + width / 2, ymin + height / 2
+    new_width = width * scale
+    new_height = height * scale
+    new_xmin = center_x - new_width / 2
+    new_ymin = center_y - new_height / 2
+    return new_xmin, new_ymin, new_width, new_height
+
+
+def enlarge_bbox_square(bbox, scale=1.2):
+    xmin, ymin, width, height = bbox
+    center_x, center_y = xmin + width / 2, ymin + height / 2
+    new_width = width * scale
+    new_height = height * scale
+    new_height, new_width = max(new_width, new_height), max(new_width, new_height)
+    new_xmin = center_x - new_width / 2
+    new_ymin = center_y - new_height / 2
+    return new_xmin, new_ymin, new_width, new_height
+
+
+def calculate_combined_bbox(bbox1, bbox2):
+    xmin = min(bbox1[0], bbox2[0])
+    ymin = min(bbox1[1], bbox2[1])
+    xmax = max(bbox1[0] + bbox1[2], bbox2[0] + bbox2[2])
+    ymax = max(bbox1[1] + bbox1[3], bbox2[1] + bbox2[3])
+    return xmin, ymin, xmax - xmin, ymax - ymin
+
+
+def constrain_bbox_within_frame(bbox, frame_shape):
+    xmin, ymin, xmax, ymax = bbox
+    xmin = max(0, int(xmin))
+    ymin = max(0, int(ymin))
+    xmax = min(frame_shape[1], int(xmax))
+    ymax = min(frame_shape[0], int(ymax))
+    return xmin, ymin, xmax, ymax
+
+
+def scalar_crop(ped, veh, frame_shape, scale):
+    """Rectangles the original draw_and_save_bboxes_scale_version drew and cropped for one frame."""
+    rects, combined = [], None
+    for bbox in (ped, veh):
+        if bbox is None:
+            rects.append(None)
+            continue
+        xmin, ymin, width, height = enlarge_bbox(bbox, scale)
+        xmin, ymin, xmax, ymax = constrain_bbox_within_frame((xmin, ymin, xmin + width, ymin + height), frame_shape)
+        rects.append((xmin, ymin, xmax, ymax))
+        box = (xmin, ymin, xmax - xmin, ymax - ymin)
+        combined = box if combined is None else calculate_combined_bbox(combined, box)
+    crop = None
+    if combined is not None:
+        xmin, ymin, width, height = enlarge_bbox_square(combined, scale)
+        xmax, ymax = int(xmin + width), int(ymin + height)
+        crop = constrain_bbox_within_frame((int(xmin), int(ymin), xmax, ymax), frame_shape)
+    return rects[0], rects[1], crop
+
+
+def random_boxes(rng, n):
+    """xywh boxes with fractional coordinates, some hanging over the frame edges."""
+    xy = rng.uniform(-100, 1300, size=(n, 2))
+    wh = rng.uniform(1, 400, size=(n, 2))
+    return np.concatenate([xy, wh], axis=1)
+
+
+@pytest.fixture
+def boxes():
+    return random_boxes(np.random.default_rng(0), 200)
+
+
+@pytest.mark.parametrize('scale', [1.2, 1.5])
+def test_scale_and_square_match_scalar(boxes, scale):
+    np.testing.assert_allclose(scale_boxes(boxes, scale), [enlarge_bbox(b, scale) for b in boxes])
+    np.testing.assert_allclose(square_boxes(boxes, scale), [enlarge_bbox_square(b, scale) for b in boxes])
+
+
+def test_union_matches_scalar(boxes):
+    a, b = boxes[:100], boxes[100:]
+    np.testing.assert_allclose(union_boxes(a, b), [calculate_combined_bbox(x, y) for x, y in zip(a, b)])
+
+
+def test_union_with_missing_box_returns_the_other():
+    box = np.array([[10.0, 20.0, 30.0, 40.0]])
+    missing = np.full((1, 4), np.nan)
+    np.testing.assert_allclose(union_boxes(box, missing), box)
+    np.testing.assert_allclose(union_boxes(missing, box), box)
+
+
+def test_clip_matches_scalar(boxes):
+    xyxy = xywh_to_xyxy(boxes)
+    clipped = clip_boxes(xyxy, FRAME_SHAPE)
+    assert clipped.dtype == np.int64
+    assert clipped.tolist() == [list(constrain_bbox_within_frame(b, FRAME_SHAPE)) for b in xyxy]
+    assert clip_boxes([[np.nan] * 4], FRAME_SHAPE).tolist() == [[-1, -1, -1, -1]]
+
+
+def test_crop_rects_match_scalar(boxes):
+    rng = np.random.default_rng(1)
+    frame_ids = list(range(len(boxes) // 2))
+    # every combination of present / missing pedestrian and vehicle boxes
+    ped = {str(f): boxes[f].tolist() for f in frame_ids if rng.random() < 0.7}
+    veh = {str(f): boxes[100 + f].tolist() for f in frame_ids if rng.random() < 0.7}
+    ped_rect, veh_rect, crop = crop_rects(boxes_from_dict(ped, frame_ids), boxes_from_dict(veh, frame_ids),
+                                          FRAME_SHAPE, 1.5)
+    for i, f in enumerate(frame_ids):
+        p, v, c = scalar_crop(ped.get(str(f)), veh.get(str(f)), FRAME_SHAPE, 1.5)
+        assert ped_rect[i].tolist() == (list(p) if p else [-1] * 4)
+        assert veh_rect[i].tolist() == (list(v) if v else [-1] * 4)
+        assert crop[i].tolist() == (list(c) if c else [-1] * 4)
+
+
+def test_area_and_iou():
+    a = np.array([[0, 0, 10, 10], [5, 5, 10, 10]], dtype=float)
+    np.testing.assert_allclose(area(a), [100, 100])
+    np.testing.assert_allclose(iou(a, a), [[1, 25 / 175], [25 / 175, 1]])
+    np.testing.assert_allclose(iou(a, [[100, 100, 5, 5]]), [[0], [0]])
+
+
+def test_interpolate_track_inside_and_outside_range():
+    track = {'10': [0, 0, 10, 10], '20': [10, 20, 30, 40], '40': [10, 20, 30, 40]}
+    out = interpolate_track(track, [5, 10, 15, 20, 30, 40, 41, 100])
+    assert np.isnan(out[0]).all()
+    np.testing.assert_allclose(out[1], [0, 0, 10, 10])
+    np.testing.assert_allclose(out[2], [5, 10, 20, 25])
+    np.testing.assert_allclose(out[3:6], [[10, 20, 30, 40]] * 3)
+    assert np.isnan(out[6:]).all()
+
+
+def test_interpolate_track_empty_and_single():
+    assert np.isnan(interpolate_track({}, [1, 2])).all()
+    out = interpolate_track({'7': [1, 2, 3, 4]}, [6, 7, 8])
+    assert np.isnan(out[[0, 2]]).all()
+    np.testing.assert_allclose(out[1], [1, 2, 3, 4])
@@ -0,0 +1,77 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from frame_pack import PackWriter, PackReader, FrameResolver, read_index, pack_path_for, MAGIC
+
+# Write -> read round trips of the .pack container and FrameResolver over
+# packed and loose frames.
+
+
+def jpeg(value):
+    return cv2.imencode('.jpg', np.full((8, 8, 3), value, np.uint8))[1]
+
+
+def test_pack_round_trip(tmp_path):
+    path = tmp_path / 'cam.pack'
+    data = {'cam/0_prerecognition.jpg': b'first', 'cam/1_recognition.jpg': b'', 'cam/2_judgement.jpg': bytes(range(256))}
+    with PackWriter(path) as writer:
+        for name, blob in data.items():
+            writer.add(name, blob, height=1, width=2)
+        writer.add('cam/0_prerecognition.jpg', b'newest')       # a repeated name keeps the newest bytes
+    assert not os.path.exists(str(path) + '.tmp')
+    members = read_index(path)
+    assert members['cam/2_judgement.jpg']['height'] == 1 and members['cam/2_judgement.jpg']['width'] == 2
+    reader = PackReader(path)
+    assert sorted(reader.names()) == sorted(data)
+    assert bytes(reader.read('cam/0_prerecognition.jpg')) == b'newest'
+    for name in ('cam/1_recognition.jpg', 'cam/2_judgement.jpg'):
+        assert bytes(reader.read(name)) == data[name]
+    reader.close()
+
+
+def test_empty_writer_writes_nothing(tmp_path):
+    PackWriter(tmp_path / 'empty.pack').close()
+    assert os.listdir(tmp_path) == []
+
+
+@pytest.mark.parametrize('content', [b'', b'short', b'x' * 64, b'x' * 64 + MAGIC[:-1] + b'2'])
+def test_read_index_rejects_non_packs(tmp_path, content):
+    path = tmp_path / 'bad.pack'
+    path.write_bytes(content)
+    with pytest.raises(ValueError):
+        read_index(path)
+
+
+def test_resolver_serves_packed_and_loose_frames(tmp_path):
+    key = 'data/videos/train/s1/overhead_view/cam.mp4'
+    pack = tmp_path / pack_path_for(key, 'bbox_global')
+    folder = str(pack)[:-len('.pack')]
+    with PackWriter(pack) as writer:
+        writer.add_file(os.path.join(folder, '0_prerecognition.jpg'), jpeg(10))
+        writer.add_file(os.path.join(folder, '1_recognition.jpg'), jpeg(20))
+    # a loose file wins over the packed member of the same name
+    os.makedirs(folder)
+    with open(os.path.join(folder, '1_recognition.jpg'), 'wb') as f:
+        f.write(jpeg(200).tobytes())
+
+    sub = 'train/s1/overhead_view/cam'
+    resolver = FrameResolver(tmp_path / 'data/bbox_global', packed=True)
+    assert resolver.listdir(sub) == ['0_prerecognition.jpg', '1_recognition.jpg']
+    assert resolver.isdir('train/s1') and resolver.subdirs('train/s1/overhead_view') == ['cam']
+    assert resolver.exists(f'{sub}/0_prerecognition.jpg') and not resolver.exists(f'{sub}/9.jpg')
+    assert bytes(resolver.read_bytes(f'{sub}/0_prerecognition.jpg')) == jpeg(10).tobytes()
+    assert resolver.imread(f'{sub}/1_recognition.jpg').mean() > 150
+    assert len(resolver.signature(f'{sub}/0_prerecognition.jpg')) == 3
+    assert len(resolver.signature(f'{sub}/1_recognition.jpg')) == 2
+    with pytest.raises(FileNotFoundError):
+        resolver.read_bytes(f'{sub}/9.jpg')
+
+    loose_only = FrameResolver(tmp_path / 'data/bbox_global')
+    assert loose_only.listdir(sub) == ['1_recognition.jpg']
+    assert not loose_only.exists(f'{sub}/0_prerecognition.jpg')
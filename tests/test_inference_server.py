@@ -0,0 +1,155 @@
+import os
+import sys
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("transformers")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from PIL import Image
+
+from frame_pack import FrameResolver
+from model_registry import BACKBONES
+from spaceom_infer import load_model
+from inference_server import Engine, Handler
+
+# CPU test of inference_server.py with the tiny Qwen2.5-VL stand-in
+# (model_registry.py "tiny-qwen"): batching under --batch-tokens, NDJSON
+# event order, /metrics fields and 400s for bad requests.
+#
+#   python -m pytest -q tests/test_inference_server.py
+#
+# Skipped when torch / transformers are missing or the model cannot be
+# downloaded.
+
+NEW_TOKENS = 4
+METRIC_KEYS = {"uptime_s", "queue_depth", "in_flight", "requests", "completed", "failed", "batches",
+               "mean_batch_size", "prompt_tokens_per_s", "generated_tokens_per_s", "queue_wait_s", "latency_s"}
+
+
+def sample(id, image="a.jpg"):
+    return dict(id=id, max_new_tokens=NEW_TOKENS, conversations=[dict(role="user", content=[
+        dict(type="image", image=image),
+        dict(type="text", text="Which object is closer to the camera?\na: the box\nb: the forklift"),
+    ])])
+
+
+@pytest.fixture(scope="module")
+def server(tmp_path_factory):
+    try:
+        model, processor = load_model(BACKBONES["tiny-qwen"]["model_id"], None, device="cpu")
+    except OSError as e:           # offline / not in the hub cache
+        pytest.skip(f"tiny model unavailable: {e}")
+    root = tmp_path_factory.mktemp("images")
+    Image.new("RGB", (56, 56), (200, 30, 30)).save(root / "a.jpg")
+    (root / "corrupt.jpg").write_bytes(b"not a jpeg")
+
+    engine = Engine(model, processor, FrameResolver(root), max_batch=8, max_wait_ms=1000)
+    # room for exactly two requests per batch
+    engine.batch_tokens = 2 * engine.prepare_request(sample("probe")).tokens
+    Handler.engine = engine
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    yield engine, f"http://127.0.0.1:{httpd.server_address[1]}"
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def post(url, body):
+    request = urllib.request.Request(url, data=json.dumps(body).encode("utf-8"),
+                                     headers={"Content-Type": "application/json"})
+    with urllib.request.urlopen(request, timeout=300) as response:
+        return [json.loads(line) for line in response.read().decode("utf-8").splitlines() if line]
+
+
+def post_error(url, body):
+    with pytest.raises(urllib.error.HTTPError) as e:
+        post(url, body)
+    return e.value.code, json.loads(e.value.read())
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=30) as response:
+        return json.loads(response.read())
+
+
+def test_concurrent_requests_are_batched_under_batch_tokens(server):
+    engine, url = server
+    before = get(f"{url}/metrics")
+    streams = dict()
+
+    def run(i):
+        streams[i] = post(f"{url}/v1/generate", sample(f"c{i}"))
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    results = []
+    for i, events in streams.items():
+        assert [e["event"] for e in events] == ["queued", "result"]
+        assert all(e["id"] == f"c{i}" for e in events)
+        results.append(events[1])
+    request_tokens = results[0]["prompt_tokens"] + NEW_TOKENS
+    assert all(r["batch_size"] * request_tokens <= engine.batch_tokens for r in results)
+    assert max(r["batch_size"] for r in results) == 2
+    assert all(0 < r["generated_tokens"] <= NEW_TOKENS for r in results)
+
+    after = get(f"{url}/metrics")
+    assert after["requests"] - before["requests"] == 4
+    assert after["completed"] - before["completed"] == 4
+    assert after["batches"] - before["batches"] == 2
+
+
+def test_batch_streams_queued_before_result(server):
+    _, url = server
+    events = post(f"{url}/v1/batch", dict(requests=[sample(f"b{i}") for i in range(3)]))
+    assert len(events) == 6
+    for i in range(3):
+        assert [e["event"] for e in events if e["id"] == f"b{i}"] == ["queued", "result"]
+
+
+def test_metrics_fields(server):
+    _, url = server
+    m = get(f"{url}/metrics")
+    assert set(m) == METRIC_KEYS
+    assert set(m["queue_wait_s"]) == set(m["latency_s"]) == {"p50", "p90", "p99"}
+    assert m["queue_depth"] == 0 and m["in_flight"] == 0 and m["failed"] == 0
+    assert m["completed"] == m["requests"]
+
+
+def test_corrupt_image_is_a_bad_request(server):
+    engine, url = server
+    code, body = post_error(f"{url}/v1/generate", sample("bad", image="corrupt.jpg"))
+    assert code == 400 and "bad request" in body["error"]
+    code, _ = post_error(f"{url}/v1/generate", sample("missing", image="missing.jpg"))
+    assert code == 400
+
+
+def test_batch_with_a_bad_payload_queues_nothing(server):
+    engine, url = server
+    before = get(f"{url}/metrics")["requests"]
+    code, _ = post_error(f"{url}/v1/batch", dict(requests=[sample("ok"), sample("bad", image="corrupt.jpg")]))
+    assert code == 400
+    assert engine.queue.qsize() == 0 and engine.pending is None
+    assert get(f"{url}/metrics")["requests"] == before
+
+
+@pytest.mark.parametrize("path, body", [("/v1/batch", [1, 2]), ("/v1/batch", "x"), ("/v1/batch", 3),
+                                        ("/v1/batch", dict(requests="x")), ("/v1/batch", dict(requests=[1])),
+                                        ("/v1/generate", [sample("list")])])
+def test_malformed_body_is_a_bad_request(server, path, body):
+    _, url = server
+    before = get(f"{url}/metrics")["requests"]
+    code, body = post_error(f"{url}{path}", body)
+    assert code == 400 and "bad request" in body["error"]
+    assert get(f"{url}/metrics")["requests"] == before
@@ -0,0 +1,70 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+from PIL import Image
+
+pytest.importorskip("decord")          # imported by space_om_extract.py
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+import space_om_extract
+from lazy_crops import CropResolver
+
+# Lazy crops (space_om_extract --lazy-crops + CropResolver) against the
+# images the eager path writes. Frames are saved losslessly here, so both
+# views must match bbox_global / bbox_local pixel for pixel.
+
+KEY = 'data/videos/train/s1/overhead_view/cam.mp4'
+PED = {'10': [100.3, 80.7, 40.2, 90.1], '20': [600, 300, 50, 80]}
+VEH = {'10': [300.5, 100, 120, 60], '30': [5, 5, 30, 20]}
+PHASES = {'10': 0, '20': 1, '30': 2, '40': 3}
+NAMES = ['0_prerecognition.jpg', '1_recognition.jpg', '2_judgement.jpg', '3_action.jpg']
+
+
+def save_png(file_name, image, pack=None):
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(file_name, 'wb') as f:
+        f.write(cv2.imencode('.png', image)[1].tobytes())
+
+
+@pytest.fixture
+def trees(tmp_path, monkeypatch):
+    monkeypatch.setattr(space_om_extract, 'save_jpg', save_png)
+    y, x = np.mgrid[0:360, 0:640]
+    frame = np.stack([x * 255 // 640, y * 255 // 360, (x + y) % 256], -1).astype(np.uint8)
+    frames = {int(f): frame.copy() for f in PHASES}
+    args = (KEY, frames, PED, VEH, PHASES, space_om_extract.phase_number_map)
+
+    monkeypatch.chdir(tmp_path)
+    os.makedirs('eager')
+    os.makedirs('lazy')
+    os.chdir('eager')
+    space_om_extract.draw_and_save_bboxes(*args)
+    space_om_extract.draw_and_save_bboxes_scale_version(*args, scale=1.5)
+    os.chdir('../lazy')
+    space_om_extract.draw_and_save_bboxes(*args, draw=False)
+    space_om_extract.save_crop_rects(*args, scale=1.5)
+    os.chdir('..')
+    return tmp_path
+
+
+@pytest.mark.parametrize('view, eager_root', [('global', 'bbox_global'), ('local', 'bbox_local')])
+def test_views_match_eager_images(trees, view, eager_root):
+    resolver = CropResolver(trees / 'lazy/data/bbox_global', view=view)
+    for name in NAMES:
+        rel = f'train/s1/overhead_view/cam/{name}'
+        eager = np.asarray(Image.open(trees / 'eager/data' / eager_root / rel).convert('RGB'))
+        lazy = np.asarray(resolver.open_image(trees / 'lazy/data/bbox_global' / rel))
+        assert lazy.shape == eager.shape
+        assert np.array_equal(lazy, eager), name
+
+
+def test_crop_rect_only_in_local_view(trees):
+    path = trees / 'lazy/data/bbox_global/train/s1/overhead_view/cam/1_recognition.jpg'
+    assert CropResolver(trees / 'lazy/data/bbox_global', view='global').crop_rect(path) is None
+    x0, y0, x1, y1 = CropResolver(trees / 'lazy/data/bbox_global', view='local').crop_rect(path)
+    assert (y1 - y0, x1 - x0) == np.asarray(Image.open(
+        trees / 'eager/data/bbox_local/train/s1/overhead_view/cam/1_recognition.jpg')).shape[:2]
@@ -0,0 +1,110 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+torch = pytest.importorskip("torch")
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from packing import IGNORE_INDEX, assistant_labels, pack_indices, block_causal_mask, PackingCollator
+
+# CPU tests of the packing maths: bin limits, no attention across packed
+# samples, and which tokens get labels.
+
+START, ASSISTANT, NEWLINE, END, USER, PAD = 1, 2, 3, 4, 5, 0
+
+
+class Tokenizer:
+    """Just enough of a tokenizer for assistant_labels: "<|im_start|>assistant\\n" is [1, 2, 3], <|im_end|> is 4."""
+
+    def __call__(self, text, add_special_tokens=False):
+        assert text == "<|im_start|>assistant\n"
+        return dict(input_ids=[START, ASSISTANT, NEWLINE])
+
+    def convert_tokens_to_ids(self, token):
+        assert token == "<|im_end|>"
+        return END
+
+
+def labelled(ids):
+    ids = torch.tensor(ids)
+    labels = assistant_labels(ids, Tokenizer())
+    return [int(t) if l != IGNORE_INDEX else None for t, l in zip(ids.tolist(), labels.tolist())]
+
+
+def test_only_assistant_replies_are_labelled():
+    system = [START, 9, NEWLINE, 10, 11, END, NEWLINE]
+    user = [START, USER, NEWLINE, 12, 13, END, NEWLINE]
+    reply = [START, ASSISTANT, NEWLINE, 20, 21, END]
+    ids = system + user + reply + [NEWLINE] + user + reply + [PAD, PAD, PAD]
+    out = labelled(ids)
+    expected = [None] * len(ids)
+    for start in (len(system + user) + 3, len(system + user + reply) + 1 + len(user) + 3):
+        expected[start:start + 3] = [20, 21, END]
+    assert out == expected
+
+
+def test_unterminated_reply_is_not_labelled():
+    user = [START, USER, NEWLINE, 12, END, NEWLINE]
+    assert labelled(user + [START, ASSISTANT, NEWLINE]) == [None] * 9          # generation prompt
+    assert labelled(user + [START, ASSISTANT, NEWLINE, 20, 21]) == [None] * 11   # truncated reply
+
+
+def test_pack_indices_respects_budget():
+    rng = np.random.default_rng(0)
+    lengths = rng.integers(10, 400, size=500).tolist() + [1000, 2500]
+    budget = 1024
+    packs = pack_indices(lengths, budget, seed=1, chunk=128)
+    flat = sorted(i for pack in packs for i in pack)
+    assert flat == list(range(len(lengths)))
+    for pack in packs:
+        assert sum(min(lengths[i], budget) for i in pack) <= budget
+        if any(lengths[i] > budget for i in pack):
+            assert len(pack) == 1
+    assert len(packs) < len(lengths) / 2
+    assert pack_indices(lengths, budget, seed=1, chunk=128) == packs
+
+
+def test_pack_indices_stays_within_chunks():
+    lengths = [1] * 10
+    packs = pack_indices(lengths, 100, seed=0, chunk=4)
+    assert sorted(len(p) for p in packs) == [2, 4, 4]
+
+
+def test_block_causal_mask_isolates_segments():
+    segments = torch.tensor([[0, 0, 0, 1, 1, -1, -1],
+                             [0, 1, 1, 1, 2, 2, 2]])
+    mask = block_causal_mask(segments, torch.float32)
+    assert mask.shape == (2, 1, 7, 7)
+    allowed = (mask[:, 0] == 0).tolist()
+    for b in range(2):
+        seg = segments[b].tolist()
+        for i in range(7):
+            for j in range(7):
+                expected = i == j or (j <= i and seg[i] == seg[j] and seg[i] >= 0)
+                assert allowed[b][i][j] == expected, (b, i, j)
+    assert (mask[mask != 0] == torch.finfo(torch.float32).min).all()
+
+
+def test_collator_pads_labels_and_restarts_positions():
+    def rope_index(input_ids, image_grid_thw=None, attention_mask=None):
+        n = input_ids.shape[1]
+        return torch.arange(n).expand(3, 1, n), None
+
+    def sample(ids, labels):
+        return dict(input_ids=torch.tensor(ids), labels=torch.tensor(labels))
+
+    a = sample([7, 8, 9], [IGNORE_INDEX, 8, 9])
+    b = sample([5, 6], [IGNORE_INDEX, 6])
+    c = sample([4], [IGNORE_INDEX])
+    out = PackingCollator(PAD, rope_index)([[a, b], [c]])
+    assert out["input_ids"].tolist() == [[7, 8, 9, 5, 6], [4, PAD, PAD, PAD, PAD]]
+    assert out["labels"].tolist() == [[IGNORE_INDEX, 8, 9, IGNORE_INDEX, 6], [IGNORE_INDEX] * 5]
+    assert out["position_ids"][:, 0].tolist() == [[0, 1, 2, 0, 1]] * 3
+    assert out["position_ids"][:, 1, 0].tolist() == [0, 0, 0]
+    allowed = out["attention_mask"][0, 0] == 0
+    assert not allowed[3:, :3].any()                  # the second sample never sees the first
+    assert allowed[4, 3] and allowed[2, 0]
+    assert "pixel_values" not in out
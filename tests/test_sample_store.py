@@ -0,0 +1,115 @@
+import os
+import sys
+import json
+import pickle
+
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from shards import write_shards, INDEX_SUFFIX
+from sample_store import BIN_SUFFIX, OFFSETS_SUFFIX, build_store, cached_array, is_fresh, open_store, store_prefix
+
+# Write -> read round trips of sample_store.py and its rebuild when the
+# source is newer than the store.
+
+
+def make_samples(n, tag='v1'):
+    return [dict(id=i, tag=tag, text=f'sample {i} é') for i in range(n)]
+
+
+def touch_later(path, than):
+    """Give `path` an mtime newer than `than` (some file systems have coarse timestamps)."""
+    later = os.stat(than).st_mtime_ns + 10 ** 9
+    os.utime(path, ns=(later, later))
+
+
+@pytest.mark.parametrize('kind', ['json', 'jsonl', 'index'])
+def test_store_round_trip(tmp_path, kind):
+    samples = make_samples(12)
+    if kind == 'json':
+        source = tmp_path / 'train.json'
+        source.write_text(json.dumps(samples, indent=2, ensure_ascii=False), encoding='utf-8')
+    elif kind == 'jsonl':
+        source = tmp_path / 'train.jsonl'
+        source.write_text(''.join(json.dumps(s) + '\n' for s in samples), encoding='utf-8')
+    else:
+        write_shards(samples, str(tmp_path / 'train'), 3)
+        source = tmp_path / ('train' + INDEX_SUFFIX)
+    assert store_prefix(source) == str(tmp_path / 'train')
+
+    store = open_store(source)
+    assert len(store) == 12
+    loaded = list(store)
+    key = (lambda s: s['id']) if kind == 'index' else None
+    assert (sorted(loaded, key=key) if key else loaded) == samples
+    assert store[-1] == loaded[-1]
+    with pytest.raises(IndexError):
+        store[12]
+    assert list(pickle.loads(pickle.dumps(store))) == loaded
+
+
+def test_empty_store(tmp_path):
+    source = tmp_path / 'empty.json'
+    source.write_text('[]')
+    store = open_store(source)
+    assert len(store) == 0 and list(store) == []
+
+
+def test_stale_store_is_rebuilt(tmp_path, capsys):
+    source = tmp_path / 'train.jsonl'
+    source.write_text(''.join(json.dumps(s) + '\n' for s in make_samples(3)))
+    open_store(source)
+    prefix = str(tmp_path / 'train')
+    assert is_fresh(source)
+    assert 'Built sample store' in capsys.readouterr().out
+    open_store(source)
+    assert capsys.readouterr().out == ''            # fresh: not rebuilt
+
+    source.write_text(''.join(json.dumps(s) + '\n' for s in make_samples(5, 'v2')))
+    touch_later(source, prefix + OFFSETS_SUFFIX)
+    assert not is_fresh(source)
+    store = open_store(source)
+    assert 'Built sample store' in capsys.readouterr().out
+    assert [s['tag'] for s in store] == ['v2'] * 5
+
+
+def test_stale_shard_rebuilds_index_store(tmp_path):
+    write_shards(make_samples(4), str(tmp_path / 'train'), 2)
+    source = tmp_path / ('train' + INDEX_SUFFIX)
+    open_store(source)
+    shard = tmp_path / 'train-00001-of-00002.jsonl'
+    shard.write_text(json.dumps(dict(id=99, tag='new')) + '\n')
+    touch_later(shard, str(tmp_path / 'train') + OFFSETS_SUFFIX)
+    assert not is_fresh(source)
+    assert sorted(s['id'] for s in open_store(source)) == [0, 2, 99]
+
+
+def test_missing_bin_is_not_fresh(tmp_path):
+    source = tmp_path / 'train.jsonl'
+    source.write_text(json.dumps(dict(id=0)) + '\n')
+    build_store(source)
+    os.remove(str(tmp_path / 'train') + BIN_SUFFIX)
+    assert not is_fresh(source)
+
+
+def test_cached_array_follows_store(tmp_path):
+    source = tmp_path / 'train.jsonl'
+    source.write_text(''.join(json.dumps(s) + '\n' for s in make_samples(4)))
+    store = open_store(source)
+    calls = []
+
+    def length(sample):
+        calls.append(sample['id'])
+        return len(sample['text'])
+
+    first = cached_array(store, '.lengths.npy', length)
+    assert first.tolist() == [len(s['text']) for s in make_samples(4)]
+    assert np.array_equal(cached_array(store, '.lengths.npy', length), first) and len(calls) == 4
+
+    source.write_text(''.join(json.dumps(s) + '\n' for s in make_samples(6)))
+    touch_later(source, str(tmp_path / 'train') + OFFSETS_SUFFIX)
+    store = open_store(source)
+    touch_later(str(tmp_path / 'train') + OFFSETS_SUFFIX, str(tmp_path / 'train.lengths.npy'))
+    assert len(cached_array(store, '.lengths.npy', length)) == 6 and len(calls) == 10
@@ -0,0 +1,92 @@
+import io
+import os
+import sys
+import json
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from shards import (INDEX_SUFFIX, _iter_json_array, iter_json_samples, dedup_samples, shuffle_samples, write_shards,
+                    load_index, load_samples, iter_samples, assigned_shards)
+
+# Streaming reads, shard round-trips and dedup of shards.py.
+
+
+def make_samples(n):
+    return [dict(id=i, conversations=[dict(role='user', content=[dict(type='text', text=f'q{i} é ]"[{{')])])
+            for i in range(n)]
+
+
+def named(text):
+    f = io.StringIO(text)
+    f.name = '<test>'
+    return f
+
+
+@pytest.mark.parametrize('indent', [None, 2, 4])
+@pytest.mark.parametrize('chunk_size', [1, 7, 64, 1 << 20])
+def test_iter_json_array_across_chunks(indent, chunk_size):
+    samples = make_samples(25) + [[], {}, 'x', 3.5, None]
+    text = json.dumps(samples, indent=indent, ensure_ascii=False)
+    assert list(_iter_json_array(named(text), chunk_size)) == samples
+
+
+@pytest.mark.parametrize('text', ['[]', '  [ \n ]\n', '\n[\n]'])
+def test_iter_json_array_empty(text):
+    assert list(_iter_json_array(named(text), 1)) == []
+
+
+@pytest.mark.parametrize('text', ['{"a": 1}', '', '[1, 2', '[{"a": 1}, {"b": '])
+def test_iter_json_array_rejects_bad_input(text):
+    with pytest.raises(ValueError):       # json.JSONDecodeError is a ValueError
+        list(_iter_json_array(named(text), 3))
+
+
+@pytest.mark.parametrize('num_shards', [1, 3, 8])
+def test_write_shards_round_trip(tmp_path, num_shards):
+    samples = make_samples(20)
+    prefix = str(tmp_path / 'out' / 'train_all')
+    index = write_shards(samples, prefix, num_shards, meta=dict(seed=0))
+    assert index == load_index(prefix + INDEX_SUFFIX)
+    assert index['seed'] == 0 and index['num_samples'] == 20
+    counts = [s['num_samples'] for s in index['shards']]
+    assert sum(counts) == 20 and max(counts) - min(counts) <= 1
+    for shard in index['shards']:
+        assert os.path.getsize(tmp_path / 'out' / shard['path']) == shard['bytes']
+
+    loaded = load_samples(prefix + INDEX_SUFFIX)
+    assert sorted(loaded, key=lambda s: s['id']) == samples
+    # readers split the shards between them without overlap
+    world = 2
+    parts = [list(iter_samples(prefix + INDEX_SUFFIX, rank, world)) for rank in range(world)]
+    assert sorted(sum(parts, []), key=lambda s: s['id']) == samples
+    assert sorted(sum((assigned_shards(num_shards, r, world) for r in range(world)), [])) == list(range(num_shards))
+
+
+def test_load_samples_json_and_jsonl(tmp_path):
+    samples = make_samples(5)
+    (tmp_path / 'a.json').write_text(json.dumps(samples, indent=2))
+    (tmp_path / 'a.jsonl').write_text(''.join(json.dumps(s) + '\n\n' for s in samples))
+    assert load_samples(tmp_path / 'a.json') == samples
+    assert load_samples(tmp_path / 'a.jsonl') == samples
+    assert list(iter_json_samples(tmp_path / 'a.json')) == samples
+
+
+def test_dedup_samples():
+    samples = make_samples(4)
+    # same content with keys in another order is a duplicate
+    reordered = dict(conversations=samples[1]['conversations'], id=1)
+    stats = dict()
+    out = list(dedup_samples(samples + [reordered, samples[0], dict(samples[2], id=99)], stats))
+    assert out == samples + [dict(samples[2], id=99)]
+    assert stats == dict(duplicates=2)
+    assert list(dedup_samples([])) == []
+
+
+def test_shuffle_samples_is_a_seeded_permutation():
+    samples = list(range(100))
+    first = list(shuffle_samples(samples, 10, seed=3))
+    assert sorted(first) == samples and first != samples
+    assert list(shuffle_samples(samples, 10, seed=3)) == first
+    assert list(shuffle_samples(samples[:5], 10)) != [] and sorted(shuffle_samples(samples[:5], 10)) == samples[:5]
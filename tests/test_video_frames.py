@@ -0,0 +1,78 @@
+import os
+import sys
+
+import cv2
+import numpy as np
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+from extract_val import extract_frames_from_video
+from video_frames import VideoFrameTree
+
+# VideoFrameTree against the files extract_val.py writes for a synthetic
+# video, including catalogs whose frame count is wrong.
+
+FRAMES = 400
+INTERVAL = 150
+
+
+@pytest.fixture
+def video_tree(tmp_path):
+    video_root = tmp_path / 'videos'
+    video = video_root / 'scene' / 'cam.mp4'
+    video.parent.mkdir(parents=True)
+    writer = cv2.VideoWriter(str(video), cv2.VideoWriter_fourcc(*'mp4v'), 30, (64, 48))
+    if not writer.isOpened():
+        pytest.skip('no mp4v encoder')
+    for i in range(FRAMES):
+        frame = np.zeros((48, 64, 3), np.uint8)
+        frame[:, :, 0] = i % 256
+        frame[:, i % 64] = 255
+        writer.write(frame)
+    writer.release()
+    out_root = tmp_path / 'bbox_global'
+    extract_frames_from_video(video, out_root / 'scene' / 'cam', frame_interval=INTERVAL)
+    return video, video_root, out_root, tmp_path / 'video_meta.json'
+
+
+def tree_with_count(video_tree, frame_count=None):
+    video, video_root, out_root, catalog_path = video_tree
+    tree = VideoFrameTree(video_root, out_root, interval=INTERVAL, catalog_path=str(catalog_path))
+    if frame_count is not None:
+        tree.catalog.probe_all([str(video)])
+        tree.catalog.videos[tree.catalog.key(video)]['frame_count'] = frame_count
+    return tree
+
+
+@pytest.mark.parametrize('frame_count', [None, FRAMES + 2 * INTERVAL, FRAMES - 2 * INTERVAL, 0])
+def test_tree_matches_extract_val(video_tree, frame_count):
+    _, _, out_root, _ = video_tree
+    tree = tree_with_count(video_tree, frame_count)
+    folder = out_root / 'scene' / 'cam'
+    names = sorted(os.listdir(folder))
+    assert len(names) == -(-FRAMES // INTERVAL)
+    assert tree.listdir(folder) == names
+    for name in names:
+        assert tree.read_bytes(folder / name) == (folder / name).read_bytes()
+    assert not tree.exists(folder / f'{len(names):05d}.jpg')
+
+
+def test_jpeg_codec_images_match_files(video_tree):
+    from PIL import Image
+    _, _, out_root, _ = video_tree
+    tree = tree_with_count(video_tree, FRAMES + 2 * INTERVAL)
+    folder = out_root / 'scene' / 'cam'
+    paths = [folder / name for name in tree.listdir(folder)]
+    images = tree.load(paths)
+    for p in paths:
+        assert np.array_equal(np.asarray(images[p]), np.asarray(Image.open(p).convert('RGB')))
+
+
+def test_extract_val_raises_when_encoding_fails(video_tree, monkeypatch, tmp_path):
+    import extract_val
+    video = video_tree[0]
+    monkeypatch.setattr(extract_val.cv2, 'imencode', lambda ext, frame: (False, np.zeros(0, np.uint8)))
+    with pytest.raises(ValueError):
+        extract_frames_from_video(video, tmp_path / 'failed', frame_interval=INTERVAL)
+    assert not any((tmp_path / 'failed').iterdir())
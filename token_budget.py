@@ -0,0 +1,198 @@
+import math
+import json
+import copy
+
+from PIL import Image
+
+import metrics
+
+# Visual-token budget for multi-image samples (Qwen2.5-VL geometry).
+#
+# The image processor resizes every image to multiples of 28 px (14 px
+# patches, 2x2 patches merged into one token), so an image of h x w pixels
+# after smart_resize costs (h / 28) * (w / 28) tokens plus <|vision_start|>
+# and <|vision_end|>. fit_conversation() measures the text of a sample,
+# gives the images an equal share of what is left of `max_tokens`, resizes
+# each one to a 28 px grid within its share (so the processor leaves it
+# untouched) and, if even MIN_IMAGE_TOKENS per image does not fit, drops
+# frames evenly. The resulting sequence fits `max_tokens` exactly, so
+# truncation never cuts image tokens or the answer.
+#
+# train.py and spaceom_infer.py both go through fit_conversation(), and each
+# plan can be appended to a JSONL log (resolutions and token counts).
+
+PATCH_SIZE = 14
+MERGE_SIZE = 2
+FACTOR = PATCH_SIZE * MERGE_SIZE            # 28 px per visual token side
+MIN_PIXELS = 56 * 56                        # processor defaults for Qwen2.5-VL
+MAX_PIXELS = 12845056
+MIN_IMAGE_TOKENS = 64                       # below this a frame is dropped rather than shrunk further
+MAX_IMAGE_PIXELS = 512 * 512                # never feed an image larger than this, even with budget to spare
+TOKENS_PER_IMAGE_MARKERS = 2                # <|vision_start|> and <|vision_end|>
+
+
+def smart_resize(height, width, factor=FACTOR, min_pixels=MIN_PIXELS, max_pixels=MAX_PIXELS):
+    """
+    Same rounding as the Qwen2-VL image processor: multiples of `factor` within
+    the pixel range. Sides shorter than `factor` are scaled up instead of rejected.
+    """
+    if min(height, width) < factor:
+        scale = factor / min(height, width)
+        height, width = height * scale, width * scale
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+def image_tokens(height, width):
+    """Visual tokens for an image the processor will not resize further (28 px multiples)."""
+    return (height // FACTOR) * (width // FACTOR)
+
+
+def fit_size(height, width, max_tokens, max_pixels=MAX_IMAGE_PIXELS):
+    """Largest 28 px-grid size of an h x w image costing at most `max_tokens` (and `max_pixels`)."""
+    limit = min(max_pixels, max_tokens * FACTOR * FACTOR)
+    h, w = smart_resize(height, width, max_pixels=max(limit, FACTOR * FACTOR))
+    # smart_resize floors each side separately; walk down if rounding still overshoots
+    while image_tokens(h, w) > max_tokens and (h > FACTOR or w > FACTOR):
+        if h >= w:
+            h -= FACTOR
+        else:
+            w -= FACTOR
+    return h, w
+
+
+def spread_indices(n, k):
+    """k indices spread evenly over range(n), first and last included."""
+    if k >= n:
+        return list(range(n))
+    if k == 1:
+        return [0]
+    return sorted({round(i * (n - 1) / (k - 1)) for i in range(k)})
+
+
+def plan_images(sizes, text_tokens, max_tokens, min_image_tokens=MIN_IMAGE_TOKENS,
+                max_image_pixels=MAX_IMAGE_PIXELS, drop_frames=True):
+    """
+    sizes: [(height, width)] of the images, text_tokens: tokens of the sample
+    without images. Returns (kept indices, [(height, width)] for the kept images).
+    """
+    n = len(sizes)
+    if n == 0:
+        return [], []
+    keep = list(range(n))
+    per_image = (max_tokens - text_tokens) // n - TOKENS_PER_IMAGE_MARKERS
+    if per_image < min_image_tokens and drop_frames:
+        k = (max_tokens - text_tokens) // (min_image_tokens + TOKENS_PER_IMAGE_MARKERS)
+        keep = spread_indices(n, max(1, k))
+        per_image = (max_tokens - text_tokens) // len(keep) - TOKENS_PER_IMAGE_MARKERS
+    per_image = max(1, per_image)
+
+    # images smaller than their share give the rest back to the others
+    fitted = dict()
+    budget = per_image * len(keep)
+    order = sorted(keep, key=lambda i: sizes[i][0] * sizes[i][1])
+    for pos, i in enumerate(order):
+        share = budget // (len(order) - pos)
+        fitted[i] = fit_size(sizes[i][0], sizes[i][1], share, max_image_pixels)
+        budget -= image_tokens(*fitted[i])
+    return keep, [fitted[i] for i in keep]
+
+
+def _image_items(messages):
+    for message in messages:
+        content = message.get('content')
+        if isinstance(content, list):
+            for item in content:
+                if item.get('type') == 'image':
+                    yield message, item
+
+
+def count_text_tokens(processor, messages, add_generation_prompt):
+    """Tokens of the templated conversation, counting each image as its two markers only."""
+    text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+    num_images = sum(1 for _ in _image_items(messages))
+    # each image appears as <|vision_start|><|image_pad|><|vision_end|>; the pad is expanded later
+    return len(processor.tokenizer(text, add_special_tokens=False)['input_ids']) - num_images, text
+
+
+def planned_tokens(processor, messages, sizes, max_tokens, add_generation_prompt=True,
+                   min_image_tokens=MIN_IMAGE_TOKENS, max_image_pixels=MAX_IMAGE_PIXELS, drop_frames=True):
+    """plan['total_tokens'] fit_conversation() would report for images of `sizes` [(h, w)], without the images."""
+    text_tokens, _ = count_text_tokens(processor, messages, add_generation_prompt)
+    text_tokens -= TOKENS_PER_IMAGE_MARKERS * len(sizes)
+    keep, fitted = plan_images(sizes, text_tokens, max_tokens, min_image_tokens, max_image_pixels, drop_frames)
+    return text_tokens + sum(image_tokens(h, w) for h, w in fitted) + TOKENS_PER_IMAGE_MARKERS * len(keep)
+
+
+def fit_conversation(processor, messages, images, max_tokens, add_generation_prompt=True,
+                     min_image_tokens=MIN_IMAGE_TOKENS, max_image_pixels=MAX_IMAGE_PIXELS, drop_frames=True):
+    """
+    Resize (and possibly drop) the PIL `images` of `messages` so the processed
+    sample is at most `max_tokens` long. Image items of `messages` map to
+    `images` in order. Returns (messages, images, text, plan); the inputs are not modified.
+    """
+    text_tokens, text = count_text_tokens(processor, messages, add_generation_prompt)
+    text_tokens -= TOKENS_PER_IMAGE_MARKERS * len(images)
+    sizes = [(img.height, img.width) for img in images]
+    keep, fitted = plan_images(sizes, text_tokens, max_tokens, min_image_tokens, max_image_pixels, drop_frames)
+
+    if len(keep) < len(images):
+        messages = copy.deepcopy(messages)
+        dropped = set(range(len(images))) - set(keep)
+        items = list(_image_items(messages))
+        for i in sorted(dropped, reverse=True):
+            message, item = items[i]
+            message['content'].remove(item)
+        text = processor.apply_chat_template(messages, tokenize=False, add_generation_prompt=add_generation_prompt)
+
+    with metrics.span('resize'):
+        resized = []
+        for i, (h, w) in zip(keep, fitted):
+            img = images[i]
+            resized.append(img if (img.height, img.width) == (h, w) else img.resize((w, h), Image.Resampling.LANCZOS))
+
+    visual = sum(image_tokens(h, w) for h, w in fitted)
+    plan = dict(
+        text_tokens=text_tokens,
+        visual_tokens=visual,
+        total_tokens=text_tokens + visual + TOKENS_PER_IMAGE_MARKERS * len(keep),
+        images=[dict(source=[sizes[i][0], sizes[i][1]], size=[h, w], tokens=image_tokens(h, w))
+                for i, (h, w) in zip(keep, fitted)],
+        dropped=len(images) - len(keep),
+    )
+    if plan['total_tokens'] > max_tokens:
+        # the text alone does not fit; images are already at their minimum
+        metrics.count('budget_overflows')
+    metrics.count('visual_tokens', visual)
+    metrics.count('frames_dropped', plan['dropped'])
+    return messages, resized, text, plan
+
+
+class PlanLog:
+    """Appends one JSON line per planned sample; a no-op without a path."""
+
+    def __init__(self, path=None):
+        self.path = path
+        self._f = None
+
+    def write(self, sample_id, plan):
+        if not self.path:
+            return
+        if self._f is None:
+            self._f = open(self.path, 'a')
+        self._f.write(json.dumps(dict(id=sample_id, **plan)) + '\n')
+        self._f.flush()
+
+    def close(self):
+        if self._f is not None:
+            self._f.close()
+            self._f = None
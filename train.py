@@ -3,11 +3,13 @@
 """
 Fine-tune SpaceOm (3 B Qwen2.5-VL backbone) on mixed caption + VQA data
 using LoRA (PEFT).  Works on a free Colab T4 / A10 with 16 GB VRAM.
+Under torchrun it trains data-parallel, one process per GPU (or per CPU
+process with gloo), see ddp.py.
 """
 
-import os, json, torch
+import io, os, json, math, torch
 from pathlib import Path
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import Dataset, DataLoader, IterableDataset, get_worker_info
 from transformers import (
     AutoProcessor, 
     Qwen2_5_VLForConditionalGeneration,
@@ -16,45 +18,84 @@ from transformers import (
 )
 from peft import LoraConfig, get_peft_model
 from PIL import Image
+import metrics
+from frame_pack import FrameResolver
+from lazy_crops import CropResolver
+from token_budget import PlanLog, fit_conversation, planned_tokens
+from sample_store import SampleStore, cached_array, open_store
+from packing import PackedDataset, PackingCollator, assistant_labels, pack_indices, packing_summary, rope_index_fn
+from ddp import EpochDataLoader, LengthGroupedDistributedSampler, distributed_env, sample_length, store_lengths
+from shards import INDEX_SUFFIX, load_index, load_samples, assigned_shards, iter_shard
 
 # ========= CONFIG ========= #
 MODEL_ID      = "remyxai/SpaceOm"
-DATA_JSON     = Path("data_preprocess/train_all.json")     # captions + VQA merged
+DATA_JSON     = Path("data_preprocess/train_all.index.json")  # captions + VQA merged (shard index or .json)
 IMAGE_ROOT    = Path("data/bbox_global")                    # images paths are stored relative to this root
 OUTPUT_DIR    = "spaceom_lora"
 BATCH_SIZE    = 1                               # fits on 16 GB with bnb.int8
 EPOCHS        = 3
 LR            = 2e-5
 MAX_NEW_TOK   = 0                               # no generation during training
-MAX_TOKENS    = 1024                            # padding / trunc
+MAX_TOKENS    = 1024                            # padding; images are sized to fit (token_budget.py)
+DROP_FRAMES   = True                            # drop frames evenly when the images cannot fit at minimum size
+TOKEN_LOG     = None                            # JSONL of per-sample resolutions / token counts
+PACKED_FRAMES = False                           # read images from .pack containers under IMAGE_ROOT
+SAMPLE_STORE  = True                            # parse samples lazily from an offset-indexed store (sample_store.py)
+LAZY_CROPS    = None                            # frames from space_om_extract --lazy-crops: "global" or "local" view (lazy_crops.py)
+PACKING       = False                           # pack several samples per row (packing.py); rows stay <= PACK_TOKENS
+PACK_TOKENS   = MAX_TOKENS
+DDP_BACKEND   = None                            # torchrun only: None picks nccl on GPU, gloo on CPU
+SEED          = 0
 # ========================== #
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
 
-print("Loading model & processor …")
-model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
-    MODEL_ID,
-    torch_dtype=torch.bfloat16,
-    device_map="auto",
-    trust_remote_code=True,
-    load_in_8bit=True,          # bitsandbytes (saves vRAM)
-)
-processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
-
-# ----- LoRA adapter -----
-peft_cfg = LoraConfig(
-    r=128,
-    lora_alpha=256,
-    target_modules=["q_proj", "v_proj", "o_proj"],
-    lora_dropout=0.05,
-    bias="none",
-    task_type="CAUSAL_LM",
-)
-model = get_peft_model(model, peft_cfg)
-model.print_trainable_parameters()
+
+def load_model_and_processor(local_rank=None):
+    print("Loading model & processor …")
+    # DDP (local_rank set): one full replica per process, on its own GPU, or in fp32 on CPU (gloo)
+    if local_rank is not None and not torch.cuda.is_available():
+        placement = dict(torch_dtype=torch.float32)
+    else:
+        placement = dict(
+            torch_dtype=torch.bfloat16,
+            device_map="auto" if local_rank is None else {"": local_rank},
+            load_in_8bit=True,          # bitsandbytes (saves vRAM)
+        )
+    model = Qwen2_5_VLForConditionalGeneration.from_pretrained(
+        MODEL_ID,
+        trust_remote_code=True,
+        **placement,
+    )
+    processor = AutoProcessor.from_pretrained(MODEL_ID, trust_remote_code=True)
+
+    # ----- LoRA adapter -----
+    peft_cfg = LoraConfig(
+        r=128,
+        lora_alpha=256,
+        target_modules=["q_proj", "v_proj", "o_proj"],
+        lora_dropout=0.05,
+        bias="none",
+        task_type="CAUSAL_LM",
+    )
+    model = get_peft_model(model, peft_cfg)
+    model.print_trainable_parameters()
+    return model, processor
+
 
 # ========= DATASET ========= #
-# ========= DATASET ========= #
+PLAN_LOG = PlanLog(TOKEN_LOG)
+
+
+def make_resolver(image_root: Path, packed: bool, lazy_crops=None):
+    """None (plain Image.open) unless images come from packs or get their boxes drawn on load."""
+    if lazy_crops:
+        return CropResolver(image_root, packed=packed, view=lazy_crops)
+    if packed:
+        return FrameResolver(image_root, packed=True)
+    return None
+
+
 class SpaceOmJsonDataset(Dataset):
     """
     Each entry:
@@ -68,105 +109,278 @@ class SpaceOmJsonDataset(Dataset):
     }
     """
 
-    def __init__(self, json_path: Path, processor, image_root: Path):
-        self.items      = json.load(open(json_path))
+    def __init__(self, json_path: Path, processor, image_root: Path, packed=PACKED_FRAMES, lazy_crops=LAZY_CROPS,
+                 lazy=SAMPLE_STORE):
+        # lazy: a mmap-backed store instead of a list of dicts that every worker slowly copies
+        self.items      = open_store(json_path) if lazy else load_samples(json_path)
         self.processor  = processor
         self.image_root = image_root.resolve()
+        self.resolver   = make_resolver(self.image_root, packed, lazy_crops)
 
     def __len__(self):
         return len(self.items)
 
     def __getitem__(self, idx):
-        item       = self.items[idx]
-        conv       = item["conversations"]
-        user_msg   = conv[0]          # first (and only) user turn
-        assistant  = conv[1]          # first assistant turn (answer)
-
-        # ---------- load image(s) ----------
-        imgs = []
-        for c in user_msg["content"]:
-            if c["type"] != "image":
-                continue
-
-            raw_path = Path(c["image"])
-
-            # ▸ If JSON already stores an absolute path OR a path that
-            #   already starts with the IMAGE_ROOT folder, do **not**
-            #   prefix again.
-            if raw_path.is_absolute() or str(raw_path).startswith(str(self.image_root)):
-                img_path = raw_path.resolve()
+        return encode_sample(self.items[idx], self.processor, self.image_root, self.resolver, pad=not PACKING)
+
+    def token_lengths(self):
+        """sample_tokens() of every sample, cached next to the sample store."""
+        fn = lambda item: sample_tokens(item, self.processor, self.image_root, self.resolver)
+        if isinstance(self.items, SampleStore):
+            # v2: counted without a trailing generation prompt
+            return cached_array(self.items, f".store.tokens{MAX_TOKENS}.v2.npy", fn)
+        return [fn(item) for item in self.items]
+
+
+def image_path(raw, image_root: Path):
+    raw_path = Path(raw)
+    # ▸ If JSON already stores an absolute path OR a path that
+    #   already starts with the IMAGE_ROOT folder, do **not**
+    #   prefix again.
+    if raw_path.is_absolute() or str(raw_path).startswith(str(image_root)):
+        return raw_path.resolve()
+    return (image_root / raw_path).resolve()
+
+
+def encode_sample(item, processor, image_root: Path, resolver=None, pad=True):
+    conv       = item["conversations"]
+    user_msg   = conv[0]          # first (and only) user turn
+    assistant  = conv[1]          # first assistant turn (answer)
+
+    # ---------- load image(s) ----------
+    imgs = []
+    for c in user_msg["content"]:
+        if c["type"] != "image":
+            continue
+
+        img_path = image_path(c["image"], image_root)
+
+        try:
+            if resolver is not None:
+                img = resolver.open_image(img_path)
             else:
-                img_path = (self.image_root / raw_path).resolve()
-
-            try:
-                img = Image.open(img_path).convert("RGB")
-            except FileNotFoundError as e:
-                raise RuntimeError(f"❌ Image not found: {img_path}") from e
-
-            # Down-scale to max-width 512 px (SpaceOm pre-training size)
-            if img.width > 512:
-                h = int(img.height * 512 / img.width)
-                img = img.resize((512, h), Image.Resampling.LANCZOS)
-
-            imgs.append(img)
-
-        # ---------- build chat template ----------
-        prompt_chat = [
-            user_msg,                   # already contains images + text
-            assistant                   # ground-truth answer
-        ]
-        text_input = self.processor.apply_chat_template(
-            prompt_chat, tokenize=False, add_generation_prompt=True
-        )
+                with metrics.span("decode"):
+                    img = Image.open(img_path).convert("RGB")
+        except FileNotFoundError as e:
+            raise RuntimeError(f"❌ Image not found: {img_path}") from e
 
-        inputs = self.processor(
+        imgs.append(img)
+    metrics.count("images_loaded", len(imgs))
+
+    # ---------- build chat template ----------
+    # the chat already ends with the answer: no generation prompt after it
+    prompt_chat = [
+        user_msg,                   # already contains images + text
+        assistant                   # ground-truth answer
+    ]
+    # size every image (and drop frames if needed) so the sample fits MAX_TOKENS exactly
+    prompt_chat, imgs, text_input, plan = fit_conversation(
+        processor, prompt_chat, imgs, MAX_TOKENS, add_generation_prompt=False, drop_frames=DROP_FRAMES
+    )
+    PLAN_LOG.write(item.get("id"), plan)
+
+    # pad=False (packing): exactly plan["total_tokens"] tokens, padded later per packed row
+    padding = dict(padding="max_length", truncation=True, max_length=MAX_TOKENS) if pad else dict()
+    with metrics.span("processor"):
+        inputs = processor(
             text=[text_input],
             images=imgs,
             return_tensors="pt",
-            padding="max_length",
-            truncation=True,
-            max_length=MAX_TOKENS,
+            **padding,
         )
+    metrics.count("samples")
 
-        # we only need input_ids & pixel_values
-        return {
-            "input_ids"    : inputs["input_ids"].squeeze(0),
-            "pixel_values" : inputs["pixel_values"],
-        }
+    # input_ids, pixel_values and the patch grid of every image (resolutions vary per sample);
+    # the loss only covers the assistant reply
+    input_ids = inputs["input_ids"].squeeze(0)
+    return {
+        "input_ids"      : input_ids,
+        "labels"         : assistant_labels(input_ids, processor.tokenizer),
+        "pixel_values"   : inputs["pixel_values"],
+        "image_grid_thw" : inputs["image_grid_thw"],
+    }
 
 
-# ========= TRAINING ========= #
-training_args = TrainingArguments(
-    output_dir        = OUTPUT_DIR,
-    per_device_train_batch_size = BATCH_SIZE,
-    gradient_accumulation_steps = 4,
-    learning_rate     = LR,
-    num_train_epochs  = EPOCHS,
-    bf16              = True,
-    logging_steps     = 20,
-    save_steps        = 500,
-    save_total_limit  = 2,
-    remove_unused_columns = False,
-    fp16              = False,  # we use bf16
-    dataloader_pin_memory = True,
-    report_to         = "none",
-)
+def image_size(path: Path, resolver=None):
+    """(height, width) of an image as the dataset will load it, from its header only."""
+    rect = resolver.crop_rect(path) if hasattr(resolver, "crop_rect") else None
+    if rect is not None:
+        return rect[3] - rect[1], rect[2] - rect[0]
+    frames = getattr(resolver, "frames", resolver)
+    src = io.BytesIO(frames.read_bytes(path)) if frames is not None else path
+    with Image.open(src) as img:
+        return img.height, img.width
+
+
+def sample_tokens(item, processor, image_root: Path, resolver=None):
+    """Unpadded token count of encode_sample(item), without decoding any image."""
+    user_msg, assistant = item["conversations"][0], item["conversations"][1]
+    sizes = [image_size(image_path(c["image"], image_root), resolver)
+             for c in user_msg["content"] if c["type"] == "image"]
+    return planned_tokens(processor, [user_msg, assistant], sizes, MAX_TOKENS,
+                          add_generation_prompt=False, drop_frames=DROP_FRAMES)
 
+
+class SpaceOmShardDataset(IterableDataset):
+    """
+    Streams the JSONL shards written by data_preprocess/merge_jsons.py.
+    Every (rank, dataloader worker) pair reads only its own shards, so no
+    process ever parses the full dataset.
+    """
+
+    def __init__(self, index_path: Path, processor, image_root: Path, rank=0, world_size=1,
+                 packed=PACKED_FRAMES, lazy_crops=LAZY_CROPS):
+        self.index_path = index_path
+        self.index      = load_index(index_path)
+        self.processor  = processor
+        self.image_root = image_root.resolve()
+        self.resolver   = make_resolver(self.image_root, packed, lazy_crops)
+        self.rank       = rank
+        self.world_size = world_size
+
+    def __len__(self):
+        shards = self.index["shards"]
+        return sum(shards[i]["num_samples"] for i in assigned_shards(len(shards), self.rank, self.world_size))
+
+    def __iter__(self):
+        info = get_worker_info()
+        num_workers = info.num_workers if info else 1
+        worker_id   = info.id if info else 0
+        mine = assigned_shards(len(self.index["shards"]), self.rank, self.world_size)
+        for shard_id in mine[worker_id::num_workers]:
+            for item in iter_shard(self.index_path, shard_id, self.index):
+                yield encode_sample(item, self.processor, self.image_root, self.resolver)
+
+
+def build_train_dataset(processor, distributed=False):
+    # under DDP (and for packing) the map-style dataset over the same store gives every rank equal steps
+    if str(DATA_JSON).endswith(INDEX_SUFFIX) and not distributed and not PACKING:
+        return SpaceOmShardDataset(DATA_JSON, processor, IMAGE_ROOT)
+    dataset = SpaceOmJsonDataset(DATA_JSON, processor, IMAGE_ROOT)
+    if not PACKING:
+        return dataset
+    lengths = dataset.token_lengths()
+    packs = pack_indices(lengths, PACK_TOKENS, seed=SEED)
+    print(packing_summary(lengths, packs, PACK_TOKENS))
+    return PackedDataset(dataset, packs, lengths)
+
+
+def dataset_lengths(dataset):
+    if isinstance(dataset, PackedDataset):
+        return dataset.pack_lengths
+    items = dataset.items
+    if isinstance(items, SampleStore):
+        return store_lengths(items)
+    return [sample_length(item) for item in items]
+
+
+class DistributedTrainer(Trainer):
+    """Trainer whose train loader is rank-sharded by LengthGroupedDistributedSampler."""
+
+    def __init__(self, *args, lengths=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lengths = lengths
+
+    def get_train_dataloader(self):
+        # built here instead of through accelerate, which would shard the batches a second time
+        sampler = LengthGroupedDistributedSampler(
+            self.lengths, self._train_batch_size, self.args.world_size, self.args.process_index, seed=self.args.seed
+        )
+        return EpochDataLoader(
+            self.train_dataset,
+            batch_size  = self._train_batch_size,
+            sampler     = sampler,
+            collate_fn  = self.data_collator,
+            num_workers = self.args.dataloader_num_workers,
+            drop_last   = self.args.dataloader_drop_last,
+        )
+
+
+# ========= TRAINING ========= #
 def collate_fn(batch):
-    return {
-        k: torch.stack([x[k] for x in batch]).to(device)
-        for k in batch[0]
-    }
+    # text is padded to MAX_TOKENS; image patches vary per sample and are concatenated like the processor does
+    out = {k: torch.stack([x[k] for x in batch]) for k in ("input_ids", "labels")}
+    with_images = [x for x in batch if x.get("image_grid_thw") is not None]
+    if with_images:
+        out["pixel_values"] = torch.cat([x["pixel_values"] for x in with_images])
+        out["image_grid_thw"] = torch.cat([x["image_grid_thw"] for x in with_images])
+    return {k: v.to(device) for k, v in out.items()}
+
+
+def main():
+    global device
+    env = distributed_env()
+    rank, world_size, local_rank = env or (0, 1, None)
+    on_gpu = torch.cuda.is_available()
+    if env and on_gpu:
+        device = f"cuda:{local_rank}"
+        torch.cuda.set_device(local_rank)
+    metrics.init(f"train.rank{rank}" if env else "train")
+    with metrics.span("model_load"):
+        model, processor = load_model_and_processor(local_rank)
+
+    distributed = dict(
+        ddp_backend       = DDP_BACKEND or ("nccl" if on_gpu else "gloo"),
+        ddp_find_unused_parameters = False,
+        ddp_broadcast_buffers = False,  # only the LoRA gradients need syncing
+        use_cpu           = not on_gpu,
+        bf16              = on_gpu,
+        dataloader_pin_memory = False,  # collate_fn already moves batches to the device
+    ) if env else dict()
+    training_kwargs = dict(
+        output_dir        = OUTPUT_DIR,
+        per_device_train_batch_size = BATCH_SIZE,
+        gradient_accumulation_steps = 4,
+        learning_rate     = LR,
+        num_train_epochs  = EPOCHS,
+        bf16              = True,
+        logging_steps     = 20,
+        save_steps        = 500,
+        save_total_limit  = 2,
+        remove_unused_columns = False,
+        fp16              = False,  # we use bf16
+        dataloader_pin_memory = True,
+        report_to         = "none",
+        seed              = SEED,
+    )
+    training_kwargs.update(distributed)
+    training_args = TrainingArguments(**training_kwargs)
+
+    # global rank 0 builds the sample store (and its length cache), the others wait and open it
+    with training_args.main_process_first(local=False, desc="sample store"):
+        train_ds = build_train_dataset(processor, distributed=bool(env))
+        lengths = dataset_lengths(train_ds) if env else None
+    if PACKING:
+        dtype = torch.bfloat16 if on_gpu else torch.float32
+        collator = PackingCollator(processor.tokenizer.pad_token_id, rope_index_fn(model), dtype, device)
+    else:
+        collator = collate_fn
+
+    if env:
+        print(f"rank {rank}/{world_size}: {len(train_ds)} samples, {math.ceil(len(train_ds) / world_size)} per rank")
+        trainer = DistributedTrainer(
+            model           = model,
+            args            = training_args,
+            train_dataset   = train_ds,
+            data_collator   = collator,
+            lengths         = lengths,
+        )
+    else:
+        trainer = Trainer(
+            model           = model,
+            args            = training_args,
+            train_dataset   = train_ds,
+            data_collator   = collator,
+        )
+
+    with metrics.span("train"):
+        trainer.train()
+    # Save LoRA adapters only, once
+    if trainer.is_world_process_zero():
+        with metrics.span("write"):
+            model.save_pretrained(OUTPUT_DIR)
+            processor.save_pretrained(OUTPUT_DIR)
 
-trainer = Trainer(
-    model           = model,
-    args            = training_args,
-    train_dataset   = train_ds,
-    data_collator   = collate_fn,
-)
 
 if __name__ == "__main__":
-    trainer.train()
-    # Save LoRA adapters only
-    model.save_pretrained(OUTPUT_DIR)
-    processor.save_pretrained(OUTPUT_DIR)
+    main()
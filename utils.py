@@ -1,5 +1,6 @@
 import os
 import json
+import metrics
 from generate_dummy_captions import generate_dummy_captions
 
 def process_all_json_files_recursive(root_folder):
@@ -12,8 +13,9 @@ def process_all_json_files_recursive(root_folder):
                 file_path = os.path.join(dirpath, filename)
                 print(f"Processing file: {file_path}")
                 try:
-                    with open(file_path, 'r') as f:
+                    with metrics.span('json_parse'), open(file_path, 'r') as f:
                         data = json.load(f)
+                    metrics.count('files_parsed')
                     scenario_id = extract_scenario_id(file_path)
                     
                     for event in data.get("event_phase", []):
@@ -0,0 +1,269 @@
+import io
+import os
+import queue
+import threading
+from pathlib import Path
+from collections import OrderedDict, defaultdict
+
+import cv2
+from PIL import Image
+
+import metrics
+from frame_pack import FrameResolver
+from video_meta import VideoCatalog, CATALOG_PATH, find_videos
+
+# Frames of extract_val.py served straight from the videos, without writing
+# or reading JPEGs.
+#
+# VideoFrameTree presents every video under `video_root` as the folder
+# extract_val.py would have written under `root` (<rel dir>/<stem>/00000.jpg,
+# one name per FRAME_INTERVAL frames) through the FrameResolver interface, so
+# vqa_space_om.py builds the very same samples from it and inference opens
+# the same relative paths. Opening an image decodes its frame from the video.
+#
+#   codec='jpeg'  encodes / decodes the frame in memory exactly like the file
+#                 path (cv2.imencode -> PIL), so pixels are identical
+#   codec='raw'   hands the decoded frame over as is (faster, no JPEG loss)
+#
+# read_bytes() returns the in-memory JPEG of a frame and signature() the
+# video's size / mtime plus the frame index, so the inherited imread() and
+# the frame_dedup.py hash cache work on the tree too.
+#
+# Folder listings start from the frame counts of the video metadata catalog
+# (video_meta.py), so scanning a tree opens no video. Container frame counts
+# can be off while extract_val.py counts the frames cap.read() delivers, so
+# the first access to a video's folder checks its count by decoding the
+# last listed frame (and the one after it), dropping listed frames that do
+# not decode and adding ones the container missed. Decoding skips ahead by
+# seeking to the last keyframe before a wanted frame instead of grabbing
+# every frame.
+#
+# FramePrefetcher decodes the frames of upcoming batches on a background
+# thread (cv2 releases the GIL while decoding), so decoding overlaps with
+# the model.
+
+FRAME_INTERVAL = 150            # extract_val.py frame_interval
+CACHE_FRAMES = 256              # decoded frames kept; questions of a scenario share their frames
+PREFETCH_BATCHES = 4
+CODECS = ('jpeg', 'raw')
+
+
+class VideoFrameTree(FrameResolver):
+    """Read-only FrameResolver over the frames extract_val.py would extract from `video_root`."""
+
+    def __init__(self, video_root, root, interval=FRAME_INTERVAL, codec='jpeg', cache_frames=CACHE_FRAMES,
+                 catalog_path=CATALOG_PATH):
+        super().__init__(root)
+        if codec not in CODECS:
+            raise ValueError(f'codec must be one of {CODECS}, got {codec!r}')
+        self.video_root = Path(video_root)
+        self.interval = interval
+        self.codec = codec
+        self.cache_frames = cache_frames
+        self.catalog = VideoCatalog(catalog_path)
+        self._videos = None         # virtual folder (posix, relative to root) -> (video path, frames listed)
+        self._vdirs = None          # every virtual folder and its parents
+        self._checked = set()       # virtual folders whose frame count was checked by decoding
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _catalog(self):
+        if self._videos is None:
+            self._videos, self._vdirs = dict(), {'.'}
+            with metrics.span('dir_scan'):
+                videos = find_videos(str(self.video_root))
+            errors = self.catalog.probe_all(videos)
+            for video in map(Path, videos):
+                rel = video.relative_to(self.video_root)
+                folder = rel.parent / rel.stem
+                count = 0 if str(video) in errors else self.catalog[video].frame_count
+                self._videos[folder.as_posix()] = (video, -(-count // self.interval))
+                self._vdirs.update(p.as_posix() for p in [folder, *folder.parents])
+        return self._videos
+
+    def _decodes(self, video, listed_index):
+        try:
+            self.frames(video, [listed_index * self.interval])
+            return True
+        except OSError:             # frame past the end, or a video that cannot be opened
+            return False
+
+    def _folder(self, folder):
+        """(video path, frames listed) of a virtual folder, its count checked against the video on first use."""
+        video, listed = self._catalog().get(folder, (None, 0))
+        if video is None or folder in self._checked:
+            return video, listed
+        checked = listed
+        while checked and not self._decodes(video, checked - 1):
+            checked -= 1
+        if checked == listed:
+            while self._decodes(video, checked):
+                checked += 1
+        if checked != listed:
+            metrics.count('frame_counts_corrected')
+        self._videos[folder] = (video, checked)
+        self._checked.add(folder)
+        return video, checked
+
+    def locate(self, path):
+        """(video path, frame index) of a virtual frame path."""
+        rel = self._relative(path)
+        video, listed = self._folder(rel.parent.as_posix())
+        index = int(rel.stem) if rel.stem.isdigit() else -1
+        if video is None or not 0 <= index < listed:
+            raise FileNotFoundError(self.root / rel)
+        return video, index * self.interval
+
+    def exists(self, path):
+        try:
+            self.locate(path)
+            return True
+        except OSError:             # frame past the end, or a video that cannot be opened
+            return False
+
+    def isdir(self, path):
+        self._catalog()
+        return self._relative(path).as_posix() in self._vdirs
+
+    def listdir(self, path):
+        _, listed = self._folder(self._relative(path).as_posix())
+        return [f'{i:05d}.jpg' for i in range(listed)]
+
+    def subdirs(self, path):
+        self._catalog()
+        rel = self._relative(path).as_posix()
+        prefix = '' if rel == '.' else rel + '/'
+        return sorted(d[len(prefix):] for d in self._vdirs
+                      if d.startswith(prefix) and d != rel and d != '.' and '/' not in d[len(prefix):])
+
+    def _encode(self, frame):
+        """JPEG bytes of a BGR frame, as extract_val.py writes them."""
+        with metrics.span('encode'):
+            ok, buf = cv2.imencode('.jpg', frame)
+        if not ok:
+            raise ValueError(f'could not encode a {frame.shape} frame as JPEG')
+        return buf.tobytes()
+
+    def _to_image(self, frame):
+        if self.codec == 'raw':
+            return Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+        return Image.open(io.BytesIO(self._encode(frame))).convert('RGB')
+
+    def decode(self, video, indices):
+        """{frame index: PIL RGB image} for `indices` of one video."""
+        return {index: self._to_image(frame) for index, frame in self.frames(video, indices).items()}
+
+    def frames(self, video, indices):
+        """{frame index: BGR frame} for `indices` of one video, in one forward pass with keyframe seeks."""
+        wanted = sorted(set(indices))
+        meta = self.catalog[video]
+        out = dict()
+        cap = cv2.VideoCapture(str(video))
+        position, decoded = 0, 0
+        # grab() + retrieve() returns exactly what read() does, without converting skipped frames
+        with metrics.span('decode'):
+            for index in wanted:
+                keyframe = meta.keyframe_before(index)
+                if keyframe > position:
+                    cap.set(cv2.CAP_PROP_POS_FRAMES, keyframe)
+                    position = keyframe
+                    metrics.count('keyframe_seeks')
+                while position < index and cap.grab():
+                    decoded += 1
+                    position += 1
+                if position != index or not cap.grab():
+                    break
+                ok, frame = cap.retrieve()
+                position += 1
+                decoded += 1
+                if not ok:
+                    break
+                out[index] = frame
+        cap.release()
+        metrics.count('frames_decoded', decoded)
+        missing = set(wanted) - set(out)
+        if missing:
+            raise FileNotFoundError(f'{video}: frames {sorted(missing)} could not be decoded')
+        return out
+
+    def load(self, paths):
+        """{path: image} for virtual frame paths, decoding each video once for all its missing frames."""
+        out, todo = dict(), defaultdict(list)
+        with self._lock:
+            for p in paths:
+                if p in self._cache:
+                    self._cache.move_to_end(p)
+                    out[p] = self._cache[p]
+        for p in paths:
+            if p not in out:
+                video, index = self.locate(p)
+                todo[video].append((index, p))
+        for video, wanted in todo.items():
+            frames = self.decode(video, [index for index, _ in wanted])
+            for index, p in wanted:
+                out[p] = frames[index]
+        with self._lock:
+            for p in paths:
+                self._cache[p] = out[p]
+                self._cache.move_to_end(p)
+            while len(self._cache) > self.cache_frames:
+                self._cache.popitem(last=False)
+        return out
+
+    def open_image(self, path):
+        """PIL RGB image of a virtual frame path."""
+        return self.load([path])[path]
+
+    def read_bytes(self, path):
+        """JPEG bytes of a virtual frame (encoded in memory, whatever the codec)."""
+        video, index = self.locate(path)
+        return self._encode(self.frames(video, [index])[index])
+
+    def signature(self, path):
+        """[video size, video mtime_ns, frame index]; for caches."""
+        video, index = self.locate(path)
+        st = os.stat(video)
+        return [st.st_size, st.st_mtime_ns, index]
+
+
+def image_paths(sample):
+    user = next(c for c in sample['conversations'] if c['role'] == 'user')
+    return [c['image'] for c in user['content'] if c['type'] == 'image']
+
+
+class FramePrefetcher:
+    """
+    Iterates (samples, [images per sample]) batches while a background thread
+    decodes up to `depth` batches ahead.
+    """
+
+    def __init__(self, tree, samples, batch_size, depth=PREFETCH_BATCHES):
+        self.tree = tree
+        self.samples = samples
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=depth)
+        self.thread = threading.Thread(target=self._produce, name='frame-prefetch', daemon=True)
+
+    def __len__(self):
+        return -(-len(self.samples) // self.batch_size)
+
+    def _produce(self):
+        try:
+            for start in range(0, len(self.samples), self.batch_size):
+                batch = self.samples[start:start + self.batch_size]
+                frames = self.tree.load(list(dict.fromkeys(p for s in batch for p in image_paths(s))))
+                self.queue.put((batch, [[frames[p] for p in image_paths(s)] for s in batch]))
+        except Exception as e:
+            self.queue.put(e)
+        self.queue.put(None)
+
+    def __iter__(self):
+        self.thread.start()
+        while True:
+            with metrics.span('prefetch_wait'):
+                item = self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
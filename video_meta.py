@@ -0,0 +1,222 @@
+import os
+import json
+import bisect
+import argparse
+from multiprocessing import Pool
+
+import cv2
+from tqdm import tqdm
+
+import metrics
+
+# Video metadata catalog: every mp4 is probed once, the result is kept in
+#
+#   processed_anno/video_meta.json
+#   {"version": 1, "videos": {"data/videos/train/.../x.mp4": {
+#       "size": ..., "mtime_ns": ..., "fps": 30.0, "frame_count": 2700,
+#       "duration": 90.0, "width": 1920, "height": 1080, "keyframes": [0, 60, ...]}}}
+#
+# and re-probed only when the file's size or mtime changes. Stages ask the
+# catalog instead of opening the video for its properties:
+#
+#   catalog = VideoCatalog()
+#   catalog.probe_all(videos, processes=4)     # stale / unknown videos, in a process pool
+#   meta = catalog[video_path]
+#   meta.time_to_frame(12.5), meta.frame_to_time(375), meta.clamp(index)
+#   meta.keyframe_before(index)                 # where a decoder has to start to reach index
+#
+#   python video_meta.py data/videos/train data/videos/val
+#
+# fills the catalog up front. Keys are normalized paths as given (the
+# annotation JSONs use paths relative to the repo root). Keyframes come from
+# the container index (decord); without decord they are left empty and
+# keyframe_before() falls back to frame 0.
+
+CATALOG_PATH = 'processed_anno/video_meta.json'
+CATALOG_VERSION = 1
+NUM_PROCESSES = 4
+HIGH_FPS = 40.0             # space_om_extract.py: annotations of faster videos index every other frame
+
+try:
+    from decord import VideoReader
+except ImportError:
+    VideoReader = None
+
+
+def probe(path):
+    """Metadata of one video (without size / mtime)."""
+    with metrics.span('probe'):
+        if VideoReader is not None:
+            vr = VideoReader(path)
+            height, width = vr[0].shape[:2] if len(vr) else (0, 0)
+            meta = dict(fps=float(vr.get_avg_fps()), frame_count=len(vr), width=int(width), height=int(height),
+                        keyframes=[int(k) for k in vr.get_key_indices()])
+        else:
+            cap = cv2.VideoCapture(path)
+            if not cap.isOpened():
+                raise IOError(f'cannot open video {path}')
+            meta = dict(fps=float(cap.get(cv2.CAP_PROP_FPS)), frame_count=int(cap.get(cv2.CAP_PROP_FRAME_COUNT)),
+                        width=int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)), height=int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                        keyframes=[])
+            cap.release()
+    meta['duration'] = meta['frame_count'] / meta['fps'] if meta['fps'] > 0 else 0.0
+    metrics.count('videos_probed')
+    return meta
+
+
+def _stat(path):
+    st = os.stat(path)
+    return dict(size=st.st_size, mtime_ns=st.st_mtime_ns)
+
+
+def _probe_job(path):
+    try:
+        return path, dict(_stat(path), **probe(path)), None
+    except Exception as e:
+        return path, None, f'{type(e).__name__}: {e}'
+
+
+class VideoMeta:
+    """Read-only view of one catalog entry with frame / time helpers."""
+
+    def __init__(self, path, entry):
+        self.path = path
+        self.fps = entry['fps']
+        self.frame_count = entry['frame_count']
+        self.duration = entry['duration']
+        self.width = entry['width']
+        self.height = entry['height']
+        self.keyframes = entry['keyframes'] or [0]
+
+    def __repr__(self):
+        return (f'VideoMeta({self.path!r}, {self.width}x{self.height}, {self.fps:.2f} fps, '
+                f'{self.frame_count} frames, {len(self.keyframes)} keyframes)')
+
+    @property
+    def high_fps(self):
+        return self.fps > HIGH_FPS
+
+    def clamp(self, frame):
+        return min(max(int(frame), 0), max(self.frame_count - 1, 0))
+
+    def time_to_frame(self, seconds):
+        """Frame shown at `seconds` (clamped to the video)."""
+        return self.clamp(int(seconds * self.fps))
+
+    def frame_to_time(self, frame):
+        return frame / self.fps if self.fps > 0 else 0.0
+
+    def keyframe_before(self, frame):
+        """Last keyframe at or before `frame`."""
+        return self.keyframes[max(bisect.bisect_right(self.keyframes, frame) - 1, 0)]
+
+    def seek_groups(self, frames):
+        """Sorted `frames` grouped by keyframe_before(); decoding a group starts at its keyframe."""
+        groups = dict()
+        for frame in sorted(set(frames)):
+            groups.setdefault(self.keyframe_before(frame), []).append(frame)
+        return list(groups.items())
+
+
+class VideoCatalog:
+    """Persistent {video path: metadata} cache, invalidated by file size and mtime."""
+
+    def __init__(self, path=CATALOG_PATH):
+        self.path = path
+        self.videos = self._read()
+        self.dirty = False
+
+    def _read(self):
+        if not self.path or not os.path.exists(self.path):
+            return dict()
+        with metrics.span('json_parse'):
+            with open(self.path) as f:
+                catalog = json.load(f)
+        return catalog['videos'] if catalog.get('version') == CATALOG_VERSION else dict()
+
+    @staticmethod
+    def key(video):
+        return os.path.normpath(str(video))
+
+    def fresh(self, video):
+        entry = self.videos.get(self.key(video))
+        return entry is not None and os.path.exists(video) and _stat(video) == dict(size=entry['size'], mtime_ns=entry['mtime_ns'])
+
+    def probe_all(self, videos, processes=NUM_PROCESSES):
+        """Probe every video of `videos` that is missing or stale. Returns {video: error} for failures."""
+        stale = [str(v) for v in dict.fromkeys(videos) if not self.fresh(v)]
+        errors = dict()
+        if not stale:
+            return errors
+        jobs = min(processes, len(stale))
+        if jobs > 1:
+            with Pool(processes=jobs) as pool:
+                results = list(tqdm(metrics.collect(pool.imap_unordered(metrics.pooled(_probe_job), stale)),
+                                    total=len(stale), desc='Probing videos'))
+        else:
+            results = [_probe_job(v) for v in stale]
+        for video, entry, error in results:
+            if entry is None:
+                errors[video] = error
+            else:
+                self.videos[self.key(video)] = entry
+                self.dirty = True
+        self.save()
+        return errors
+
+    def get(self, video):
+        """VideoMeta of `video`, probing it first if needed."""
+        if not self.fresh(video):
+            _, entry, error = _probe_job(str(video))
+            if entry is None:
+                raise IOError(error)
+            self.videos[self.key(video)] = entry
+            self.dirty = True
+        return VideoMeta(self.key(video), self.videos[self.key(video)])
+
+    __getitem__ = get
+
+    def save(self):
+        """Write the catalog, merged with entries other processes saved meanwhile."""
+        if not self.dirty or not self.path:
+            return
+        on_disk = self._read()
+        on_disk.update(self.videos)
+        self.videos = on_disk
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp = f'{self.path}.{os.getpid()}.tmp'
+        with metrics.span('write'):
+            with open(tmp, 'w') as f:
+                json.dump(dict(version=CATALOG_VERSION, videos=self.videos), f)
+            os.replace(tmp, self.path)
+        self.dirty = False
+
+
+def find_videos(root):
+    """Every .mp4 under `root` (or `root` itself), sorted."""
+    if os.path.isfile(root):
+        return [root]
+    return sorted(os.path.join(dirpath, f) for dirpath, _, files in os.walk(root)
+                  for f in files if f.endswith('.mp4'))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Probe videos into the metadata catalog.')
+    parser.add_argument('roots', nargs='+', help='video files or folders searched for .mp4')
+    parser.add_argument('--catalog', default=CATALOG_PATH)
+    parser.add_argument('--num-processes', type=int, default=NUM_PROCESSES)
+    args = parser.parse_args()
+
+    metrics.init('video_meta')
+    catalog = VideoCatalog(args.catalog)
+    videos = [v for root in args.roots for v in find_videos(root)]
+    errors = catalog.probe_all(videos, args.num_processes)
+    for video, error in errors.items():
+        print(f'Failed to probe {video}: {error}')
+    metas = [catalog[v] for v in videos if v not in errors]
+    hours = sum(m.duration for m in metas) / 3600
+    print(f'{len(metas)} videos, {sum(m.frame_count for m in metas)} frames, {hours:.2f} h -> {args.catalog}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,7 +1,13 @@
 import os
 import json
+import argparse
 from pathlib import Path
 from tqdm import tqdm
+import metrics
+from frame_pack import FrameResolver
+from frame_dedup import HashCache, DedupStats, select_frames, CACHE_PATH, THRESHOLD
+from get_best_view import load_view_ranking, top_views
+from sharding import add_shard_args, resolve_shard, in_shard, shard_output_path, gather_json
 
 # Config - adjust paths as needed
 VQA_ROOT = Path("data/annotations/vqa/val")       # Your VQA JSON annotation root
@@ -9,6 +15,16 @@ BBOX_ROOT = Path("data/bbox_global/val")          # Root where images are stored
 OUTPUT_JSON = Path("vqa_spaceom_val_multiframe.json")
 MAX_FRAMES = 10
 
+# Loose files by default; main() switches to packed frames with --packed
+RESOLVER = FrameResolver(BBOX_ROOT)
+# Set by --dedup: hash cache used to drop near-duplicate frames (see frame_dedup.py)
+DEDUP = None
+DEDUP_THRESHOLD = THRESHOLD
+DEDUP_STATS = DedupStats()
+# Set by --views-map / --top-k: only the TOP_K_VIEWS best-ranked overhead cameras are used (see get_best_view.py)
+VIEW_RANKING = None
+TOP_K_VIEWS = None
+
 label_map = {
     "avoidance": "avoidance",
     "action": "action",
@@ -19,11 +35,26 @@ label_map = {
 }
 
 def load_json(path: Path):
+    metrics.count("files_stat")
     if path.exists():
-        with open(path, "r") as f:
+        with metrics.span("json_parse"), open(path, "r") as f:
             return json.load(f)
     return None
 
+def list_jpgs(folder: Path):
+    """
+    Sorted .jpg files directly inside `folder` (one directory scan), loose or packed.
+    """
+    with metrics.span("dir_scan"):
+        names = RESOLVER.listdir(folder)
+        metrics.count("files_stat", len(names))
+        return [folder / n for n in names if n.lower().endswith(".jpg")]
+
+def first_subdir(folder: Path, sid=None):
+    """First camera folder, or the best-ranked one with --views-map."""
+    names = top_views(VIEW_RANKING, sid, RESOLVER.subdirs(folder), 1)
+    return folder / names[0] if names else None
+
 def make_content(img_paths, question, choices):
     """
     Build content list: multiple images + question text
@@ -33,32 +64,41 @@ def make_content(img_paths, question, choices):
     content.append({"type": "text", "text": question_full})
     return content
 
-def collect_imgs(folder: Path, segment: str):
+def pick_frames(imgs, weight=1):
+    """
+    First MAX_FRAMES images, or with --dedup up to MAX_FRAMES distinct ones spread over all candidates.
+    `weight` is the number of samples that will share the selection (for the savings report).
+    """
+    if DEDUP is None or not imgs:
+        return imgs[:MAX_FRAMES]
+    chosen = select_frames(imgs, DEDUP, MAX_FRAMES, DEDUP_THRESHOLD)
+    DEDUP_STATS.add(DEDUP, imgs[:MAX_FRAMES], chosen, weight)
+    return chosen
+
+def collect_imgs(folder: Path, segment: str, weight=1):
     """
     Collect up to MAX_FRAMES images from `folder` whose filenames include `segment` (case-insensitive).
     If none found, fallback to first MAX_FRAMES images in the folder.
     """
-    if not folder or not folder.exists():
+    if not folder or not RESOLVER.isdir(folder):
         return []
 
     segment_lower = segment.lower()
-    imgs = sorted([
-        f for f in folder.iterdir()
-        if f.is_file() and f.suffix.lower() == ".jpg" and segment_lower in f.name.lower()
-    ])
+    all_imgs = list_jpgs(folder)
+    imgs = [f for f in all_imgs if segment_lower in f.name.lower()]
     if not imgs:
         # fallback: any images in folder
-        imgs = sorted([f for f in folder.iterdir() if f.is_file() and f.suffix.lower() == ".jpg"])
-    return imgs[:MAX_FRAMES]
+        imgs = all_imgs
+    return pick_frames(imgs, weight)
 
 def build_env(sid, env_data):
     out = []
     env_folder = BBOX_ROOT / sid / "environment"
 
-    if not env_folder.exists():
+    if not RESOLVER.isdir(env_folder):
         ov = BBOX_ROOT / sid / "overhead_view"
-        if ov.exists():
-            env_folder = next((c for c in ov.iterdir() if c.is_dir()), None)
+        if RESOLVER.isdir(ov):
+            env_folder = first_subdir(ov, sid)
         else:
             env_folder = None
 
@@ -92,6 +132,7 @@ def build_overhead(sid, over_data):
     out = []
     entry = over_data[0]
     video_stems = [Path(v).stem for v in entry.get("overhead_videos", [])]
+    video_stems = top_views(VIEW_RANKING, sid, video_stems, TOP_K_VIEWS)
     cams_root = BBOX_ROOT / sid / "overhead_view"
 
     for phase in entry.get("event_phase", []):
@@ -100,31 +141,30 @@ def build_overhead(sid, over_data):
         start_time = phase.get("start_time", "0")
         end_time = phase.get("end_time", "0")
 
+        weight = len(phase.get("conversations", []))
         imgs = []
         for vs in video_stems:
             cam_folder = cams_root / vs
-            if not cam_folder.exists():
+            if not RESOLVER.isdir(cam_folder):
                 continue
 
-            cand = sorted([
-                p for p in cam_folder.iterdir()
-                if p.is_file() and p.suffix.lower() == ".jpg" and segment in p.name.lower()
-            ])
+            cand = [p for p in list_jpgs(cam_folder) if segment in p.name.lower()]
             imgs.extend(cand)
-            if len(imgs) >= MAX_FRAMES:
+            # with --dedup every camera is a candidate source
+            if DEDUP is None and len(imgs) >= MAX_FRAMES:
                 break
 
-        imgs = imgs[:MAX_FRAMES]
+        imgs = pick_frames(imgs, weight)
 
         # fallback: try any images if none matched segment
         if not imgs:
             for vs in video_stems:
                 cam_folder = cams_root / vs
-                if not cam_folder.exists():
+                if not RESOLVER.isdir(cam_folder):
                     continue
-                any_imgs = sorted([p for p in cam_folder.iterdir() if p.is_file() and p.suffix.lower() == ".jpg"])
+                any_imgs = list_jpgs(cam_folder)
                 if any_imgs:
-                    imgs = any_imgs[:MAX_FRAMES]
+                    imgs = pick_frames(any_imgs, weight)
                     break
 
         if not imgs:
@@ -156,14 +196,14 @@ def build_vehicle(sid, veh_data, bbox_root):
 
     # Attempt to find the nested folder for vehicle images
     nested_folder = None
-    if vehicle_cameras_path.exists():
+    if RESOLVER.isdir(vehicle_cameras_path):
         # Sometimes nested folders named like <sid>_vehicle_view
         possible_nested = vehicle_cameras_path / f"{sid}_vehicle_view"
-        if possible_nested.exists():
+        if RESOLVER.isdir(possible_nested):
             nested_folder = possible_nested
         else:
             # fallback to first directory inside vehicle_view
-            nested_folder = next((c for c in vehicle_cameras_path.iterdir() if c.is_dir()), None)
+            nested_folder = first_subdir(vehicle_cameras_path)
 
     for phase in event_phases:
         seg_raw = phase.get("labels", ["unknown"])[0]
@@ -171,13 +211,14 @@ def build_vehicle(sid, veh_data, bbox_root):
         start_time = phase.get("start_time", "0")
         end_time = phase.get("end_time", "0")
 
+        weight = len(phase.get("conversations", []))
         imgs = []
         # First try nested folder
         if nested_folder:
-            imgs = collect_imgs(nested_folder, segment)
+            imgs = collect_imgs(nested_folder, segment, weight)
         # fallback to vehicle_view root folder
         if not imgs:
-            imgs = collect_imgs(vehicle_cameras_path, segment)
+            imgs = collect_imgs(vehicle_cameras_path, segment, weight)
 
         # DEBUG: print how many images found
         # print(f"Vehicle view images found for {sid} segment '{segment}': {len(imgs)}")
@@ -218,16 +259,49 @@ def process_scenario(folder: Path, sid: str, sink: list):
         sink.extend(build_vehicle(sid, veh, BBOX_ROOT))
 
 def main():
+    global RESOLVER, DEDUP, DEDUP_THRESHOLD, VIEW_RANKING, TOP_K_VIEWS
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--packed", action="store_true", help="also read frames from .pack containers under BBOX_ROOT")
+    parser.add_argument("--dedup", action="store_true", help="drop near-duplicate frames using perceptual hashes")
+    parser.add_argument("--dedup-threshold", type=float, default=THRESHOLD, help="hash similarity at which frames count as duplicates")
+    parser.add_argument("--hash-cache", type=str, default=CACHE_PATH)
+    parser.add_argument("--views-map", type=str, default=None, help="camera ranking or best-view map from get_best_view.py")
+    parser.add_argument("--top-k", type=int, default=1, help="overhead cameras kept per scenario with --views-map")
+    add_shard_args(parser)
+    args = parser.parse_args()
+    if args.views_map:
+        VIEW_RANKING = load_view_ranking(args.views_map)
+        TOP_K_VIEWS = args.top_k
+    RESOLVER = FrameResolver(BBOX_ROOT, packed=args.packed)
+    if args.dedup:
+        DEDUP = HashCache(RESOLVER, args.hash_cache)
+        DEDUP_THRESHOLD = args.dedup_threshold
+    num_shards, shard_index = resolve_shard(args)
+
+    if args.gather:
+        # scenarios are processed in sorted order, so a stable sort by id restores the single-run order
+        all_samples = gather_json(OUTPUT_JSON, num_shards, sort_key=lambda s: s["id"])
+        with open(OUTPUT_JSON, "w") as f_out:
+            json.dump(all_samples, f_out, indent=2)
+        print(f"Gathered {len(all_samples)} samples from {num_shards} shards")
+        return
+
+    metrics.init("vqa_space_om")
     all_samples = []
 
     for scen in tqdm(sorted(os.listdir(VQA_ROOT))):
         scen_path = VQA_ROOT / scen
-        if scen_path.is_dir():
+        if scen_path.is_dir() and in_shard(scen, num_shards, shard_index):
             process_scenario(scen_path, scen, all_samples)
 
     print(f"Total samples created: {len(all_samples)}")
+    metrics.count("samples", len(all_samples))
+    if DEDUP is not None:
+        DEDUP.save()
+        print(DEDUP_STATS.summary(str(OUTPUT_JSON)))
 
-    with open(OUTPUT_JSON, "w") as f_out:
+    output_json = shard_output_path(OUTPUT_JSON, num_shards, shard_index)
+    with metrics.span("write"), open(output_json, "w") as f_out:
         json.dump(all_samples, f_out, indent=2)
 
 if __name__ == "__main__":